@@ -16,6 +16,11 @@ import threading
 import time
 from datetime import datetime
 
+from cancellation import current_token
+from concurrency_limits import provider_slot
+from ink_trace import current_span, span
+import prompt_budget
+
 logger = logging.getLogger("ink.agent")
 
 # ---------------------------------------------------------------------------
@@ -46,6 +51,25 @@ PROVIDER_MODEL_NAMES = {
     "kimi":     ("KIMI_MODEL",      "moonshot-v1-8k"),
 }
 
+# Hard cap on extracted file text; what reaches the model is trimmed to the
+# model's context window by prompt_budget.
+READ_FILE_MAX_CHARS = 400_000
+
+# Share of the input budget for one tool result, and for the initial
+# system + user messages (the rest is left for the conversation).
+TOOL_RESULT_BUDGET_RATIO = 0.25
+INITIAL_PROMPT_BUDGET_RATIO = 0.5
+# Compacted tool results keep this many tokens; the newest ones stay intact.
+COMPACTED_TOOL_TOKENS = 300
+KEEP_RECENT_TOOL_RESULTS = 2
+
+# Sent back when a tool call's arguments were cut off at the output limit
+TRUNCATED_TOOL_CALL_PROMPT = (
+    "上一条回复超出单次输出长度上限，工具调用的参数被截断，未执行。"
+    "请把内容拆成多次较短的 write_file 调用：第一次写入开头部分，"
+    "之后设置 append=true 依次追加其余部分。"
+)
+
 # ---------------------------------------------------------------------------
 # Tool definitions (OpenAI function-calling format)
 # ---------------------------------------------------------------------------
@@ -120,7 +144,9 @@ TOOL_DEFINITIONS = [
             "description": (
                 "Write content to a file in the workspace. "
                 "Creates parent directories if needed. "
-                "You MUST use this to create 'output/article.html'."
+                "You MUST use this to create 'output/article.html'. "
+                "For long content, write it in several calls: the first one "
+                "creates the file, later ones set append=true."
             ),
             "parameters": {
                 "type": "object",
@@ -133,6 +159,10 @@ TOOL_DEFINITIONS = [
                         "type": "string",
                         "description": "The content to write.",
                     },
+                    "append": {
+                        "type": "boolean",
+                        "description": "Append to the file instead of overwriting it.",
+                    },
                 },
                 "required": ["path", "content"],
             },
@@ -169,7 +199,7 @@ def validate_path(path, workspace):
 # Tool implementations (synchronous)
 # ---------------------------------------------------------------------------
 
-def tool_web_search(query, config):
+def tool_web_search(query, config, token=None):
     """Web search via existing search_adapter."""
     try:
         from search_adapter import _search_via_tavily, _search_via_serpapi
@@ -204,9 +234,9 @@ def tool_web_search(query, config):
     for p in order:
         try:
             if p == "tavily":
-                results = _search_via_tavily([query], config, fetch_top_n=5)
+                results = _search_via_tavily([query], config, fetch_top_n=5, token=token)
             else:
-                results = _search_via_serpapi([query], config, fetch_top_n=5)
+                results = _search_via_serpapi([query], config, fetch_top_n=5, token=token)
 
             if results:
                 formatted = []
@@ -338,8 +368,8 @@ def _read_text(path):
     for enc in ("utf-8", "gbk", "gb2312", "latin-1"):
         try:
             text = raw.decode(enc)
-            if len(text) > 50000:
-                text = text[:50000] + "\n... [truncated]"
+            if len(text) > READ_FILE_MAX_CHARS:
+                text = text[:READ_FILE_MAX_CHARS] + "\n... [truncated]"
             return text
         except (UnicodeDecodeError, LookupError):
             continue
@@ -364,8 +394,8 @@ def _read_excel(path):
             parts.append(f"## Sheet: {name}\n" + "\n".join(rows))
         wb.close()
         result = "\n\n".join(parts)
-        if len(result) > 50000:
-            result = result[:50000] + "\n... [truncated]"
+        if len(result) > READ_FILE_MAX_CHARS:
+            result = result[:READ_FILE_MAX_CHARS] + "\n... [truncated]"
         return result
     except Exception as e:
         return f"Error reading Excel: {e}"
@@ -382,8 +412,8 @@ def _read_docx(path):
                 cells = [cell.text.strip() for cell in row.cells]
                 parts.append(" | ".join(cells))
         result = "\n".join(parts)
-        if len(result) > 50000:
-            result = result[:50000] + "\n... [truncated]"
+        if len(result) > READ_FILE_MAX_CHARS:
+            result = result[:READ_FILE_MAX_CHARS] + "\n... [truncated]"
         return result
     except Exception as e:
         return f"Error reading Word: {e}"
@@ -400,37 +430,38 @@ def _read_pdf(path):
                 if text:
                     parts.append(f"--- Page {i+1} ---\n{text}")
         result = "\n\n".join(parts)
-        if len(result) > 50000:
-            result = result[:50000] + "\n... [truncated]"
+        if len(result) > READ_FILE_MAX_CHARS:
+            result = result[:READ_FILE_MAX_CHARS] + "\n... [truncated]"
         return result or "(empty PDF)"
     except Exception as e:
         return f"Error reading PDF: {e}"
 
 
-def tool_write_file(path, content, workspace):
-    """Write file to workspace with path validation."""
+def tool_write_file(path, content, workspace, append=False):
+    """Write (or append) file to workspace with path validation."""
     try:
         resolved = validate_path(path, workspace)
         os.makedirs(os.path.dirname(resolved), exist_ok=True)
-        with open(resolved, "w", encoding="utf-8") as f:
+        with open(resolved, "a" if append else "w", encoding="utf-8") as f:
             f.write(content)
-        return f"OK: wrote {len(content)} chars to {path}"
+        return f"OK: {'appended' if append else 'wrote'} {len(content)} chars to {path}"
     except ValueError as e:
         return f"Error: {e}"
     except Exception as e:
         return f"Error writing file: {e}"
 
 
-def execute_tool(name, args, workspace, config):
+def execute_tool(name, args, workspace, config, token=None):
     """Tool dispatcher."""
     if name == "web_search":
-        return tool_web_search(args.get("query", ""), config)
+        return tool_web_search(args.get("query", ""), config, token=token)
     elif name == "run_python":
         return tool_run_python(args.get("code", ""), workspace)
     elif name == "read_file":
         return tool_read_file(args.get("path", ""), workspace)
     elif name == "write_file":
-        return tool_write_file(args.get("path", ""), args.get("content", ""), workspace)
+        return tool_write_file(args.get("path", ""), args.get("content", ""), workspace,
+                               append=bool(args.get("append")))
     else:
         return f"Error: Unknown tool '{name}'"
 
@@ -439,12 +470,18 @@ def execute_tool(name, args, workspace, config):
 # LLM calling with tools
 # ---------------------------------------------------------------------------
 
+def _uses_anthropic_api(config):
+    """Claude in agent mode goes through the Messages API whenever a key is configured."""
+    return (config.get("LLM_PROVIDER", "deepseek").lower() == "claude"
+            and bool(config.get("ANTHROPIC_API_KEY")))
+
+
 def _resolve_provider(config):
     """Extract endpoint, api_key, model from config."""
     provider = config.get("LLM_PROVIDER", "deepseek").lower()
     if provider == "claude":
-        # Agent 模式需要 function-calling，Claude CLI 不支持，回退到 deepseek
-        logger.warning("Agent mode: Claude not supported, falling back to deepseek")
+        # Agent 模式需要 function-calling，Claude CLI 不支持；未配置 ANTHROPIC_API_KEY 时回退到 deepseek
+        logger.warning("Agent mode: Claude CLI has no function calling, falling back to deepseek")
         provider = "deepseek"
 
     endpoint = PROVIDER_ENDPOINTS.get(provider)
@@ -462,35 +499,230 @@ def _resolve_provider(config):
     return endpoint, api_key, model
 
 
-def call_llm_with_tools(messages, config, tools=None):
-    """Call OpenAI-compatible API with function-calling support."""
-    import requests
+def call_llm_with_tools(messages, config, tools=None, token=None):
+    """Call OpenAI-compatible API with function-calling support.
 
-    endpoint, api_key, model = _resolve_provider(config)
+    Claude with ANTHROPIC_API_KEY goes through the Messages API; the request and
+    response keep the OpenAI shape. The HTTP timeout is derived from the
+    request's remaining budget. Transient failures (429 / 5xx / connection
+    errors) are retried per retry_policy before the turn is given up. Every
+    attempt first takes a slot from the cross-process rate limiter, queueing
+    while the provider's RPM / TPM budget is exhausted, and is recorded in the
+    usage ledger. A text reply cut off by the output limit is continued (see
+    llm_continuation) and returned as one stitched message. Each request passes
+    the provider's circuit breaker; while it is open the turn fails at once.
+    """
+    import circuit_breaker
+    import http_session
+    import llm_continuation
+    import rate_limiter
+    import usage_ledger
+    from retry_policy import (
+        HTTPStatusError, call_with_retry, is_retryable, response_retry_after,
+    )
 
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": 0.7,
-        "max_tokens": 8192,
-    }
-    if tools:
-        payload["tools"] = tools
+    if token is None:
+        token = current_token()
+    timeout = token.timeout(300)
+    prompt_tokens = prompt_budget.estimate_tokens(json.dumps(messages, ensure_ascii=False))
+    ceiling = llm_continuation.output_ceiling(config)
+
+    if _uses_anthropic_api(config):
+        import anthropic_client
+        provider = "claude"
+        model = anthropic_client.resolve_model(config)
+        api_key = config.get("ANTHROPIC_API_KEY", "")
+
+        def _send_once(msgs, max_tokens, extra_tokens):
+            def _chat():
+                rate_limiter.acquire("llm", "claude", api_key,
+                                     tokens=prompt_tokens + extra_tokens,
+                                     config=config, token=token)
+                with usage_ledger.meter("claude", model, kind="tools"):
+                    data = anthropic_client.chat_with_tools(
+                        msgs, config, tools, token.timeout(timeout), token,
+                        max_tokens=max_tokens)
+                    usage_ledger.note(data.get("usage"))
+                return data
+            return call_with_retry(_chat, token=token, label="llm.tools.claude")
+    else:
+        endpoint, api_key, model = _resolve_provider(config)
+        # Claude falls back to deepseek in _resolve_provider; key the slot by the real endpoint
+        provider = next((p for p, url in PROVIDER_ENDPOINTS.items() if url == endpoint),
+                        endpoint)
+
+        def _send_once(msgs, max_tokens, extra_tokens):
+            payload = {
+                "model": model,
+                "messages": msgs,
+                "temperature": 0.7,
+                "max_tokens": max_tokens,
+            }
+            if tools:
+                payload["tools"] = tools
+
+            def _post():
+                rate_limiter.acquire("llm", provider, api_key,
+                                     tokens=prompt_tokens + extra_tokens,
+                                     config=config, token=token)
+                with usage_ledger.meter(provider, model, kind="tools"):
+                    resp = http_session.post(
+                        endpoint,
+                        headers={
+                            "Authorization": f"Bearer {api_key}",
+                            "Content-Type": "application/json",
+                        },
+                        json=payload,
+                        timeout=token.timeout(timeout),
+                    )
+                    # Cancelled while blocked on the call: discard the response
+                    token.check()
+
+                    if resp.status_code != 200:
+                        raise HTTPStatusError(
+                            f"LLM API error: HTTP {resp.status_code} {resp.text[:300]}",
+                            status=resp.status_code, retry_after=response_retry_after(resp))
+                    data = resp.json()
+                    usage_ledger.note(data.get("usage"))
+                current_span().add(bytes_out=len(resp.content))
+                return data
+            return call_with_retry(_post, token=token, label=f"llm.tools.{provider}")
+
+    def _send(msgs, max_tokens, extra_tokens):
+        # Open breaker: fail the turn at once instead of waiting out the timeout
+        wait = circuit_breaker.admit("llm", provider, config, lease=timeout)
+        if wait:
+            raise RuntimeError(f"{provider} circuit open after repeated failures, "
+                               f"retry in ~{wait:.0f}s")
+        start = time.monotonic()
+        try:
+            data = _send_once(msgs, max_tokens, extra_tokens)
+        except Exception as e:
+            # Only unhealthy errors count; 400 / 401 mean the provider answered
+            circuit_breaker.record("llm", provider, not is_retryable(e),
+                                   time.monotonic() - start, config)
+            raise
+        except BaseException:
+            circuit_breaker.record("llm", provider, None, config=config)
+            raise
+        circuit_breaker.record("llm", provider, True, time.monotonic() - start, config)
+        return data
+
+    with provider_slot("llm", provider), \
+            span("llm.tools", cat="llm", model=model, messages=len(messages)) as sp:
+        data = _send(messages, prompt_budget.max_output_tokens(provider, model,
+                                                              min(8192, ceiling)), 0)
+        data, continuations = _continue_truncated(
+            data, messages, _send, provider, model, prompt_tokens,
+            llm_continuation.max_continuations(config), ceiling)
+        if continuations:
+            sp.set(continuations=continuations)
+        usage = data.get("usage") or {}
+    rate_limiter.debit("llm", provider, api_key,
+                       tokens=usage.get("completion_tokens") or 0, config=config)
+    return data
+
+
+def _continue_truncated(data, messages, send, provider, model, prompt_tokens, limit, ceiling):
+    """Continue a text reply cut off at the output limit.
+
+    Tool calls cut off mid-arguments cannot be continued; they come back as-is
+    (finish_reason "length") for run_agent_loop to reject. Returns the response
+    with the stitched content and summed usage, and the number of continuations.
+    """
+    import llm_continuation
+
+    choices = data.get("choices") or []
+    if not choices:
+        return data, 0
+    choice = choices[0]
+    message = choice.get("message") or {}
+    usage = dict(data.get("usage") or {})
+    produced = usage.get("completion_tokens") or prompt_budget.estimate_tokens(
+        message.get("content") or "", provider)
+    done = 0
+    while choice.get("finish_reason") == "length" and not message.get("tool_calls"):
+        content = message.get("content") or ""
+        max_tokens = llm_continuation.next_max_tokens(provider, model, prompt_tokens,
+                                                      produced, ceiling)
+        if done >= limit or not max_tokens or not content:
+            logger.warning("Agent reply truncated at ~%d tokens, continuation limit reached",
+                           produced)
+            break
+        done += 1
+        logger.info("Agent reply truncated at ~%d tokens, continuing (%d/%d)",
+                    produced, done, limit)
+        try:
+            more = send(llm_continuation.messages_for(messages, content, provider),
+                        max_tokens, produced)
+        except Exception as e:
+            # Keep what we have; the turn proceeds as if it had not been continued
+            logger.warning("Agent continuation failed: %s", e)
+            break
+        more_choice = (more.get("choices") or [{}])[0]
+        more_message = more_choice.get("message") or {}
+        message = dict(message, content=llm_continuation.stitch(
+            content, more_message.get("content") or "", provider))
+        if more_message.get("tool_calls"):
+            message["tool_calls"] = more_message["tool_calls"]
+        choice = dict(more_choice, message=message)
+        more_usage = more.get("usage") or {}
+        produced += more_usage.get("completion_tokens") or prompt_budget.estimate_tokens(
+            more_message.get("content") or "", provider)
+        for key in ("prompt_tokens", "completion_tokens"):
+            usage[key] = (usage.get(key) or 0) + (more_usage.get(key) or 0)
+    if done:
+        data = dict(data, choices=[choice], usage=usage)
+    return data, done
 
-    resp = requests.post(
-        endpoint,
-        headers={
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        },
-        json=payload,
-        timeout=300,
-    )
 
-    if resp.status_code != 200:
-        raise RuntimeError(f"LLM API error: HTTP {resp.status_code} {resp.text[:300]}")
+# ---------------------------------------------------------------------------
+# Context budget
+# ---------------------------------------------------------------------------
+
+def _agent_model(config):
+    """(provider, model) the agent will talk to, mirroring call_llm_with_tools."""
+    if _uses_anthropic_api(config):
+        import anthropic_client
+        return "claude", anthropic_client.resolve_model(config)
+    provider = config.get("LLM_PROVIDER", "deepseek").lower()
+    if provider == "claude":
+        provider = "deepseek"
+    model_key, default_model = PROVIDER_MODEL_NAMES.get(provider, ("", ""))
+    return provider, config.get(model_key, default_model)
 
-    return resp.json()
+
+def _message_tokens(msg, provider):
+    tokens = prompt_budget.estimate_tokens(msg.get("content") or "", provider)
+    if msg.get("tool_calls"):
+        tokens += prompt_budget.estimate_tokens(
+            json.dumps(msg["tool_calls"], ensure_ascii=False), provider)
+    return tokens + 4
+
+
+def _fit_messages(messages, budget, provider):
+    """Shrink the oldest tool results until the conversation fits the budget.
+
+    The system prompt, the task message and the most recent tool results are
+    kept intact; returns the estimated token count after compaction.
+    """
+    total = sum(_message_tokens(m, provider) for m in messages)
+    if total <= budget:
+        return total
+    tool_indexes = [i for i, m in enumerate(messages) if m.get("role") == "tool"]
+    for i in tool_indexes[:-KEEP_RECENT_TOOL_RESULTS]:
+        msg = messages[i]
+        before = _message_tokens(msg, provider)
+        if before <= COMPACTED_TOOL_TOKENS + 4:
+            continue
+        msg["content"] = prompt_budget.truncate(msg["content"], COMPACTED_TOOL_TOKENS, provider)
+        total -= before - _message_tokens(msg, provider)
+        if total <= budget:
+            break
+    if total > budget:
+        logger.warning("Agent context still over budget after compaction: ~%d > %d tokens",
+                       total, budget)
+    return total
 
 
 # ---------------------------------------------------------------------------
@@ -499,7 +731,8 @@ def call_llm_with_tools(messages, config, tools=None):
 
 def run_agent_loop(topic, config, emit_fn, workspace,
                    template_prompt="", file_contents="",
-                   file_formats=None, max_turns=15, layout_style=""):
+                   file_formats=None, max_turns=15, layout_style="",
+                   token=None):
     """
     Run the multi-turn agent loop.
 
@@ -512,15 +745,21 @@ def run_agent_loop(topic, config, emit_fn, workspace,
         file_contents: Extracted text from uploaded files
         file_formats: List of dicts with file format info [{name, ext, path}]
         max_turns: Maximum agent turns
+        token: CancelToken; checked before every turn and tool call
 
     Returns:
         HTML content string, or None if agent didn't produce output
     """
-    from agent_prompts import get_agent_system_prompt
+    from agent_prompts import TOPIC_REFERENCE, defer_topic, get_agent_system_prompt
+
+    if token is None:
+        token = current_token()
 
-    # 替换模板中的 {{TOPIC}} 占位符
-    if template_prompt and "{{TOPIC}}" in template_prompt:
-        template_prompt = template_prompt.replace("{{TOPIC}}", topic)
+    # 模板中的 {{TOPIC}} 换成固定指代，实际主题放在 user 消息里：
+    # system prompt 与主题无关，可命中服务商的前缀缓存
+    topic_deferred = bool(template_prompt and "{{TOPIC}}" in template_prompt)
+    if topic_deferred:
+        template_prompt = defer_topic(template_prompt)
 
     # 有上传文件时，去掉模板中"只输出 HTML"的指令（与格式保持规则冲突）
     if file_formats and template_prompt:
@@ -530,11 +769,24 @@ def run_agent_loop(topic, config, emit_fn, workspace,
 
     system_prompt = get_agent_system_prompt(template_prompt, file_formats, layout_style)
 
+    # Context budget of the actual model, minus the tool definitions sent every turn
+    provider, model = _agent_model(config)
+    budget = prompt_budget.input_budget(provider, model) - prompt_budget.estimate_tokens(
+        json.dumps(TOOL_DEFINITIONS, ensure_ascii=False), provider)
+    if file_contents:
+        # Uploaded text may use up to half the budget together with the system prompt
+        file_contents = prompt_budget.pack(
+            [prompt_budget.Section("system", system_prompt, required=True),
+             prompt_budget.Section("files", file_contents)],
+            int(budget * INITIAL_PROMPT_BUDGET_RATIO), provider)["files"]
+
     # Build user message — 根据场景调整措辞
     if file_formats:
         user_content = f"请处理以下任务：「{topic}」\n\n"
     else:
         user_content = f"请对「{topic}」进行调研和创作。\n\n"
+    if topic_deferred:
+        user_content = f"{TOPIC_REFERENCE}：「{topic}」\n\n" + user_content
 
     if file_contents:
         user_content += "## 用户上传的参考资料\n\n"
@@ -564,15 +816,19 @@ def run_agent_loop(topic, config, emit_fn, workspace,
         {"role": "user", "content": user_content},
     ]
 
-    logger.info("Agent loop start: topic=%s, max_turns=%d", topic[:60], max_turns)
+    logger.info("Agent loop start: topic=%s, max_turns=%d, model=%s, budget=%d tokens",
+                topic[:60], max_turns, model, budget)
 
     for turn in range(max_turns):
+        token.check()
         emit_fn("progress", stage="agent",
                 message=f"Agent 第 {turn+1}/{max_turns} 轮")
 
+        _fit_messages(messages, budget, provider)
         try:
             t0 = time.monotonic()
-            response = call_llm_with_tools(messages, config, tools=TOOL_DEFINITIONS)
+            response = call_llm_with_tools(messages, config, tools=TOOL_DEFINITIONS,
+                                           token=token)
             elapsed = round((time.monotonic() - t0) * 1000)
         except Exception as e:
             logger.error("LLM call failed at turn %d: %s", turn+1, e)
@@ -587,6 +843,16 @@ def run_agent_loop(topic, config, emit_fn, workspace,
 
         message = choices[0].get("message", {})
 
+        if choices[0].get("finish_reason") == "length" and message.get("tool_calls"):
+            # Arguments were cut off at the output limit: do not run the calls,
+            # ask the model to split the output instead
+            logger.warning("Turn %d: tool call truncated at the output limit", turn+1)
+            emit_fn("progress", stage="agent", message="工具调用参数超出输出长度，要求分段写入")
+            if message.get("content"):
+                messages.append({"role": "assistant", "content": message["content"]})
+            messages.append({"role": "user", "content": TRUNCATED_TOOL_CALL_PROMPT})
+            continue
+
         # Build assistant message for conversation history
         assistant_msg = {"role": "assistant"}
         assistant_msg["content"] = message.get("content") or ""
@@ -597,9 +863,11 @@ def run_agent_loop(topic, config, emit_fn, workspace,
         # Log token usage
         usage = response.get("usage", {})
         if usage:
-            logger.info("Turn %d: %dms, tokens in=%d out=%d",
+            logger.info("Turn %d: %dms, tokens in=%d (cached %d) out=%d",
                         turn+1, elapsed,
                         usage.get("prompt_tokens", 0),
+                        (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+                        or usage.get("prompt_cache_hit_tokens", 0),
                         usage.get("completion_tokens", 0))
 
         # Check for tool calls
@@ -625,18 +893,21 @@ def run_agent_loop(topic, config, emit_fn, workspace,
                     message=f"🔧 {tool_name}: {preview}")
 
             # Execute
+            token.check()
             t0 = time.monotonic()
-            result = execute_tool(tool_name, args, workspace, config)
+            with span(f"tool.{tool_name}", cat="tool"):
+                result = execute_tool(tool_name, args, workspace, config, token=token)
             tool_ms = round((time.monotonic() - t0) * 1000)
 
             emit_fn("progress", stage="agent",
                     message=f"✓ {tool_name} 完成 ({tool_ms}ms)")
 
-            # Append tool result
+            # Append tool result, trimmed to its share of the context budget
             messages.append({
                 "role": "tool",
                 "tool_call_id": tc_id,
-                "content": result,
+                "content": prompt_budget.truncate(
+                    result, int(budget * TOOL_RESULT_BUDGET_RATIO), provider),
             })
     else:
         emit_fn("progress", stage="agent",
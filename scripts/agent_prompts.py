@@ -66,6 +66,30 @@ HTML_QUALITY_RULES = """
   - 禁止使用浅色文字配浅色背景"""
 
 
+# ---------------------------------------------------------------------------
+# 缓存友好的 prompt 布局
+# ---------------------------------------------------------------------------
+# DeepSeek / Kimi / OpenAI 对重复的 prompt 前缀自动缓存（命中部分计费打折、首 token 更快）。
+# 固定的写作要求、排版规则放在前面，日期、主题、资料等每次变化的内容放在最后；
+# 模板中的 {{TOPIC}} 换成固定的指代，实际主题写在末尾的「本次任务」中。
+
+TOPIC_REFERENCE = "本次任务指定的主题"
+
+
+def defer_topic(template):
+    """模板中的 {{TOPIC}} 替换为固定指代，使模板部分逐字节不变"""
+    return template.replace("{{TOPIC}}", TOPIC_REFERENCE)
+
+
+def task_section(today, topic=None, extra_lines=()):
+    """prompt 末尾的「本次任务」：日期、主题和其他每次变化的要求"""
+    lines = ["", "", "## 本次任务", "", f"今天是 {today}。"]
+    if topic:
+        lines.append(f"{TOPIC_REFERENCE}：「{topic}」")
+    lines.extend(extra_lines)
+    return "\n".join(lines)
+
+
 def get_layout_instruction(layout_style=""):
     """根据排版样式返回对应的排版指令。"""
     if not layout_style or layout_style == "custom":
@@ -83,17 +107,14 @@ def get_agent_system_prompt(template_prompt="", file_formats=None, layout_style=
         layout_style: 排版样式 (modular/chapter/card/narrative/custom)
     """
     today = datetime.now().strftime("%Y年%m月%d日")
-    current_year = datetime.now().year
 
-    base_prompt = f"""你是一位专业的 AI 创作助手，能够根据用户需求灵活使用工具完成各类任务。
-
-## 当前日期
-{today}
+    # 固定内容在前、日期在最后，多轮调用和多次运行共享同一缓存前缀
+    base_prompt = """你是一位专业的 AI 创作助手，能够根据用户需求灵活使用工具完成各类任务。
 
 ## 可用工具
 
 1. **web_search(query)** — 搜索互联网获取最新信息
-   - 搜索时请包含年份关键词（如 {current_year}）以获取最新结果
+   - 搜索时请包含当前年份关键词（见文末「当前日期」）以获取最新结果
    - 优先搜索英文源（官方文档、GitHub、论文）
 
 2. **run_python(code)** — 执行 Python 代码
@@ -180,4 +201,9 @@ def get_agent_system_prompt(template_prompt="", file_formats=None, layout_style=
 
 **重要：你只需要生成 HTML 输出。系统会自动将 HTML 转换为与上传文件相同的格式（{ext_list}）。不要尝试用 run_python 生成 PDF/DOCX/XLSX 文件。**"""
 
+    base_prompt += f"""
+
+## 当前日期
+{today}"""
+
     return base_prompt
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Anthropic Messages API 后端
+
+claude provider 默认通过 Claude CLI 调用；配置 CLAUDE_BACKEND=api（或只配置了
+ANTHROPIC_API_KEY 的 Agent 模式）时改走 HTTP Messages API：
+
+- 复用 http_session 的连接池，没有每次调用的进程启动开销
+- 支持 SSE 流式输出（generate 的 on_delta）
+- 支持工具调用：chat_with_tools 接收 / 返回 OpenAI function-calling 格式，
+  agent_loop 无需区分后端
+
+配置项：
+    ANTHROPIC_API_KEY   API Key
+    ANTHROPIC_MODEL     模型名（默认 DEFAULT_MODEL）
+    ANTHROPIC_BASE_URL  API 地址（默认官方地址，可指向本地替身服务做测试）
+"""
+
+import json
+import time
+
+import http_session
+import retry_policy
+import usage_ledger
+from ink_trace import current_span
+
+DEFAULT_BASE_URL = "https://api.anthropic.com"
+DEFAULT_MODEL = "claude-sonnet-4-5"
+API_VERSION = "2023-06-01"
+
+# Anthropic stop_reason → OpenAI finish_reason
+_FINISH_REASONS = {
+    "end_turn": "stop",
+    "stop_sequence": "stop",
+    "tool_use": "tool_calls",
+    "max_tokens": "length",
+}
+
+
+class AnthropicError(Exception):
+    """Messages API 调用失败；status / retry_after / retryable 含义同 LLMError"""
+
+    def __init__(self, message, status=None, retry_after=None, retryable=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+def _status_error(resp):
+    return AnthropicError(
+        f"Anthropic API 返回错误: HTTP {resp.status_code} {_error_message(resp)}",
+        status=resp.status_code, retry_after=retry_policy.response_retry_after(resp))
+
+
+def use_api(config):
+    """claude provider 是否走 HTTP API（否则走 CLI）"""
+    return str(config.get("CLAUDE_BACKEND", "")).lower() == "api"
+
+
+def resolve_model(config):
+    return config.get("ANTHROPIC_MODEL") or DEFAULT_MODEL
+
+
+def _credentials(config):
+    api_key = config.get("ANTHROPIC_API_KEY", "")
+    if not api_key:
+        raise AnthropicError("未配置 ANTHROPIC_API_KEY，请在配置中设置")
+    base_url = (config.get("ANTHROPIC_BASE_URL") or DEFAULT_BASE_URL).rstrip("/")
+    return api_key, f"{base_url}/v1/messages"
+
+
+def _headers(api_key):
+    return {
+        "x-api-key": api_key,
+        "anthropic-version": API_VERSION,
+        "content-type": "application/json",
+    }
+
+
+def _error_message(resp):
+    try:
+        error = resp.json().get("error") or {}
+        return error.get("message") or resp.text[:300]
+    except ValueError:
+        return resp.text[:300]
+
+
+# ==================== 单轮生成 ====================
+
+def generate(prompt, config, timeout, token, max_tokens=8192, temperature=0.7,
+             on_delta=None, partial=""):
+    """单轮生成，返回 (文本, finish_reason)；传入 on_delta 时走 SSE 流式输出。
+
+    partial 非空时作为 assistant 预填充，从已生成部分之后续写（见 llm_continuation）。
+    """
+    import requests
+    import llm_continuation
+
+    api_key, url = _credentials(config)
+    messages = [{"role": "user", "content": prompt}]
+    if partial:
+        messages = llm_continuation.messages_for(messages, partial, "claude")
+    payload = {
+        "model": resolve_model(config),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": messages,
+    }
+    if on_delta is not None:
+        payload["stream"] = True
+
+    try:
+        resp = http_session.post(url, headers=_headers(api_key), json=payload,
+                                 timeout=timeout, stream=on_delta is not None)
+    except requests.exceptions.Timeout:
+        raise AnthropicError(f"Anthropic API 请求超时（{int(timeout)}秒）", retryable=True)
+    except requests.exceptions.ConnectionError:
+        raise AnthropicError("无法连接 Anthropic API，请检查网络", retryable=True)
+
+    if on_delta is not None:
+        content, stop_reason = _read_stream(resp, timeout, token, on_delta)
+    else:
+        token.check()
+        if resp.status_code != 200:
+            raise _status_error(resp)
+        data = resp.json()
+        usage_ledger.note(data.get("usage"))
+        content = "".join(b.get("text", "") for b in data.get("content") or []
+                          if b.get("type") == "text")
+        stop_reason = data.get("stop_reason")
+
+    # 不去除首尾空白：被截断的输出需要原样拼接续写内容
+    if not content.strip():
+        raise AnthropicError("Anthropic API 返回空内容")
+    return content, _FINISH_REASONS.get(stop_reason, "stop")
+
+
+def _read_stream(resp, timeout, token, on_delta):
+    """解析 Messages API 的 SSE 事件，回调文本增量，返回 (完整文本, stop_reason)"""
+    import requests
+
+    deadline = time.monotonic() + timeout
+    unregister = token.on_cancel(resp.close)
+    usage = {}
+    parts = []
+    stop_reason = None
+    try:
+        if resp.status_code != 200:
+            raise _status_error(resp)
+        for line in resp.iter_lines(chunk_size=None):
+            token.check()
+            if time.monotonic() > deadline:
+                raise AnthropicError(f"Anthropic API 请求超时（{int(timeout)}秒）", retryable=True)
+            line = line.decode("utf-8", errors="replace").strip()
+            if not line.startswith("data:"):
+                continue
+            try:
+                event = json.loads(line[5:].strip())
+            except json.JSONDecodeError:
+                continue
+            etype = event.get("type")
+            if etype == "content_block_delta":
+                delta = event.get("delta") or {}
+                if delta.get("type") == "text_delta" and delta.get("text"):
+                    parts.append(delta["text"])
+                    on_delta(delta["text"])
+            elif etype == "message_start":
+                usage.update((event.get("message") or {}).get("usage") or {})
+            elif etype == "message_delta":
+                usage.update(event.get("usage") or {})
+                stop_reason = (event.get("delta") or {}).get("stop_reason") or stop_reason
+            elif etype == "error":
+                error = event.get("error") or {}
+                # 流内的 overloaded_error / api_error 属于服务端瞬时故障，可重试
+                raise AnthropicError(f"Anthropic API 返回错误: {error.get('message', error)}",
+                                     retryable=error.get("type") in ("overloaded_error",
+                                                                     "api_error"))
+            elif etype == "message_stop":
+                break
+    except AnthropicError:
+        raise
+    except Exception as e:
+        # 取消时 resp.close() 会让阻塞中的读取抛出各种异常，优先报告取消
+        token.check()
+        if isinstance(e, requests.exceptions.Timeout):
+            raise AnthropicError(f"Anthropic API 请求超时（{int(timeout)}秒）", retryable=True)
+        if isinstance(e, requests.exceptions.RequestException):
+            raise AnthropicError(f"Anthropic API 连接中断: {e}", retryable=True)
+        raise
+    finally:
+        unregister()
+        resp.close()
+    token.check()
+    usage_ledger.note(usage)
+    return "".join(parts), stop_reason
+
+
+# ==================== 工具调用（OpenAI 格式互转） ====================
+
+def _to_anthropic_tools(tools):
+    converted = []
+    for tool in tools or []:
+        fn = tool.get("function", tool)
+        converted.append({
+            "name": fn["name"],
+            "description": fn.get("description", ""),
+            "input_schema": fn.get("parameters") or {"type": "object", "properties": {}},
+        })
+    return converted
+
+
+def _to_anthropic_messages(messages):
+    """OpenAI 格式消息 → (system, messages)。
+
+    tool 消息转为 user 角色的 tool_result 块；相邻同角色消息合并，
+    满足 Messages API 角色交替的要求。
+    """
+    system_parts = []
+    converted = []
+    for msg in messages:
+        role = msg.get("role")
+        content = msg.get("content") or ""
+        if role == "system":
+            system_parts.append(content)
+            continue
+        if role == "tool":
+            role = "user"
+            blocks = [{"type": "tool_result", "tool_use_id": msg.get("tool_call_id", ""),
+                       "content": content}]
+        elif role == "assistant":
+            blocks = [{"type": "text", "text": content}] if content else []
+            for tc in msg.get("tool_calls") or []:
+                fn = tc.get("function", {})
+                try:
+                    args = json.loads(fn.get("arguments") or "{}")
+                except json.JSONDecodeError:
+                    args = {}
+                blocks.append({"type": "tool_use", "id": tc.get("id", ""),
+                               "name": fn.get("name", ""), "input": args})
+        else:
+            role = "user"
+            blocks = [{"type": "text", "text": content}]
+        if not blocks:
+            continue
+        if converted and converted[-1]["role"] == role:
+            converted[-1]["content"].extend(blocks)
+        else:
+            converted.append({"role": role, "content": blocks})
+    return "\n\n".join(system_parts), converted
+
+
+def _to_openai_response(data):
+    """Messages API 响应 → OpenAI chat.completions 响应结构"""
+    texts = []
+    tool_calls = []
+    for block in data.get("content") or []:
+        if block.get("type") == "text":
+            texts.append(block.get("text", ""))
+        elif block.get("type") == "tool_use":
+            tool_calls.append({
+                "id": block.get("id", ""),
+                "type": "function",
+                "function": {
+                    "name": block.get("name", ""),
+                    "arguments": json.dumps(block.get("input") or {}, ensure_ascii=False),
+                },
+            })
+    message = {"role": "assistant", "content": "".join(texts)}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    usage = data.get("usage") or {}
+    cached = usage.get("cache_read_input_tokens") or 0
+    return {
+        "id": data.get("id", ""),
+        "model": data.get("model", ""),
+        "choices": [{
+            "index": 0,
+            "message": message,
+            "finish_reason": _FINISH_REASONS.get(data.get("stop_reason"), "stop"),
+        }],
+        "usage": {
+            "prompt_tokens": (usage.get("input_tokens", 0) + cached
+                              + (usage.get("cache_creation_input_tokens") or 0)),
+            "completion_tokens": usage.get("output_tokens", 0),
+            "prompt_tokens_details": {"cached_tokens": cached},
+        },
+    }
+
+
+def chat_with_tools(messages, config, tools, timeout, token, max_tokens=8192,
+                    temperature=0.7):
+    """多轮对话 + 工具调用；输入输出均为 OpenAI function-calling 格式"""
+    import requests
+
+    api_key, url = _credentials(config)
+    system, converted = _to_anthropic_messages(messages)
+    payload = {
+        "model": resolve_model(config),
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": converted,
+    }
+    if system:
+        # Messages API 只缓存显式标记的前缀：工具定义 + system prompt 在 Agent 多轮间不变
+        payload["system"] = [{"type": "text", "text": system,
+                              "cache_control": {"type": "ephemeral"}}]
+    if tools:
+        payload["tools"] = _to_anthropic_tools(tools)
+
+    try:
+        resp = http_session.post(url, headers=_headers(api_key), json=payload,
+                                 timeout=timeout)
+    except requests.exceptions.Timeout:
+        raise AnthropicError(f"Anthropic API 请求超时（{int(timeout)}秒）", retryable=True)
+    except requests.exceptions.ConnectionError:
+        raise AnthropicError("无法连接 Anthropic API，请检查网络", retryable=True)
+    token.check()
+    if resp.status_code != 200:
+        raise _status_error(resp)
+    current_span().add(bytes_out=len(resp.content))
+    return _to_openai_response(resp.json())
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+请求取消令牌 & 截止时间
+
+daemon 模式下每条命令对应一个 CancelToken，`cancel` 动作只影响目标请求，
+其他并发请求不受影响。handler 在安全点（emit 进度、网络调用前后）检查令牌，
+被取消时抛出 Cancelled 逐层退出。
+
+令牌可携带截止时间（命令的 timeout 字段）：每次网络调用用 token.timeout(默认值)
+从剩余预算推导超时，预算不足时直接抛出 DeadlineExceeded，不再发起注定超时的请求。
+"""
+
+import contextvars
+import threading
+import time
+
+
+class Cancelled(BaseException):
+    """请求已被取消。
+
+    继承 BaseException（同 asyncio.CancelledError），
+    避免被 handler 里大量的 `except Exception` 吞掉。
+    """
+
+    def __init__(self, reason="请求已取消"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class DeadlineExceeded(Cancelled):
+    """请求剩余时间预算已耗尽"""
+
+
+# 剩余预算低于该秒数时不再发起新的网络调用
+MIN_CALL_SECONDS = 1.0
+
+
+class CancelToken:
+    """线程安全的取消令牌，可选截止时间。
+
+    timeout: 从现在起的总预算（秒），None 表示不限。
+    到期时令牌自动取消，已注册的回调（如终止子进程）随之触发。
+    """
+
+    def __init__(self, timeout=None):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._timer = None
+        self._on_close = None
+        self._expired = False
+        self.reason = ""
+        self.deadline = None
+        if timeout is not None:
+            timeout = max(0.0, float(timeout))
+            self.deadline = time.monotonic() + timeout
+            self._timer = threading.Timer(timeout, self._expire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason="用户取消"):
+        """取消请求，并调用已注册的回调（如终止子进程、关闭连接）"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+            callbacks = list(self._callbacks)
+            self._callbacks.clear()
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    def _expire(self):
+        self._expired = True
+        self.cancel("已超过截止时间")
+
+    def check(self):
+        """安全点检查：已取消则抛出 Cancelled（到期抛出 DeadlineExceeded）"""
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self._expired = True
+        if self._expired:
+            raise DeadlineExceeded("已超过截止时间")
+        if self._event.is_set():
+            raise Cancelled(self.reason or "请求已取消")
+
+    def remaining(self):
+        """剩余秒数；无截止时间返回 None"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    def timeout(self, default, minimum=MIN_CALL_SECONDS):
+        """为一次网络调用计算超时：取 default 与剩余预算的较小值。
+
+        已取消或剩余预算不足 minimum 秒时抛出异常，调用方无需再发请求。
+        """
+        self.check()
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        if remaining < minimum:
+            self._expired = True
+            raise DeadlineExceeded(f"剩余时间不足 {minimum:g} 秒")
+        return min(default, remaining)
+
+    def child(self, timeout=None):
+        """派生子令牌：父令牌取消时子令牌随之取消，截止时间取两者较早者"""
+        remaining = self.remaining()
+        if timeout is None:
+            timeout = remaining
+        elif remaining is not None:
+            timeout = min(timeout, remaining)
+        child = CancelToken(timeout=timeout)
+        unregister = self.on_cancel(lambda: child.cancel(self.reason))
+        child._on_close = unregister
+        return child
+
+    def close(self):
+        """请求结束后释放计时器和父令牌上的回调"""
+        if self._timer is not None:
+            self._timer.cancel()
+        if self._on_close:
+            self._on_close()
+
+    def on_cancel(self, fn):
+        """注册取消回调；令牌已取消时立即调用。返回注销函数。"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return lambda: self._remove_callback(fn)
+        fn()
+        return lambda: None
+
+    def _remove_callback(self, fn):
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def wait(self, seconds):
+        """可被取消打断的等待，返回 True 表示期间被取消"""
+        return self._event.wait(seconds)
+
+
+# 当前请求的令牌（由 sidecar dispatcher 设置）
+_current_token = contextvars.ContextVar("ink_cancel_token", default=None)
+
+
+def current_token():
+    """返回当前请求的令牌；不在请求上下文中时返回一个永不取消的令牌"""
+    token = _current_token.get()
+    return token if token is not None else CancelToken()
+
+
+def bind_token(token):
+    """将令牌绑定到当前上下文，返回用于 reset 的 contextvars.Token"""
+    return _current_token.set(token)
+
+
+def unbind_token(ctx_token):
+    _current_token.reset(ctx_token)
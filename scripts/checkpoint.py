@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+生成流水线检查点
+
+handle_generate 每完成一个阶段（LLM 原始输出、HTML 提取、保存分篇、封面、
+OSS 上传、格式转换、元数据）就把产物记录到
+INK_HOME/checkpoints/{run_id}/manifest.json。下游阶段失败后用 resume 动作
+重跑时，产物仍然有效的阶段直接复用——LLM 调用最慢最贵，不会因为下游失败而重复。
+
+manifest 中保存的请求参数会去掉 API Key 等密钥，resume 时由调用方重新提供。
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+
+from ink_env import INK_HOME
+
+CHECKPOINT_DIR = os.path.join(str(INK_HOME), "checkpoints")
+MANIFEST_NAME = "manifest.json"
+
+# 参数名包含这些片段（不区分大小写）时视为密钥，不写入 manifest
+_SECRET_MARKERS = ("key", "secret", "token", "password")
+
+
+def _strip_secrets(params):
+    return {k: v for k, v in params.items()
+            if not any(m in k.lower() for m in _SECRET_MARKERS)}
+
+
+def _file_ok(path):
+    return bool(path) and os.path.isfile(path) and os.path.getsize(path) > 0
+
+
+class RunCheckpoint:
+    """一次生成运行的检查点。
+
+    stages: {阶段名: {"output": ..., "at": 时间戳}}，output 中的文件路径
+    在读取时校验存在性，文件被删除的阶段视为未完成。
+    """
+
+    def __init__(self, run_id, params=None, stages=None):
+        self.run_id = run_id
+        self.dir = os.path.join(CHECKPOINT_DIR, run_id)
+        self.path = os.path.join(self.dir, MANIFEST_NAME)
+        self.params = params or {}
+        self.stages = stages or {}
+        # 后处理阶段并发执行，record 可能来自多个线程
+        self._lock = threading.Lock()
+
+    # ---------- 创建 / 加载 ----------
+
+    @classmethod
+    def create(cls, run_id, params):
+        cp = cls(run_id, _strip_secrets(params))
+        cp._write()
+        return cp
+
+    @classmethod
+    def load(cls, run_id):
+        """读取已有检查点；不存在或损坏时返回 None"""
+        cp = cls(run_id)
+        try:
+            with open(cp.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        cp.params = data.get("params", {})
+        cp.stages = data.get("stages", {})
+        return cp
+
+    @classmethod
+    def open(cls, run_id, params, resume=False):
+        """resume 时加载已有检查点，否则新建"""
+        if resume:
+            cp = cls.load(run_id)
+            if cp is not None:
+                return cp
+        return cls.create(run_id, params)
+
+    # ---------- 阶段读写 ----------
+
+    def record(self, stage, output):
+        """记录阶段产物并立即落盘"""
+        with self._lock:
+            self.stages[stage] = {"output": output,
+                                  "at": time.strftime("%Y-%m-%d %H:%M:%S")}
+            self._write()
+
+    def get(self, stage, files=()):
+        """返回阶段产物；未记录或 files 指定的产物文件缺失时返回 None。
+
+        files: output 中表示文件路径的字段名，值可以是单个路径或路径列表。
+        """
+        entry = self.stages.get(stage)
+        if not entry:
+            return None
+        output = entry.get("output")
+        for field in files:
+            value = output.get(field) if isinstance(output, dict) else None
+            paths = value if isinstance(value, list) else [value]
+            # 空路径表示该项本就没有产物（如未安装 Pillow 时没有封面）
+            if not all(_file_ok(p) for p in paths if p):
+                return None
+        return output
+
+    def done(self):
+        """已完成的阶段名（不校验文件）"""
+        return list(self.stages)
+
+    def save_text(self, name, text):
+        """把较大的文本产物（如 LLM 原始输出）存到检查点目录，返回路径"""
+        os.makedirs(self.dir, exist_ok=True)
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def read_text(self, name):
+        path = os.path.join(self.dir, name)
+        if not _file_ok(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def _write(self):
+        os.makedirs(self.dir, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"run_id": self.run_id, "params": self.params,
+                       "stages": self.stages}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, self.path)
+
+
+def cleanup_old_checkpoints(max_days=7):
+    """删除 max_days 天前的检查点目录"""
+    if not os.path.isdir(CHECKPOINT_DIR):
+        return
+    cutoff = time.time() - max_days * 86400
+    for name in os.listdir(CHECKPOINT_DIR):
+        path = os.path.join(CHECKPOINT_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+按服务商熔断（跨进程共享健康状态）
+
+服务商故障时，每次 generate 都要等满超时（最长 600 秒）才失败，下一次 sidecar
+运行又重复一遍。这里按 (类别, 服务商) 维护断路器，状态存于 INK_HOME/breaker.db
+（SQLite），短命的单次运行进程之间共享已知的健康状况：
+
+    wait = circuit_breaker.admit("llm", "deepseek", config, lease=timeout)
+    if wait:
+        raise LLMError(f"... 约 {wait:.0f} 秒后重试")
+    ...
+    circuit_breaker.record("llm", "deepseek", ok, latency, config)
+
+- closed：正常放行，记录最近 WINDOW_SIZE 次结果（WINDOW_SECONDS 内）的成功 / 失败和延迟
+- 连续失败 LLM_BREAKER_FAILURES 次（默认 5），或窗口内至少 MIN_CALLS 次调用且失败率
+  ≥ FAILURE_RATIO 时打开（open）：调用直接被拒，llm_hedge 立即换备用服务商，
+  没有备用时快速返回明确的错误
+- 冷却 LLM_BREAKER_COOLDOWN 秒（默认 60）后进入 half_open：放行一个探测请求
+  （所有进程中只有一个，租期为该调用的超时），成功则关闭，失败则重新打开、冷却加倍
+  （上限 MAX_COOLDOWN）
+- 失败只计服务商不健康的错误（retry_policy.is_retryable：429 / 5xx / 超时 / 连接失败），
+  401、400 之类说明服务商正常响应，计为成功；取消不计入结果，只释放探测租期
+- LLM_BREAKER_SLOW_SECONDS > 0 时，超过该耗时的成功调用在失败率中计为失败
+- LLM_BREAKER=0（或环境变量 INK_LLM_BREAKER=0）关闭；数据库不可用时记录警告并放行
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+from ink_env import INK_HOME
+
+logger = logging.getLogger("ink")
+
+DB_PATH = os.path.join(str(INK_HOME), "breaker.db")
+
+DEFAULT_FAILURES = 5
+DEFAULT_COOLDOWN = 60.0
+MAX_COOLDOWN = 900.0
+# 失败率判定：窗口内最近的调用
+WINDOW_SIZE = 20
+WINDOW_SECONDS = 600.0
+MIN_CALLS = 10
+FAILURE_RATIO = 0.5
+# 未给出租期时探测请求占用 half_open 的秒数
+DEFAULT_LEASE = 60.0
+
+
+def _setting(config, key, default):
+    raw = (config or {}).get(key) or os.environ.get(f"INK_{key}", "")
+    try:
+        return max(0.0, float(raw)) if str(raw).strip() else default
+    except ValueError:
+        logger.warning("%s: invalid value %s", key, raw)
+        return default
+
+
+def enabled(config=None):
+    value = str((config or {}).get("LLM_BREAKER") or os.environ.get("INK_LLM_BREAKER", "1"))
+    return value.lower() not in ("0", "false", "no", "off")
+
+
+def _connect():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS breakers (
+        key TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        failures INTEGER NOT NULL,
+        opened_at REAL NOT NULL,
+        cooldown REAL NOT NULL,
+        probe_until REAL NOT NULL,
+        outcomes TEXT NOT NULL)""")
+    return conn
+
+
+def _load(conn, key):
+    row = conn.execute("SELECT state, failures, opened_at, cooldown, probe_until, outcomes "
+                       "FROM breakers WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    state, failures, opened_at, cooldown, probe_until, outcomes = row
+    try:
+        outcomes = json.loads(outcomes)
+    except json.JSONDecodeError:
+        outcomes = []
+    return {"state": state, "failures": failures, "opened_at": opened_at,
+            "cooldown": cooldown, "probe_until": probe_until, "outcomes": outcomes}
+
+
+def _save(conn, key, b):
+    conn.execute("INSERT OR REPLACE INTO breakers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                 (key, b["state"], b["failures"], b["opened_at"], b["cooldown"],
+                  b["probe_until"], json.dumps(b["outcomes"])))
+
+
+def _transaction(fn):
+    """在一个写事务内执行 fn(conn)；数据库不可用时记录警告并返回 None"""
+    try:
+        conn = _connect()
+    except sqlite3.Error as e:
+        logger.warning("circuit breaker unavailable: %s", e)
+        return None
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    except sqlite3.Error as e:
+        logger.warning("circuit breaker error: %s", e)
+        return None
+    finally:
+        conn.close()
+
+
+# ==================== 放行 / 记录 ====================
+
+def admit(kind, name, config=None, lease=None):
+    """是否放行一次调用：返回 0 放行；熔断中返回距下次探测的大致秒数"""
+    if not enabled(config):
+        return 0
+    key = f"{kind}:{name}"
+
+    def take(conn):
+        b = _load(conn, key)
+        if b is None or b["state"] == "closed":
+            return 0
+        now = time.time()
+        reopen_at = b["opened_at"] + b["cooldown"]
+        if now < reopen_at:
+            return reopen_at - now
+        if b["state"] == "half_open" and now < b["probe_until"]:
+            return b["probe_until"] - now  # 其他调用正在探测
+        b["state"] = "half_open"
+        b["probe_until"] = now + (lease or DEFAULT_LEASE)
+        _save(conn, key, b)
+        logger.info("circuit %s half-open, probing", key)
+        return 0
+
+    return _transaction(take) or 0
+
+
+def record(kind, name, ok, latency=None, config=None):
+    """记录一次调用的结果：ok 为 True / False；None 表示无结果（如取消），只释放探测租期"""
+    if not enabled(config):
+        return
+    key = f"{kind}:{name}"
+    threshold = _setting(config, "LLM_BREAKER_FAILURES", DEFAULT_FAILURES)
+    base_cooldown = _setting(config, "LLM_BREAKER_COOLDOWN", DEFAULT_COOLDOWN)
+    slow = _setting(config, "LLM_BREAKER_SLOW_SECONDS", 0.0)
+
+    def update(conn):
+        now = time.time()
+        b = _load(conn, key) or {"state": "closed", "failures": 0, "opened_at": 0.0,
+                                 "cooldown": base_cooldown, "probe_until": 0.0,
+                                 "outcomes": []}
+        if ok is None:
+            if b["state"] == "half_open":
+                b["probe_until"] = 0.0
+                _save(conn, key, b)
+            return
+        healthy = ok and not (slow and latency is not None and latency > slow)
+        b["outcomes"] = [o for o in b["outcomes"] if now - o[0] <= WINDOW_SECONDS]
+        b["outcomes"].append([round(now, 3), 1 if healthy else 0,
+                              round(latency, 3) if latency is not None else None])
+        del b["outcomes"][:-WINDOW_SIZE]
+
+        if ok:
+            b["failures"] = 0
+            if b["state"] != "closed":
+                logger.info("circuit %s closed", key)
+                b.update(state="closed", cooldown=base_cooldown, probe_until=0.0,
+                         outcomes=b["outcomes"][-1:])
+        else:
+            b["failures"] += 1
+            if b["state"] == "half_open":
+                b.update(state="open", opened_at=now, probe_until=0.0,
+                         cooldown=min(max(b["cooldown"], base_cooldown) * 2, MAX_COOLDOWN))
+                logger.warning("circuit %s probe failed, open for %.0fs", key, b["cooldown"])
+        if b["state"] == "closed" and _should_open(b, threshold):
+            b.update(state="open", opened_at=now, cooldown=base_cooldown, probe_until=0.0)
+            logger.warning("circuit %s open for %.0fs after %d consecutive failures",
+                           key, b["cooldown"], b["failures"])
+        _save(conn, key, b)
+
+    _transaction(update)
+
+
+def _should_open(b, threshold):
+    if threshold and b["failures"] >= threshold:
+        return True
+    outcomes = b["outcomes"]
+    if len(outcomes) < MIN_CALLS:
+        return False
+    failed = sum(1 for o in outcomes if not o[1])
+    return failed / len(outcomes) >= FAILURE_RATIO
+
+
+# ==================== 查询 ====================
+
+def states():
+    """各断路器的状态、连续失败数、窗口内失败率、平均延迟和距下次探测的秒数"""
+    try:
+        conn = _connect()
+    except sqlite3.Error as e:
+        logger.warning("circuit breaker unavailable: %s", e)
+        return []
+    try:
+        keys = [row[0] for row in conn.execute("SELECT key FROM breakers ORDER BY key")]
+        breakers = [(key, _load(conn, key)) for key in keys]
+    except sqlite3.Error as e:
+        logger.warning("circuit breaker error: %s", e)
+        return []
+    finally:
+        conn.close()
+
+    now = time.time()
+    result = []
+    for key, b in breakers:
+        outcomes = [o for o in b["outcomes"] if now - o[0] <= WINDOW_SECONDS]
+        latencies = [o[2] for o in outcomes if o[2] is not None]
+        retry_in = max(0.0, b["opened_at"] + b["cooldown"] - now) \
+            if b["state"] == "open" else 0.0
+        result.append({
+            "key": key,
+            "state": b["state"],
+            "consecutive_failures": b["failures"],
+            "calls": len(outcomes),
+            "error_rate": round(sum(1 for o in outcomes if not o[1]) / len(outcomes), 3)
+            if outcomes else 0.0,
+            "avg_latency_ms": round(sum(latencies) / len(latencies) * 1000)
+            if latencies else 0,
+            "retry_in": round(retry_in, 1),
+        })
+    return result
+
+
+def reset(key=None):
+    """清除断路器状态（key 为空时全部清除），返回清除条数"""
+    def clear(conn):
+        if key:
+            return conn.execute("DELETE FROM breakers WHERE key = ?", (key,)).rowcount
+        return conn.execute("DELETE FROM breakers").rowcount
+
+    return _transaction(clear) or 0
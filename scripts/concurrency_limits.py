@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+按服务商限制并发
+
+batch_generate 并发执行多个生成任务时，同一 LLM / 搜索服务商的同时调用数
+受限（避免触发限流）。限额作用域绑定在 contextvar 上：
+
+    limits = ProviderLimits(llm={"deepseek": 2}, search=3)
+    ctx_token = bind_limits(limits)
+    ...
+    with provider_slot("llm", "deepseek"):
+        requests.post(...)
+
+不在限额作用域内（单篇生成）时 provider_slot 为空操作。
+"""
+
+import contextlib
+import contextvars
+import threading
+
+from cancellation import current_token
+from ink_trace import span
+
+# 未单独配置的服务商默认并发数
+DEFAULT_LIMITS = {"llm": 2, "search": 3}
+
+# 等待名额时检查取消的间隔（秒）
+_POLL_SECONDS = 0.5
+
+_current_limits = contextvars.ContextVar("ink_provider_limits", default=None)
+
+
+class ProviderLimits:
+    """一组按 (类别, 服务商) 划分的信号量。
+
+    每个类别的配置可以是 int（所有服务商同一限额）或 {服务商: 限额} 字典，
+    字典中可用 "*" 指定其余服务商的限额。
+    """
+
+    def __init__(self, llm=None, search=None):
+        self._config = {"llm": llm, "search": search}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def limit_for(self, kind, name):
+        conf = self._config.get(kind)
+        default = DEFAULT_LIMITS.get(kind, 1)
+        if isinstance(conf, dict):
+            value = conf.get(name, conf.get("*", default))
+        elif conf is not None:
+            value = conf
+        else:
+            value = default
+        try:
+            return max(1, int(value))
+        except (TypeError, ValueError):
+            return default
+
+    def semaphore(self, kind, name):
+        key = (kind, name)
+        with self._lock:
+            sem = self._semaphores.get(key)
+            if sem is None:
+                sem = threading.BoundedSemaphore(self.limit_for(kind, name))
+                self._semaphores[key] = sem
+            return sem
+
+    def describe(self):
+        """已用到的限额，用于结果汇总"""
+        with self._lock:
+            keys = list(self._semaphores)
+        return {f"{kind}:{name}": self.limit_for(kind, name) for kind, name in keys}
+
+
+def bind_limits(limits):
+    """绑定限额到当前上下文，返回用于 unbind_limits 的 contextvars.Token"""
+    return _current_limits.set(limits)
+
+
+def unbind_limits(ctx_token):
+    _current_limits.reset(ctx_token)
+
+
+@contextlib.contextmanager
+def provider_slot(kind, name):
+    """占用一个服务商并发名额；等待期间可被取消，等待时间记录为 span"""
+    limits = _current_limits.get()
+    if limits is None:
+        yield
+        return
+    sem = limits.semaphore(kind, name)
+    if not sem.acquire(blocking=False):
+        token = current_token()
+        with span(f"wait.{kind}", cat="wait", provider=name):
+            while not sem.acquire(timeout=_POLL_SECONDS):
+                token.check()
+    try:
+        yield
+    finally:
+        sem.release()
@@ -41,6 +41,16 @@ if PYLIB_DIR.exists():
 CONFIG_FILE = PROJECT_ROOT / "config.env"
 
 from ink_env import INK_HOME, get_cjk_font_paths
+from ink_trace import traced
+
+# LLM 缓存有效期（需开启 LLM_CACHE，见 llm_cache）：日报 prompt 按日期和变体确定，
+# 专题调研依赖当天搜索结果，时效更短
+DAILY_CACHE_TTL = 12 * 3600
+TOPIC_CACHE_TTL = 6 * 3600
+FILE_ANALYSIS_CACHE_TTL = 7 * 86400
+
+# "以下是搜索到的最新资料" 等包裹搜索上下文的文字所占 token（预算余量）
+SEARCH_WRAPPER_TOKENS = 50
 
 # 提示词：优先使用用户自定义目录，回退到内置默认
 # Legacy fallback: ~/Ink/prompts (pre-cross-platform path)
@@ -251,11 +261,14 @@ def make_timestamp():
 # ============================================================
 
 
-def generate_article(topic=None, config=None, custom_prompt=None, file_contents=None, layout_style=""):
+def generate_article(topic=None, config=None, custom_prompt=None, file_contents=None, layout_style="",
+                     token=None, emit_fn=None):
     """调用 LLM 生成文章。topic 指定时走深度调研，否则走日报模式。
     custom_prompt: 模板自定义提示词，包含 {{TOPIC}} 占位符，覆盖默认提示词。
     file_contents: 用户上传的文件文本内容，单独传递避免污染 topic。
     layout_style: 排版样式 (modular/chapter/card/narrative/custom)。
+    token: CancelToken，透传给搜索和 LLM 调用，超时从请求剩余预算推导。
+    emit_fn: 传入时 LLM 以流式方式调用，生成过程中输出 progress 事件。
     """
     if config is None:
         config = {}
@@ -265,31 +278,44 @@ def generate_article(topic=None, config=None, custom_prompt=None, file_contents=
         return _generate_topic_research(topic, today, config,
                                         custom_prompt=custom_prompt,
                                         file_contents=file_contents,
-                                        layout_style=layout_style)
+                                        layout_style=layout_style,
+                                        token=token, emit_fn=emit_fn)
     else:
         return _generate_daily_news(today, config, custom_prompt=custom_prompt,
-                                    layout_style=layout_style)
+                                    layout_style=layout_style, token=token,
+                                    emit_fn=emit_fn)
 
 
-def _generate_topic_research(topic, today, config, custom_prompt=None, file_contents=None, layout_style=""):
+def _generate_topic_research(topic, today, config, custom_prompt=None, file_contents=None, layout_style="",
+                             token=None, emit_fn=None):
     """深度调研模式：围绕指定 topic 搜索官方资料做深度分析"""
-    from llm_adapter import generate, LLMError
+    from llm_adapter import LLMError
     from search_adapter import search_and_fetch
-    from agent_prompts import get_layout_instruction, HTML_QUALITY_RULES
+    from agent_prompts import (
+        get_layout_instruction, HTML_QUALITY_RULES, defer_topic, task_section,
+    )
+    from prompt_budget import Section, estimate_tokens, pack
+    import model_router
+    import outline_generation
 
     if custom_prompt:
-        # 使用模板自定义提示词，替换 {{TOPIC}} 占位符
-        prompt = f"今天是 {today}。\n\n" + custom_prompt.replace("{{TOPIC}}", topic)
+        # 使用模板自定义提示词
+        prompt_template = custom_prompt
     else:
         with open(TOPIC_PROMPT_FILE, "r", encoding="utf-8") as f:
             prompt_template = f.read()
-        prompt = f"今天是 {today}。\n\n" + prompt_template.replace("{{TOPIC}}", topic)
 
-    # 注入排版样式指令和 HTML 质量规则
+    # 固定部分（模板、排版样式指令、HTML 质量规则）在前，构成可被服务商缓存的前缀；
+    # 日期、主题和资料在后
+    prompt = defer_topic(prompt_template)
     layout_inst = get_layout_instruction(layout_style)
     if layout_inst:
         prompt += "\n" + layout_inst
     prompt += "\n" + HTML_QUALITY_RULES
+    prompt += task_section(today, topic)
+
+    # 上传数据 / 搜索资料按模型上下文窗口装填（research 梯队中最小的窗口），指令部分保持完整
+    provider, budget = model_router.input_budget("research", config)
 
     # 有上传文件时：跳过联网搜索，将数据附加到 prompt 末尾
     has_file_data = bool(file_contents and file_contents.strip())
@@ -302,14 +328,18 @@ def _generate_topic_research(topic, today, config, custom_prompt=None, file_cont
                 "以下是用户上传的原始数据，请务必基于这些数据进行深入分析，"
                 "引用具体数字和内容，不要泛泛描述分析方法。"
             )
-        prompt += (
+        data_header = (
             f"\n\n{'='*60}\n"
             f"{prefix}\n"
             f"{'='*60}\n\n"
-            f"{file_contents}"
         )
+        parts = pack([Section("instructions", prompt + data_header, required=True),
+                      Section("data", file_contents)], budget, provider)
+        if len(parts["data"]) < len(file_contents):
+            print(f"[提示] 上传数据超出模型上下文，已截取前 {len(parts['data'])} 字符"
+                  f"（原文 {len(file_contents)} 字符）")
+        prompt += data_header + parts["data"]
 
-    provider = config.get("LLM_PROVIDER", "claude").lower()
     short_topic = topic[:80] + "..." if len(topic) > 80 else topic
     if has_file_data:
         print(f"[1/4] 正在调用 AI 分析上传数据「{short_topic}」...")
@@ -319,19 +349,37 @@ def _generate_topic_research(topic, today, config, custom_prompt=None, file_cont
         print(f"      模式: 深度调研（搜索官方文档和英文资料）")
     print(f"      提供商: {provider}")
 
+    # 分段并行模式：先大纲后并发撰写各 PART（翻译需保持原文顺序，不适用）
+    parallel = outline_generation.enabled(config) and not (
+        custom_prompt and "翻译专家" in custom_prompt)
+    if parallel:
+        print("      分段并行: 先生成大纲，再并发撰写各部分")
+
     try:
         if has_file_data:
             # 数据分析模式：不需要联网搜索，直接调用 LLM
-            output = generate(prompt, config, timeout=600)
-        elif provider == "claude":
-            output = generate(prompt, config, timeout=1200, need_search=True)
+            full_prompt, timeout, cache_ttl = prompt, 600, FILE_ANALYSIS_CACHE_TTL
+        elif model_router.builtin_search("research", config):
+            full_prompt, timeout, cache_ttl = prompt, 1200, TOPIC_CACHE_TTL
         else:
             context = search_and_fetch(
                 [f"{topic} 最新进展 2026", f"{topic} official announcement"],
-                config,
+                config, token=token,
+                max_tokens=budget - estimate_tokens(prompt, provider) - SEARCH_WRAPPER_TOKENS,
             )
-            full_prompt = f"以下是搜索到的最新资料：\n\n{context}\n\n---\n\n{prompt}"
-            output = generate(full_prompt, config, timeout=600)
+            full_prompt = _append_search_context(prompt, context)
+            timeout, cache_ttl = 600, TOPIC_CACHE_TTL
+        if parallel:
+            # 各部分共享同一前缀（含搜索资料）；大纲不可用时回退到单次生成
+            html_content = outline_generation.generate(
+                full_prompt, config, timeout=timeout, need_search=True, token=token,
+                cache_ttl=cache_ttl, emit_fn=emit_fn)
+            if html_content:
+                return html_content
+        output = model_router.generate(
+            "research", full_prompt, config, validate=model_router.has_section,
+            timeout=timeout, need_search=True, token=token, cache_ttl=cache_ttl,
+            emit_fn=emit_fn)
     except LLMError as e:
         print(f"[错误] {e}")
         sys.exit(1)
@@ -345,10 +393,13 @@ def _generate_topic_research(topic, today, config, custom_prompt=None, file_cont
     return html_content
 
 
-def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
+def _generate_daily_news(today, config, custom_prompt=None, layout_style="", token=None,
+                         emit_fn=None):
     """日报模式：搜索多家公司最新动态生成日报"""
-    from llm_adapter import generate, LLMError
+    from llm_adapter import LLMError
     from search_adapter import search_and_fetch
+    from prompt_budget import estimate_tokens
+    import model_router
 
     # 获取当天的内容变化组合
     variation = pick_daily_variation(today)
@@ -358,18 +409,20 @@ def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
     companies = list(variation["companies"])
     companies_str = "、".join(companies)
 
-    from agent_prompts import get_layout_instruction, HTML_QUALITY_RULES
+    from agent_prompts import (
+        get_layout_instruction, HTML_QUALITY_RULES, defer_topic, task_section,
+    )
 
     if custom_prompt:
         # 使用模板自定义提示词
-        prompt = f"今天是 {today}。\n\n" + custom_prompt.replace("{{TOPIC}}", effective_topic or "AI")
+        prompt_template = defer_topic(custom_prompt)
+        task = task_section(today, effective_topic or "AI")
     else:
         with open(PROMPT_FILE, "r", encoding="utf-8") as f:
             prompt_template = f.read()
 
         # 构建变化部分的 prompt
         variation_parts = []
-        variation_parts.append(f"今天是 {today}。\n")
 
         if effective_topic:
             variation_parts.append(f"本期聚焦方向：「{effective_topic}」")
@@ -381,17 +434,18 @@ def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
         variation_parts.append(f"本期关注的公司/团队：{companies_str}")
         variation_parts.append(f"写作视角：{variation['angle']}")
         variation_parts.append(f"文章体裁：{variation['structure']}")
-        variation_parts.append("")  # 空行分隔
-
-        prompt = "\n".join(variation_parts) + "\n" + prompt_template
+        task = task_section(today, extra_lines=variation_parts)
 
-    # 注入排版样式指令和 HTML 质量规则
+    # 固定部分（模板、排版样式指令、HTML 质量规则）在前，构成可被服务商缓存的前缀；
+    # 日期和每日变化的方向、公司、视角、体裁在后
+    prompt = prompt_template
     layout_inst = get_layout_instruction(layout_style)
     if layout_inst:
         prompt += "\n" + layout_inst
     prompt += "\n" + HTML_QUALITY_RULES
+    prompt += task
 
-    provider = config.get("LLM_PROVIDER", "claude").lower()
+    provider, budget = model_router.input_budget("research", config)
     topic_label = f"（方向: {effective_topic}）" if effective_topic else ""
     print(f"[1/4] 正在调用 AI 生成 {today} AI 日报{topic_label}...")
     print(f"      关注公司: {companies_str}")
@@ -401,8 +455,12 @@ def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
     print("      (这一步需要联网搜索，请耐心等待)")
 
     try:
-        if provider == "claude":
-            output = generate(prompt, config, timeout=600, need_search=True)
+        # 梯队中有不能自行搜索的模型时先搜索，升级后的模型同样有资料可用
+        if model_router.builtin_search("research", config):
+            output = model_router.generate(
+                "research", prompt, config, validate=model_router.has_section,
+                timeout=600, need_search=True, token=token, cache_ttl=DAILY_CACHE_TTL,
+                emit_fn=emit_fn)
         else:
             # 构造搜索查询：用公司名和话题
             queries = []
@@ -410,9 +468,13 @@ def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
                 queries.append(f"{company} AI latest news 2026")
             if effective_topic:
                 queries.append(f"{effective_topic} 最新进展 2026")
-            context = search_and_fetch(queries, config)
-            full_prompt = f"以下是搜索到的最新资料：\n\n{context}\n\n---\n\n{prompt}"
-            output = generate(full_prompt, config, timeout=600)
+            context = search_and_fetch(
+                queries, config, token=token,
+                max_tokens=budget - estimate_tokens(prompt, provider) - SEARCH_WRAPPER_TOKENS)
+            full_prompt = _append_search_context(prompt, context)
+            output = model_router.generate(
+                "research", full_prompt, config, validate=model_router.has_section,
+                timeout=600, token=token, cache_ttl=DAILY_CACHE_TTL, emit_fn=emit_fn)
     except LLMError as e:
         print(f"[错误] {e}")
         sys.exit(1)
@@ -425,6 +487,12 @@ def _generate_daily_news(today, config, custom_prompt=None, layout_style=""):
     return html_content
 
 
+def _append_search_context(prompt, context):
+    """搜索资料放在 prompt 最后，不打断前面可缓存的固定前缀"""
+    return (f"{prompt}\n\n---\n\n以下是搜索到的最新资料：\n\n{context}\n\n---\n\n"
+            "请基于以上资料，按前述要求完成本次任务。")
+
+
 def extract_html(text):
     """从 Claude 输出中提取 HTML section 内容"""
     match = re.search(r"(<section[\s\S]*</section>)\s*$", text)
@@ -981,6 +1049,7 @@ def _pick_cover_theme(color_style="random", rng=None):
     return rng.choice(pool)
 
 
+@traced("cover.render", cat="cover")
 def generate_cover_image(timestamp, title, topic, output_dir, cover_theme=None,
                          color_style="random", pattern_style="random",
                          show_title=True, subtitle="Ink", cover_title=None):
@@ -1108,7 +1177,7 @@ def generate_cover_image(timestamp, title, topic, output_dir, cover_theme=None,
 
 def get_access_token(app_id, app_secret):
     """获取微信 access_token"""
-    import requests
+    import http_session
     import logging
     _logger = logging.getLogger("ink")
 
@@ -1118,7 +1187,7 @@ def get_access_token(app_id, app_secret):
         "appid": app_id,
         "secret": app_secret,
     }
-    resp = requests.get(url, params=params, timeout=10)
+    resp = http_session.get(url, params=params, timeout=10)
     data = resp.json()
 
     if "access_token" not in data:
@@ -1129,9 +1198,10 @@ def get_access_token(app_id, app_secret):
     return data["access_token"]
 
 
+@traced("wechat.upload_cover", cat="upload")
 def upload_cover_image(access_token, image_path):
     """上传封面图到微信素材库，返回 media_id"""
-    import requests
+    import http_session
     import logging
     _logger = logging.getLogger("ink")
 
@@ -1141,7 +1211,7 @@ def upload_cover_image(access_token, image_path):
     url = f"https://api.weixin.qq.com/cgi-bin/material/add_material?access_token={access_token}&type=image"
     with open(image_path, "rb") as f:
         files = {"media": f}
-        resp = requests.post(url, files=files, timeout=30)
+        resp = http_session.post(url, files=files, timeout=30)
     data = resp.json()
 
     if "media_id" not in data:
@@ -1152,16 +1222,17 @@ def upload_cover_image(access_token, image_path):
     return data["media_id"]
 
 
+@traced("wechat.upload_image", cat="upload")
 def upload_article_image(access_token, image_path):
     """上传文章内图片到微信，返回可在文章中使用的 URL"""
-    import requests
+    import http_session
     import logging
     _logger = logging.getLogger("ink")
 
     url = f"https://api.weixin.qq.com/cgi-bin/media/uploadimg?access_token={access_token}"
     with open(image_path, "rb") as f:
         files = {"media": f}
-        resp = requests.post(url, files=files, timeout=30)
+        resp = http_session.post(url, files=files, timeout=30)
     data = resp.json()
 
     if "url" not in data:
@@ -1213,9 +1284,10 @@ def append_footer(html_content, qrcode_url=None):
     return html_content
 
 
+@traced("wechat.create_draft", cat="upload")
 def create_draft(access_token, title, html_content, author, thumb_media_id=None):
     """创建微信公众号草稿"""
-    import requests
+    import http_session
     import json as json_mod
     import logging
     _logger = logging.getLogger("ink")
@@ -1254,7 +1326,7 @@ def create_draft(access_token, title, html_content, author, thumb_media_id=None)
     payload = {"articles": [article]}
 
     body = json_mod.dumps(payload, ensure_ascii=False).encode("utf-8")
-    resp = requests.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=30)
+    resp = http_session.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=30)
     data = resp.json()
 
     # 脱敏日志：不记录完整响应（可能含 token 信息）
@@ -1276,12 +1348,12 @@ def create_draft(access_token, title, html_content, author, thumb_media_id=None)
 
 def publish_draft(access_token, media_id):
     """发布草稿"""
-    import requests
+    import http_session
 
     url = f"https://api.weixin.qq.com/cgi-bin/freepublish/submit?access_token={access_token}"
     payload = {"media_id": media_id}
 
-    resp = requests.post(url, json=payload, timeout=30)
+    resp = http_session.post(url, json=payload, timeout=30)
     data = resp.json()
 
     if data.get("errcode", 0) != 0:
@@ -1301,14 +1373,14 @@ INK_BASE_URL = "https://ink.starapp.net"
 
 def ink_upload_cover(api_key, image_path):
     """上传封面图到 Ink 平台 OSS"""
-    import requests
+    import http_session
 
     url = f"{INK_BASE_URL}/api/open/upload"
     headers = {"Authorization": f"Bearer {api_key}"}
 
     with open(image_path, "rb") as f:
         files = {"file": (os.path.basename(image_path), f, "image/png")}
-        resp = requests.post(url, headers=headers, files=files, timeout=30)
+        resp = http_session.post(url, headers=headers, files=files, timeout=30)
 
     if resp.status_code != 200:
         print(f"      [Ink] 封面上传失败: HTTP {resp.status_code} {resp.text[:200]}")
@@ -1379,7 +1451,7 @@ def _extract_summary(html, max_len=480):
 def ink_create_article(api_key, title, html_content, author, cover_key=None,
                        summary=None, markdown_content=None, category="AI"):
     """在 Ink 平台创建文章"""
-    import requests
+    import http_session
 
     url = f"{INK_BASE_URL}/api/open/articles"
     headers = {
@@ -1402,7 +1474,7 @@ def ink_create_article(api_key, title, html_content, author, cover_key=None,
     if markdown_content:
         payload["content"] = markdown_content
 
-    resp = requests.post(url, headers=headers, json=payload, timeout=60)
+    resp = http_session.post(url, headers=headers, json=payload, timeout=60)
 
     if resp.status_code == 201:
         data = resp.json()
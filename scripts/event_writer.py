@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+合并限流的事件输出
+
+翻译、Agent 循环会在短时间内输出大量同 stage 的 progress 事件，Tauri 侧逐条
+转发给 webview 并触发重渲染。EventWriter 按 (request_id, stage, job) 合并
+（job 为 batch_generate 中子任务的序号，各子任务的进度互不覆盖）：
+
+- 窗口期内同一 stage 的 progress 只保留最新一条，窗口结束时由后台线程写出
+- progress 以外的事件（result / error / done 等）从不合并、从不丢弃，
+  写出前先冲刷同一请求的待发事件，保证顺序
+- 被合并掉的事件数按请求统计，附加到 result / done 事件的 suppressed_events 字段
+
+窗口由环境变量 INK_EVENT_COALESCE_MS 配置（默认 250，0 表示不合并）。
+"""
+
+import json
+import os
+import threading
+import time
+
+DEFAULT_WINDOW_MS = 250
+
+
+def window_from_env():
+    """读取合并窗口（秒）"""
+    try:
+        ms = float(os.environ.get("INK_EVENT_COALESCE_MS", DEFAULT_WINDOW_MS))
+    except ValueError:
+        ms = DEFAULT_WINDOW_MS
+    return max(0.0, ms) / 1000
+
+
+class EventWriter:
+    """线程安全的 JSON Lines 事件输出，合并同 stage 的高频 progress 事件"""
+
+    def __init__(self, stream, window=None):
+        self._stream = stream
+        self.window = window_from_env() if window is None else window
+        self._cond = threading.Condition()
+        self._last_sent = {}   # (request_id, stage, job) → 上次写出时间
+        self._pending = {}     # (request_id, stage, job) → (event, 到期时间)
+        self._suppressed = {}  # request_id → 被合并掉的事件数
+        self.total_suppressed = 0
+        self._thread = None
+        self._closed = False
+
+    def write(self, event):
+        """写出事件；窗口期内的 progress 事件暂存，等待合并"""
+        rid = event.get("request_id")
+        etype = event.get("type")
+        with self._cond:
+            if etype == "progress" and self.window > 0 and not self._closed:
+                key = (rid, event.get("stage", ""), event.get("job"))
+                if key in self._pending:
+                    # 替换尚未写出的旧事件
+                    self._pending[key] = (event, self._pending[key][1])
+                    self._count_suppressed(rid)
+                    return
+                now = time.monotonic()
+                last = self._last_sent.get(key)
+                if last is not None and now - last < self.window:
+                    self._pending[key] = (event, last + self.window)
+                    self._ensure_flusher()
+                    self._cond.notify()
+                    return
+                # 同一请求其他 stage 的待发事件先写出，保持先后顺序
+                self._flush_locked(lambda k: k[0] == rid and k != key)
+                self._last_sent[key] = now
+                self._write_locked(event)
+                return
+
+            self._flush_locked(lambda k: k[0] == rid)
+            if etype == "done":
+                count = self._suppressed.pop(rid, 0)
+                for key in [k for k in self._last_sent if k[0] == rid]:
+                    del self._last_sent[key]
+            elif etype == "result":
+                count = self._suppressed.get(rid, 0)
+            else:
+                count = 0
+            if count:
+                event = {**event, "suppressed_events": count}
+            self._write_locked(event)
+
+    def suppressed(self, request_id=None):
+        """指定请求（或全部请求）被合并掉的事件数"""
+        with self._cond:
+            if request_id is None:
+                return self.total_suppressed
+            return self._suppressed.get(request_id, 0)
+
+    def flush(self):
+        """立即写出所有待发事件"""
+        with self._cond:
+            self._flush_locked(lambda k: True)
+
+    def close(self):
+        """写出待发事件并停止后台线程"""
+        with self._cond:
+            self._flush_locked(lambda k: True)
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+
+    # ---- 内部方法（调用方持有 self._cond） ----
+
+    def _count_suppressed(self, rid):
+        self._suppressed[rid] = self._suppressed.get(rid, 0) + 1
+        self.total_suppressed += 1
+
+    def _write_locked(self, event):
+        self._stream.write(json.dumps(event, ensure_ascii=False) + "\n")
+        self._stream.flush()
+
+    def _flush_locked(self, match):
+        keys = [k for k in self._pending if match(k)]
+        if not keys:
+            return
+        now = time.monotonic()
+        for key in keys:
+            event, _ = self._pending.pop(key)
+            self._last_sent[key] = now
+            self._write_locked(event)
+
+    def _ensure_flusher(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._flush_loop,
+                                            name="ink-events", daemon=True)
+            self._thread.start()
+
+    def _flush_loop(self):
+        """后台线程：窗口到期后写出待发事件"""
+        with self._cond:
+            while not self._closed:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                now = time.monotonic()
+                due = min(d for _, d in self._pending.values())
+                if due > now:
+                    self._cond.wait(due - now)
+                    continue
+                self._flush_locked(lambda k: self._pending[k][1] <= now)
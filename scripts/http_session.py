@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+进程内共享的 HTTP 会话
+
+各适配层（LLM、搜索、图片、微信、OSS 以外的 HTTP 调用）都通过这里发请求，
+而不是直接调用 requests.get/post：
+
+    import http_session
+    resp = http_session.post(endpoint, json=payload, timeout=timeout)
+
+- 一个进程只有一个 requests.Session，urllib3 按 host 维护 keep-alive 连接池，
+  同一 LLM 端点的多轮调用（Agent 循环）、常驻模式下的多个请求复用 TCP/TLS 连接
+- 连接池大小：缓存的 host 数 INK_HTTP_POOL_HOSTS（默认 16），每个 host 的连接数
+  INK_HTTP_POOL_SIZE（默认 8，覆盖批量生成和阶段图的并发）
+- 统一 User-Agent；调用方传入的 headers 优先（如抓取网页时的浏览器 UA）
+- 传输层只重试连接失败和幂等请求（GET/HEAD）的 502/503/504；POST 不在这里重试，
+  避免重复提交 LLM 调用或微信草稿
+- 不保存 cookie：会话跨请求、跨线程共享，各接口都用 token 鉴权
+
+Session 在首次使用时创建，requests 只在那时导入，不影响轻量命令的冷启动。
+"""
+
+import os
+import threading
+
+USER_AGENT = "Ink-sidecar/1.9"
+
+DEFAULT_POOL_HOSTS = 16
+DEFAULT_POOL_SIZE = 8
+
+_session = None
+_lock = threading.Lock()
+
+
+def _env_int(name, default):
+    try:
+        return max(1, int(os.environ.get(name, default)))
+    except ValueError:
+        return default
+
+
+def _build_session():
+    import requests
+    from http.cookiejar import DefaultCookiePolicy
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    retry = Retry(
+        total=2,
+        connect=2,
+        read=0,
+        status=2,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=_env_int("INK_HTTP_POOL_HOSTS", DEFAULT_POOL_HOSTS),
+        pool_maxsize=_env_int("INK_HTTP_POOL_SIZE", DEFAULT_POOL_SIZE),
+        max_retries=retry,
+    )
+    s = requests.Session()
+    s.mount("https://", adapter)
+    s.mount("http://", adapter)
+    s.headers["User-Agent"] = USER_AGENT
+    s.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return s
+
+
+def session():
+    """返回进程内共享的 Session（首次调用时创建）"""
+    global _session
+    if _session is None:
+        with _lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def get(url, **kwargs):
+    return session().get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return session().post(url, **kwargs)
+
+
+def close():
+    """关闭所有连接池（进程退出时调用）"""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -14,6 +14,9 @@ import base64
 import io
 from urllib.parse import urlparse
 
+from cancellation import current_token
+from ink_trace import span
+
 
 def find_all_img_tags(html):
     """
@@ -35,59 +38,70 @@ def find_all_img_tags(html):
     return results
 
 
-def download_image(url, timeout=15, max_size_mb=5):
+def download_image(url, timeout=15, max_size_mb=5, token=None):
     """
     下载图片，带超时和大小限制。
+    超时取 timeout 与请求剩余预算的较小值，流式读取时在分块之间检查取消。
     返回 (图片字节, content_type) 或 (None, None)。
     """
     import requests
-
-    try:
-        # 设置 User-Agent 以避免被某些网站拒绝
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-                          "AppleWebKit/537.36 (KHTML, like Gecko) "
-                          "Chrome/120.0.0.0 Safari/537.36"
-        }
-        resp = requests.get(url, headers=headers, timeout=timeout, stream=True)
-        resp.raise_for_status()
-
-        # 检查 Content-Type
-        content_type = resp.headers.get("Content-Type", "")
-        if not content_type.startswith("image/"):
-            print(f"      [图片] 非图片类型: {content_type} - {url[:80]}")
+    import http_session
+
+    if token is None:
+        token = current_token()
+    timeout = token.timeout(timeout)
+
+    with span("image.download", cat="image", url=url[:200]) as sp:
+        try:
+            # 设置 User-Agent 以避免被某些网站拒绝
+            headers = {
+                "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+                              "AppleWebKit/537.36 (KHTML, like Gecko) "
+                              "Chrome/120.0.0.0 Safari/537.36"
+            }
+            # 流式响应在 with 结束时归还连接池（含提前 return 的分支）
+            with http_session.get(url, headers=headers, timeout=timeout,
+                                  stream=True) as resp:
+                resp.raise_for_status()
+
+                # 检查 Content-Type
+                content_type = resp.headers.get("Content-Type", "")
+                if not content_type.startswith("image/"):
+                    print(f"      [图片] 非图片类型: {content_type} - {url[:80]}")
+                    return None, None
+
+                # 检查大小（通过 Content-Length 或流式读取）
+                content_length = resp.headers.get("Content-Length")
+                if content_length and int(content_length) > max_size_mb * 1024 * 1024:
+                    print(f"      [图片] 文件过大: {int(content_length) / 1024 / 1024:.1f}MB - {url[:80]}")
+                    return None, None
+
+                # 流式读取，防止内存溢出
+                chunks = []
+                total_size = 0
+                for chunk in resp.iter_content(chunk_size=8192):
+                    token.check()
+                    total_size += len(chunk)
+                    if total_size > max_size_mb * 1024 * 1024:
+                        print(f"      [图片] 下载中超过大小限制 - {url[:80]}")
+                        return None, None
+                    chunks.append(chunk)
+
+                image_bytes = b"".join(chunks)
+                sp.add(bytes_in=len(image_bytes))
+                if len(image_bytes) < 100:
+                    print(f"      [图片] 文件过小，可能无效 - {url[:80]}")
+                    return None, None
+
+                return image_bytes, content_type
+
+        except requests.exceptions.Timeout:
+            print(f"      [图片] 下载超时 - {url[:80]}")
             return None, None
-
-        # 检查大小（通过 Content-Length 或流式读取）
-        content_length = resp.headers.get("Content-Length")
-        if content_length and int(content_length) > max_size_mb * 1024 * 1024:
-            print(f"      [图片] 文件过大: {int(content_length) / 1024 / 1024:.1f}MB - {url[:80]}")
+        except requests.exceptions.RequestException as e:
+            print(f"      [图片] 下载失败: {e} - {url[:80]}")
             return None, None
 
-        # 流式读取，防止内存溢出
-        chunks = []
-        total_size = 0
-        for chunk in resp.iter_content(chunk_size=8192):
-            total_size += len(chunk)
-            if total_size > max_size_mb * 1024 * 1024:
-                print(f"      [图片] 下载中超过大小限制 - {url[:80]}")
-                return None, None
-            chunks.append(chunk)
-
-        image_bytes = b"".join(chunks)
-        if len(image_bytes) < 100:
-            print(f"      [图片] 文件过小，可能无效 - {url[:80]}")
-            return None, None
-
-        return image_bytes, content_type
-
-    except requests.exceptions.Timeout:
-        print(f"      [图片] 下载超时 - {url[:80]}")
-        return None, None
-    except requests.exceptions.RequestException as e:
-        print(f"      [图片] 下载失败: {e} - {url[:80]}")
-        return None, None
-
 
 def image_to_base64_data_uri(image_bytes, content_type):
     """将图片字节转换为 base64 data URI"""
@@ -109,12 +123,16 @@ def image_to_base64_data_uri(image_bytes, content_type):
     return f"data:{mime};base64,{b64}"
 
 
-def upload_image_to_wechat(access_token, image_bytes, content_type):
+def upload_image_to_wechat(access_token, image_bytes, content_type, token=None):
     """
     上传图片到微信公众号素材库（用于文章内嵌图片）。
     使用 /cgi-bin/media/uploadimg 接口，返回可在文章中使用的 URL。
     """
-    import requests
+    import http_session
+
+    if token is None:
+        token = current_token()
+    timeout = token.timeout(30)
 
     url = f"https://api.weixin.qq.com/cgi-bin/media/uploadimg?access_token={access_token}"
 
@@ -132,65 +150,72 @@ def upload_image_to_wechat(access_token, image_bytes, content_type):
         "media": (f"image.{ext}", io.BytesIO(image_bytes), content_type)
     }
 
-    try:
-        resp = requests.post(url, files=files, timeout=30)
-        data = resp.json()
+    with span("image.upload", cat="image", bytes_out=len(image_bytes)):
+        try:
+            resp = http_session.post(url, files=files, timeout=timeout)
+            data = resp.json()
 
-        if "url" in data:
-            return data["url"]
-        else:
-            print(f"      [图片] 微信上传失败: {data}")
+            if "url" in data:
+                return data["url"]
+            else:
+                print(f"      [图片] 微信上传失败: {data}")
+                return None
+        except Exception as e:
+            print(f"      [图片] 微信上传异常: {e}")
             return None
-    except Exception as e:
-        print(f"      [图片] 微信上传异常: {e}")
-        return None
 
 
-def generate_ai_image(prompt, api_key):
+def generate_ai_image(prompt, api_key, token=None, config=None):
     """
     使用 OpenAI DALL-E 生成图片（兜底方案）。
     返回 (图片字节, content_type) 或 (None, None)。
-    需要配置 OPENAI_API_KEY。
+    需要配置 OPENAI_API_KEY；调用前按 rate_limiter 的 image 额度排队。
     """
-    import requests
+    import http_session
+    import rate_limiter
 
     if not api_key:
         return None, None
+    if token is None:
+        token = current_token()
+    rate_limiter.acquire("image", "dall-e", api_key, config=config, token=token)
+    timeout = token.timeout(60)
+
+    with span("image.generate", cat="image"):
+        try:
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            }
+            payload = {
+                "model": "dall-e-3",
+                "prompt": f"A clean, professional illustration for a tech article: {prompt}. "
+                          f"Style: modern, minimalist, suitable for a WeChat article.",
+                "n": 1,
+                "size": "1792x1024",
+                "response_format": "b64_json",
+            }
+
+            resp = http_session.post(
+                "https://api.openai.com/v1/images/generations",
+                headers=headers,
+                json=payload,
+                timeout=timeout,
+            )
+            data = resp.json()
+
+            if "data" in data and len(data["data"]) > 0:
+                b64_data = data["data"][0]["b64_json"]
+                image_bytes = base64.b64decode(b64_data)
+                return image_bytes, "image/png"
+            else:
+                print(f"      [图片] AI 生成失败: {data.get('error', {}).get('message', '未知错误')}")
+                return None, None
 
-    try:
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-        }
-        payload = {
-            "model": "dall-e-3",
-            "prompt": f"A clean, professional illustration for a tech article: {prompt}. "
-                      f"Style: modern, minimalist, suitable for a WeChat article.",
-            "n": 1,
-            "size": "1792x1024",
-            "response_format": "b64_json",
-        }
-
-        resp = requests.post(
-            "https://api.openai.com/v1/images/generations",
-            headers=headers,
-            json=payload,
-            timeout=60,
-        )
-        data = resp.json()
-
-        if "data" in data and len(data["data"]) > 0:
-            b64_data = data["data"][0]["b64_json"]
-            image_bytes = base64.b64decode(b64_data)
-            return image_bytes, "image/png"
-        else:
-            print(f"      [图片] AI 生成失败: {data.get('error', {}).get('message', '未知错误')}")
+        except Exception as e:
+            print(f"      [图片] AI 生成异常: {e}")
             return None, None
 
-    except Exception as e:
-        print(f"      [图片] AI 生成异常: {e}")
-        return None, None
-
 
 def remove_broken_img_tags(html, failed_tags):
     """移除下载失败的 img 标签"""
@@ -199,7 +224,7 @@ def remove_broken_img_tags(html, failed_tags):
     return html
 
 
-def process_images_in_html(html, mode="local", access_token=None, config=None):
+def process_images_in_html(html, mode="local", access_token=None, config=None, token=None):
     """
     主入口：处理 HTML 中的所有图片。
 
@@ -208,12 +233,15 @@ def process_images_in_html(html, mode="local", access_token=None, config=None):
         mode: "local"（base64 嵌入）或 "wechat"（上传微信 CDN）
         access_token: 微信 access_token（mode="wechat" 时必须）
         config: 配置字典（用于获取 OPENAI_API_KEY 等）
+        token: CancelToken，每张图片处理前检查取消/截止时间
 
     返回：
         处理后的 HTML 字符串
     """
     if config is None:
         config = {}
+    if token is None:
+        token = current_token()
 
     img_tags = find_all_img_tags(html)
     if not img_tags:
@@ -227,16 +255,18 @@ def process_images_in_html(html, mode="local", access_token=None, config=None):
     failed_tags = []
 
     for i, (full_tag, src_url, alt_text) in enumerate(img_tags, 1):
+        token.check()
         print(f"      [图片 {i}/{len(img_tags)}] {src_url[:80]}...")
 
         # 尝试下载
-        image_bytes, content_type = download_image(src_url)
+        image_bytes, content_type = download_image(src_url, token=token)
 
         # 下载失败，尝试 AI 生成
         if image_bytes is None and openai_api_key:
             desc = alt_text if alt_text else "technology illustration"
             print(f"      [图片 {i}] 下载失败，尝试 AI 生成...")
-            image_bytes, content_type = generate_ai_image(desc, openai_api_key)
+            image_bytes, content_type = generate_ai_image(desc, openai_api_key, token=token,
+                                                          config=config)
 
         # 仍然失败，记录并跳过
         if image_bytes is None:
@@ -247,7 +277,8 @@ def process_images_in_html(html, mode="local", access_token=None, config=None):
         # 根据模式处理图片
         if mode == "wechat" and access_token:
             # 上传到微信 CDN
-            wechat_url = upload_image_to_wechat(access_token, image_bytes, content_type)
+            wechat_url = upload_image_to_wechat(access_token, image_bytes, content_type,
+                                                token=token)
             if wechat_url:
                 new_tag = full_tag.replace(src_url, wechat_url)
                 html = html.replace(full_tag, new_tag)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+流水线阶段追踪（span）
+
+每次生成类请求对应一个 Trace，流水线各阶段（LLM 调用、搜索、网页抓取、
+图片下载/上传、封面渲染、格式转换、OSS 上传）用 span() 包裹：
+
+    with span("llm.generate", cat="llm", provider="deepseek") as sp:
+        ...
+        sp.add(bytes_in=len(prompt), tokens_out=usage["completion_tokens"])
+
+span 可嵌套，结束时记录耗时和计数（bytes/tokens），写入
+INK_HOME/traces/ 下的 Chrome trace-event 文件（chrome://tracing 或
+https://ui.perfetto.dev 可直接打开），汇总信息附加到最终的 result 事件。
+
+不在 Trace 上下文中时 span() 退化为空操作，模块可独立调用。
+"""
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+from ink_env import INK_HOME
+
+TRACE_DIR = os.path.join(INK_HOME, "traces")
+
+# 汇总中列出的最慢 span 数量
+SLOWEST_SPANS = 5
+
+_current_trace = contextvars.ContextVar("ink_trace", default=None)
+_current_span = contextvars.ContextVar("ink_span", default=None)
+
+
+class Span:
+    """一个计时区间，args 中的数值计数会累加到汇总"""
+
+    __slots__ = ("name", "cat", "args", "start", "end", "tid")
+
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = dict(args)
+        self.start = time.perf_counter()
+        self.end = None
+        self.tid = threading.get_ident()
+
+    def set(self, **kwargs):
+        """设置属性（覆盖）"""
+        self.args.update(kwargs)
+
+    def add(self, **counts):
+        """累加计数，如 bytes_in / bytes_out / tokens_in / tokens_out"""
+        for key, value in counts.items():
+            if value is None:
+                continue
+            self.args[key] = self.args.get(key, 0) + value
+
+    @property
+    def duration_ms(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return (end - self.start) * 1000
+
+
+class _NullSpan:
+    """不在 Trace 上下文中时使用，所有操作为空"""
+
+    def set(self, **kwargs):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """一次请求的全部 span"""
+
+    def __init__(self, name, run_id=""):
+        self.name = name
+        self.run_id = run_id
+        self.start = time.perf_counter()
+        self.started_at = time.strftime("%Y%m%d-%H%M%S")
+        self.spans = []
+        self._lock = threading.Lock()
+        # 单次模式没有 request_id，用 pid 区分同一秒内的多次运行
+        filename = f"{self.started_at}-{name}-{run_id or os.getpid()}"
+        self.path = os.path.join(TRACE_DIR, f"{filename}.json")
+
+    def record(self, sp):
+        with self._lock:
+            self.spans.append(sp)
+
+    def summary(self):
+        """按类别汇总耗时与计数，并列出最慢的 span"""
+        with self._lock:
+            spans = [s for s in self.spans if s.end is not None]
+        by_cat = {}
+        for s in spans:
+            cat = by_cat.setdefault(s.cat or s.name, {"count": 0, "ms": 0.0})
+            cat["count"] += 1
+            cat["ms"] += s.duration_ms
+            for key, value in s.args.items():
+                if key.startswith(("bytes", "tokens", "retries")) and isinstance(value, (int, float)):
+                    cat[key] = cat.get(key, 0) + value
+        for cat in by_cat.values():
+            cat["ms"] = round(cat["ms"], 1)
+        slowest = sorted(spans, key=lambda s: s.duration_ms, reverse=True)[:SLOWEST_SPANS]
+        return {
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 1),
+            "span_count": len(spans),
+            "stages": by_cat,
+            "slowest": [{"name": s.name, "ms": round(s.duration_ms, 1)} for s in slowest],
+            "trace_file": self.path,
+        }
+
+    def to_chrome_events(self):
+        """转为 Chrome trace-event 格式（"X" 完整事件，时间单位微秒）"""
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [{
+            "name": "process_name", "ph": "M", "pid": pid,
+            "args": {"name": f"ink {self.name}"},
+        }]
+        for s in spans:
+            if s.end is None:
+                continue
+            events.append({
+                "name": s.name,
+                "cat": s.cat,
+                "ph": "X",
+                "ts": round((s.start - self.start) * 1e6, 1),
+                "dur": round((s.end - s.start) * 1e6, 1),
+                "pid": pid,
+                "tid": s.tid,
+                "args": s.args,
+            })
+        return events
+
+    def write(self):
+        """写出 trace 文件，失败时返回 None（不影响主流程）"""
+        try:
+            os.makedirs(TRACE_DIR, exist_ok=True)
+            with open(self.path, "w", encoding="utf-8") as f:
+                json.dump({"traceEvents": self.to_chrome_events(),
+                           "displayTimeUnit": "ms"},
+                          f, ensure_ascii=False, default=str)
+            return self.path
+        except OSError:
+            return None
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_span():
+    """当前最内层 span；不在 Trace 上下文中时返回空 span"""
+    sp = _current_span.get()
+    return sp if sp is not None else _NULL_SPAN
+
+
+def start_trace(name, run_id=""):
+    """开始追踪，返回 (trace, 用于 end_trace 的 contextvars.Token)"""
+    trace = Trace(name, run_id)
+    return trace, _current_trace.set(trace)
+
+
+def end_trace(ctx_token):
+    """结束追踪并写出文件，返回 trace（无 trace 时返回 None）"""
+    trace = _current_trace.get()
+    _current_trace.reset(ctx_token)
+    if trace is not None:
+        trace.write()
+    return trace
+
+
+@contextlib.contextmanager
+def span(name, cat="", **args):
+    """记录一个嵌套 span；异常时在 args 中记录 error 后继续抛出"""
+    trace = _current_trace.get()
+    if trace is None:
+        yield _NULL_SPAN
+        return
+    sp = Span(name, cat, args)
+    parent = _current_span.get()
+    if parent is not None:
+        sp.args.setdefault("parent", parent.name)
+    ctx_token = _current_span.set(sp)
+    try:
+        yield sp
+    except BaseException as e:
+        sp.args["error"] = type(e).__name__
+        raise
+    finally:
+        sp.end = time.perf_counter()
+        _current_span.reset(ctx_token)
+        trace.record(sp)
+
+
+def traced(name, cat=""):
+    """装饰器：整个函数调用记录为一个 span，函数内可用 current_span() 补充计数"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name, cat=cat):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def cleanup_old_traces(max_days=7):
+    """删除 max_days 天前的 trace 文件"""
+    if not os.path.isdir(TRACE_DIR):
+        return
+    cutoff = time.time() - max_days * 86400
+    for f in os.listdir(TRACE_DIR):
+        fpath = os.path.join(TRACE_DIR, f)
+        if os.path.isfile(fpath) and os.path.getmtime(fpath) < cutoff:
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
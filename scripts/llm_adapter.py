@@ -3,184 +3,687 @@
 LLM 调用适配层
 
 统一生成接口，支持 Claude / DeepSeek / OpenAI / GLM / 豆包 / Kimi 六个后端。
-- Claude 后端：调用 claude CLI，支持一体化搜索模式
+- Claude 后端：默认调用 claude CLI，支持一体化搜索模式；CLAUDE_BACKEND=api 时
+  走 Anthropic Messages API（anthropic_client），搜索同其余后端
 - 其余后端：调用 OpenAI 兼容 HTTP API，搜索由 search_adapter 处理
 """
 
+import json
+import logging
 import subprocess
+import threading
+import time
 from pathlib import Path
 
+from cancellation import current_token
+from concurrency_limits import provider_slot
+from ink_trace import span
+import anthropic_client
+import circuit_breaker
+import http_session
+import llm_continuation
+import llm_hedge
+import prompt_budget
+import rate_limiter
+import retry_policy
+import usage_ledger
+
+logger = logging.getLogger("ink")
+
 PROJECT_ROOT = Path(__file__).parent.parent
 
+# OpenAI 兼容 API 的采样参数（同时参与 LLM 缓存键）
+DEFAULT_TEMPERATURE = 0.7
+DEFAULT_MAX_TOKENS = 8192
+
+# provider → (模型配置项, 默认模型)
+PROVIDER_MODELS = {
+    "deepseek": ("DEEPSEEK_MODEL", "deepseek-chat"),
+    "openai": ("OPENAI_MODEL", "gpt-4o"),
+    "glm": ("GLM_MODEL", "glm-4-flash"),
+    "doubao": ("DOUBAO_MODEL", "doubao-1.5-pro-32k"),
+    "kimi": ("KIMI_MODEL", "moonshot-v1-8k"),
+}
+# generate() 支持的全部 provider
+ROUTED_PROVIDERS = ("claude",) + tuple(PROVIDER_MODELS)
+
+
+def resolve_model(provider, config):
+    """返回 provider 当前配置的模型名；Claude CLI 使用其自身默认模型"""
+    if provider == "claude" and anthropic_client.use_api(config):
+        return anthropic_client.resolve_model(config)
+    if provider not in PROVIDER_MODELS:
+        return provider
+    key, default = PROVIDER_MODELS[provider]
+    return config.get(key, default)
+
+
+def has_builtin_search(config):
+    """当前后端能否自行联网搜索（Claude CLI 的 WebSearch / WebFetch）。
+
+    不能时由调用方先经 search_adapter 搜索，把结果拼进 prompt。
+    """
+    provider = config.get("LLM_PROVIDER", "claude").lower()
+    return provider == "claude" and not anthropic_client.use_api(config)
+
 
 class LLMError(Exception):
-    """LLM 调用异常的统一异常类"""
-    pass
+    """LLM 调用异常的统一异常类。
+
+    status / retry_after / retryable 供 retry_policy 判断是否重试：
+    未设置 retryable 时按 HTTP 状态码分类，没有状态码视为致命错误。
+    """
 
+    def __init__(self, message, status=None, retry_after=None, retryable=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.retryable = retryable
 
-def generate(prompt, config, timeout=600, need_search=True):
+
+def generate(prompt, config, timeout=600, need_search=True, token=None, cache_ttl=None,
+             emit_fn=None):
     """
     统一 LLM 生成入口。
 
     参数:
         prompt: 提示词文本
         config: 配置字典（从 config.env 加载）
-        timeout: 超时秒数
+        timeout: 超时秒数（上限，实际取与请求剩余预算的较小值）
         need_search: 是否需要搜索能力（仅 Claude 后端生效）
+        token: CancelToken，缺省使用当前请求的令牌
+        cache_ttl: 该调用点的缓存有效期（秒）；None 表示不缓存。
+                   还需在配置中开启 LLM_CACHE，见 llm_cache
+        emit_fn: 传入时以流式方式调用（OpenAI 兼容后端走 SSE），生成过程中
+                 输出限流的 progress 事件（已生成 token 数、tok/s）；返回值不变
+
+    与正在进行的相同调用（键同响应缓存）合并为一次，见 singleflight。
 
     返回:
-        生成的文本内容
+        生成的文本内容（输出被长度截断时已按 llm_continuation 续写拼接）
 
     异常:
-        LLMError: 超时、API 错误、空输出等
+        LLMError: 超时、API 错误、空输出等（可重试的错误已按 retry_policy 重试）
     """
     provider = config.get("LLM_PROVIDER", "claude").lower()
-
+    if token is None:
+        token = current_token()
+
+    if provider not in ROUTED_PROVIDERS:
+        raise LLMError(f"不支持的 LLM 提供商: {provider}，可选: {' / '.join(ROUTED_PROVIDERS)}")
+
+    import llm_cache
+    import singleflight
+    key = llm_cache.make_key(
+        prompt, provider, resolve_model(provider, config),
+        temperature=DEFAULT_TEMPERATURE, max_tokens=DEFAULT_MAX_TOKENS,
+        need_search=need_search if has_builtin_search(config) else False)
+    use_cache = bool(cache_ttl) and llm_cache.enabled(config)
+    if use_cache:
+        token.check()
+        with span("llm.cache", cat="cache", provider=provider) as sp:
+            cached = llm_cache.get(key)
+            sp.set(hit=cached is not None)
+        if cached is not None:
+            return cached
+
+    def produce():
+        # 从请求剩余预算推导本次调用超时，预算不足时直接抛出 DeadlineExceeded
+        call_timeout = token.timeout(timeout)
+        on_delta = StreamProgress(emit_fn) if emit_fn is not None else None
+
+        def call(name, call_token, delta_fn):
+            return _call_provider(name, prompt, config, call_timeout, need_search,
+                                  call_token, delta_fn)
+
+        providers = llm_hedge.provider_chain(provider, config)
+        cacheable = use_cache
+        if len(providers) == 1:
+            content = call(provider, token, on_delta)
+        else:
+            # 配置了备用服务商：失败时故障转移，开启 LLM_HEDGE 时对慢请求发起对冲
+            winner, content = llm_hedge.run(call, providers, config, token, on_delta)
+            if winner != provider:
+                cacheable = False  # 缓存键按主服务商计算，不存备用服务商的输出
+        if cacheable and content:
+            llm_cache.put(key, content, cache_ttl, provider=provider)
+        return content
+
+    # 并发的相同请求（与响应缓存同键）只发起一次，结果分发给所有等待者
+    return singleflight.do(("llm", key), produce, token)
+
+
+def _call_provider(provider, prompt, config, timeout, need_search, token, on_delta):
+    """调用单个服务商：占用并发名额、记录 span，瞬时错误按 retry_policy 重试；
+    输出被长度截断时按 llm_continuation 续写并拼接"""
+    # 各后端返回 (文本, finish_reason)；partial 为续写时已生成的部分
     router = {
-        "claude": lambda: _generate_via_claude(prompt, timeout, need_search),
-        "deepseek": lambda: _generate_via_deepseek(prompt, config, timeout),
-        "openai": lambda: _generate_via_openai(prompt, config, timeout),
-        "glm": lambda: _generate_via_glm(prompt, config, timeout),
-        "doubao": lambda: _generate_via_doubao(prompt, config, timeout),
-        "kimi": lambda: _generate_via_kimi(prompt, config, timeout),
+        "claude": lambda t, partial, max_tokens: (
+            _generate_via_claude_api(prompt, config, t, token, on_delta,
+                                     partial=partial, max_tokens=max_tokens)
+            if anthropic_client.use_api(config)
+            else _generate_via_claude(prompt, t, need_search, token, on_delta)),
+        "deepseek": lambda t, partial, max_tokens: _generate_via_deepseek(
+            prompt, config, t, token, on_delta, partial=partial, max_tokens=max_tokens),
+        "openai": lambda t, partial, max_tokens: _generate_via_openai(
+            prompt, config, t, token, on_delta, partial=partial, max_tokens=max_tokens),
+        "glm": lambda t, partial, max_tokens: _generate_via_glm(
+            prompt, config, t, token, on_delta, partial=partial, max_tokens=max_tokens),
+        "doubao": lambda t, partial, max_tokens: _generate_via_doubao(
+            prompt, config, t, token, on_delta, partial=partial, max_tokens=max_tokens),
+        "kimi": lambda t, partial, max_tokens: _generate_via_kimi(
+            prompt, config, t, token, on_delta, partial=partial, max_tokens=max_tokens),
     }
+    handler = router[provider]
+    api_key = _rate_limit_key(provider, config)
+    prompt_tokens = prompt_budget.estimate_tokens(prompt, provider)
+    model = resolve_model(provider, config)
+    continuations = llm_continuation.max_continuations(config)
+    ceiling = llm_continuation.output_ceiling(config)
+    # 熔断中的服务商直接失败，由 llm_hedge 换备用服务商；Claude CLI 为本地进程，不熔断
+    breaker = api_key is not None
+    if breaker:
+        wait = circuit_breaker.admit("llm", provider, config, lease=timeout)
+        if wait:
+            raise LLMError(f"{provider} 近期连续失败，已暂停调用（熔断），"
+                           f"约 {wait:.0f} 秒后重试", retryable=False)
+
+    def attempt(partial, produced, max_tokens):
+        # 重试时丢弃失败尝试已计入的流式进度，续写从已生成部分继续计数
+        if on_delta is not None and hasattr(on_delta, "reset"):
+            on_delta.reset(tokens=produced, chars=len(partial))
+        # 每次尝试都占用跨进程的 RPM / TPM 额度，额度不足时排队
+        if api_key is not None:
+            rate_limiter.acquire("llm", provider, api_key, tokens=prompt_tokens + produced,
+                                 config=config, token=token)
+        # 每次尝试（含失败的）记入用量账本
+        with usage_ledger.meter(provider, model) as m:
+            text, finish = handler(token.timeout(timeout), partial, max_tokens)
+        return text, finish, m.tokens_out or prompt_budget.estimate_tokens(text, provider)
+
+    with provider_slot("llm", provider), \
+            span("llm.generate", cat="llm", provider=provider) as sp:
+        sp.add(bytes_in=len(prompt.encode("utf-8")))
+        # 瞬时错误（429 / 5xx / 连接失败）按策略重试，每次尝试从剩余预算重新推导超时
+        start = time.monotonic()
+        try:
+            content, finish, produced = retry_policy.call_with_retry(
+                lambda: attempt("", 0, min(DEFAULT_MAX_TOKENS, ceiling)),
+                token=token, label=f"llm.{provider}")
+        except Exception as e:
+            # 只有服务商不健康的错误计为失败；400 / 401 等说明服务商正常响应
+            if breaker:
+                circuit_breaker.record("llm", provider, not retry_policy.is_retryable(e),
+                                       time.monotonic() - start, config)
+            raise
+        except BaseException:
+            if breaker:
+                circuit_breaker.record("llm", provider, None, config=config)
+            raise
+        if breaker:
+            circuit_breaker.record("llm", provider, True, time.monotonic() - start, config)
+        done = 0
+        while finish == "length":
+            max_tokens = llm_continuation.next_max_tokens(provider, model, prompt_tokens,
+                                                          produced, ceiling)
+            if done >= continuations or not max_tokens:
+                logger.warning("LLM output truncated at ~%d tokens (%s), "
+                               "continuation limit reached", produced, provider)
+                break
+            done += 1
+            logger.info("LLM output truncated at ~%d tokens (%s), continuing (%d/%d)",
+                        produced, provider, done, continuations)
+            try:
+                text, finish, tokens_out = retry_policy.call_with_retry(
+                    lambda: attempt(content, produced, max_tokens),
+                    token=token, label=f"llm.{provider}.continue")
+            except Exception as e:
+                # 续写失败时保留已生成的部分，与不续写时的结果相同
+                logger.warning("LLM continuation failed (%s): %s", provider, e)
+                break
+            content = llm_continuation.stitch(content, text, provider)
+            produced += tokens_out
+        if done:
+            sp.set(continuations=done)
+        content = content.strip()
+        sp.add(bytes_out=len(content.encode("utf-8")))
+    if api_key is not None:
+        rate_limiter.debit("llm", provider, api_key,
+                           tokens=prompt_budget.estimate_tokens(content, provider),
+                           config=config)
+    return content
 
-    handler = router.get(provider)
-    if not handler:
-        supported = " / ".join(router.keys())
-        raise LLMError(f"不支持的 LLM 提供商: {provider}，可选: {supported}")
 
-    return handler()
+def _rate_limit_key(provider, config):
+    """限流桶使用的 API Key；Claude CLI 由 CLI 自身管理额度，返回 None 表示不限流"""
+    if provider == "claude":
+        return config.get("ANTHROPIC_API_KEY", "") if anthropic_client.use_api(config) else None
+    return config.get(f"{provider.upper()}_API_KEY", "")
 
 
-def _generate_via_claude(prompt, timeout, need_search):
-    """调用 Claude CLI 生成内容"""
+def _generate_via_claude(prompt, timeout, need_search, token, on_delta=None):
+    """调用 Claude CLI 生成内容，请求取消时终止子进程；传入 on_delta 时走流式输出"""
     cmd = ["claude", "-p", prompt]
     if need_search:
         cmd.extend(["--allowedTools", "WebSearch,WebFetch"])
+    if on_delta is not None:
+        return _stream_claude(cmd, timeout, token, on_delta)
 
     try:
-        result = subprocess.run(
+        proc = subprocess.Popen(
             cmd,
-            capture_output=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
             text=True,
-            timeout=timeout,
             cwd=str(PROJECT_ROOT),
         )
-    except subprocess.TimeoutExpired:
-        raise LLMError(f"Claude CLI 执行超时（{timeout // 60}分钟）")
     except FileNotFoundError:
         raise LLMError("未找到 claude 命令，请确认 Claude Code CLI 已安装")
 
-    output = result.stdout.strip()
+    unregister = token.on_cancel(proc.kill)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.communicate()
+        raise LLMError(f"Claude CLI 执行超时（{int(timeout) // 60}分钟）")
+    finally:
+        unregister()
+    token.check()
+
+    output = stdout.strip()
 
-    if result.returncode != 0 or not output:
-        stderr = result.stderr.strip() if result.stderr else "无错误输出"
+    if proc.returncode != 0 or not output:
+        stderr = stderr.strip() if stderr else "无错误输出"
         raise LLMError(f"Claude 返回异常: {stderr}")
 
-    return output
+    # CLI 不报告截断原因，不续写
+    return output, None
 
 
-def _generate_via_openai_compatible(prompt, api_key, model, endpoint, timeout, provider_name):
-    """OpenAI 兼容 API 的通用调用方法"""
+def _generate_via_openai_compatible(prompt, api_key, model, endpoint, timeout, provider_name,
+                                    token, on_delta=None, max_tokens=DEFAULT_MAX_TOKENS,
+                                    stream_usage=False, partial=""):
+    """OpenAI 兼容 API 的通用调用方法；传入 on_delta 时走流式接口，逐段回调。
+    max_tokens 由调用方按模型输出上限收紧（prompt_budget.max_output_tokens）；
+    stream_usage 表示服务商支持 stream_options.include_usage，流式时也能拿到 usage；
+    partial 非空时为续写请求。返回 (文本, finish_reason)，文本不去除首尾空白以便拼接"""
     try:
         import requests
     except ImportError:
         raise LLMError("requests 库未安装，请执行: pip3 install requests")
 
+    messages = [{"role": "user", "content": prompt}]
+    if partial:
+        messages = llm_continuation.messages_for(messages, partial, "openai")
+
+    if on_delta is not None:
+        content, finish = _stream_openai_compatible(messages, api_key, model, endpoint,
+                                                    timeout, provider_name, token, on_delta,
+                                                    max_tokens, stream_usage)
+        if not content.strip():
+            raise LLMError(f"{provider_name} API 返回空内容")
+        return content, finish
+
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
     payload = {
         "model": model,
-        "messages": [{"role": "user", "content": prompt}],
-        "max_tokens": 8192,
-        "temperature": 0.7,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": DEFAULT_TEMPERATURE,
     }
 
     try:
-        resp = requests.post(endpoint, headers=headers, json=payload, timeout=timeout)
+        resp = http_session.post(endpoint, headers=headers, json=payload, timeout=timeout)
     except requests.exceptions.Timeout:
-        raise LLMError(f"{provider_name} API 请求超时（{timeout}秒）")
+        raise LLMError(f"{provider_name} API 请求超时（{int(timeout)}秒）", retryable=True)
     except requests.exceptions.ConnectionError:
-        raise LLMError(f"无法连接 {provider_name} API，请检查网络")
+        raise LLMError(f"无法连接 {provider_name} API，请检查网络", retryable=True)
+    # 阻塞期间被取消：丢弃结果
+    token.check()
 
     if resp.status_code != 200:
-        raise LLMError(f"{provider_name} API 返回错误: HTTP {resp.status_code} {resp.text[:300]}")
+        raise LLMError(f"{provider_name} API 返回错误: HTTP {resp.status_code} {resp.text[:300]}",
+                       status=resp.status_code,
+                       retry_after=retry_policy.response_retry_after(resp))
 
     data = resp.json()
+    usage_ledger.note(data.get("usage"))
     choices = data.get("choices", [])
     if not choices:
         raise LLMError(f"{provider_name} API 返回空结果")
 
-    content = choices[0].get("message", {}).get("content", "").strip()
-    if not content:
+    content = choices[0].get("message", {}).get("content") or ""
+    if not content.strip():
         raise LLMError(f"{provider_name} API 返回空内容")
 
-    return content
+    return content, choices[0].get("finish_reason")
+
+
+def _generate_via_claude_api(prompt, config, timeout, token, on_delta=None, partial="",
+                             max_tokens=DEFAULT_MAX_TOKENS):
+    """调用 Anthropic Messages API 生成内容（CLAUDE_BACKEND=api）"""
+    try:
+        return anthropic_client.generate(
+            prompt, config, timeout, token,
+            max_tokens=prompt_budget.max_output_tokens(
+                "claude", anthropic_client.resolve_model(config), max_tokens),
+            temperature=DEFAULT_TEMPERATURE, on_delta=on_delta, partial=partial)
+    except anthropic_client.AnthropicError as e:
+        raise LLMError(str(e), status=e.status, retry_after=e.retry_after,
+                       retryable=e.retryable)
+
+
+# ==================== 流式生成 ====================
+
+# 流式进度事件的最小间隔（秒）
+STREAM_PROGRESS_INTERVAL = 1.0
+
+
+class StreamProgress:
+    """流式增量的回调：统计 token 数和速率，限流输出 progress 事件。
+
+    SSE 每个增量块大致对应一个 token，按块计数作为近似值。
+    """
+
+    def __init__(self, emit_fn, stage="generating", interval=STREAM_PROGRESS_INTERVAL):
+        self.emit_fn = emit_fn
+        self.stage = stage
+        self.interval = interval
+        self.reset()
+
+    def reset(self, tokens=0, chars=0):
+        """每次尝试开始时重新计数，丢弃失败尝试的增量；续写时从已生成部分的计数继续"""
+        self.tokens = tokens
+        self.chars = chars
+        self._base = tokens
+        self.started = time.monotonic()
+        self._last_emit = 0.0
+
+    def __call__(self, delta, tokens=1):
+        self.tokens += tokens
+        self.chars += len(delta)
+        now = time.monotonic()
+        if now - self._last_emit < self.interval:
+            return
+        self._last_emit = now
+        elapsed = max(now - self.started, 1e-6)
+        rate = (self.tokens - self._base) / elapsed
+        self.emit_fn("progress", stage=self.stage,
+                     message=f"正在生成文章... 已生成 {self.tokens} tokens（{rate:.0f} tok/s）",
+                     tokens=self.tokens, chars=self.chars,
+                     tokens_per_sec=round(rate, 1))
+
+    def activity(self, message, **fields):
+        """工具调用等低频动态，不限流"""
+        self.emit_fn("progress", stage=self.stage, message=message, **fields)
+
+
+def _stream_openai_compatible(messages, api_key, model, endpoint, timeout, provider_name, token,
+                              on_delta, max_tokens=DEFAULT_MAX_TOKENS, stream_usage=False):
+    """以 SSE（stream: true）调用 OpenAI 兼容 API，逐段回调文本增量，
+    返回 (完整文本, finish_reason)。
+
+    timeout 是整次生成的上限；单次读取也以它为超时。请求取消时关闭响应，
+    中断阻塞中的读取。错误语义与非流式调用一致（LLMError）。
+    """
+    import requests
+
+    headers = {
+        "Authorization": f"Bearer {api_key}",
+        "Content-Type": "application/json",
+        "Accept": "text/event-stream",
+    }
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": DEFAULT_TEMPERATURE,
+        "stream": True,
+    }
+    if stream_usage:
+        # 最后一个 chunk 附带 usage（含缓存命中 token），计入用量账本
+        payload["stream_options"] = {"include_usage": True}
+    deadline = time.monotonic() + timeout
+
+    try:
+        resp = http_session.post(endpoint, headers=headers, json=payload,
+                                 timeout=timeout, stream=True)
+    except requests.exceptions.Timeout:
+        raise LLMError(f"{provider_name} API 请求超时（{int(timeout)}秒）", retryable=True)
+    except requests.exceptions.ConnectionError:
+        raise LLMError(f"无法连接 {provider_name} API，请检查网络", retryable=True)
+
+    unregister = token.on_cancel(resp.close)
+    parts = []
+    finish = None
+    try:
+        if resp.status_code != 200:
+            raise LLMError(f"{provider_name} API 返回错误: HTTP {resp.status_code} {resp.text[:300]}",
+                           status=resp.status_code,
+                           retry_after=retry_policy.response_retry_after(resp))
+
+        # chunk_size=None：收到多少处理多少，不等凑满缓冲区
+        for line in resp.iter_lines(chunk_size=None):
+            token.check()
+            if time.monotonic() > deadline:
+                raise LLMError(f"{provider_name} API 请求超时（{int(timeout)}秒）", retryable=True)
+            # 按 UTF-8 解码：text/event-stream 常不带 charset
+            line = line.decode("utf-8", errors="replace").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[5:].strip()
+            if data == "[DONE]":
+                break
+            try:
+                chunk = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            if chunk.get("error"):
+                message = chunk["error"].get("message", chunk["error"]) \
+                    if isinstance(chunk["error"], dict) else chunk["error"]
+                raise LLMError(f"{provider_name} API 返回错误: {message}")
+            usage_ledger.note(chunk.get("usage"))
+            for choice in chunk.get("choices") or []:
+                # Kimi 把 usage 放在最后一个 choice 里
+                usage_ledger.note(choice.get("usage"))
+                finish = choice.get("finish_reason") or finish
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    on_delta(delta)
+    except LLMError:
+        raise
+    except Exception as e:
+        # 取消时 resp.close() 会让阻塞中的读取抛出各种异常，优先报告取消
+        token.check()
+        if isinstance(e, requests.exceptions.Timeout):
+            raise LLMError(f"{provider_name} API 请求超时（{int(timeout)}秒）", retryable=True)
+        if isinstance(e, requests.exceptions.RequestException):
+            raise LLMError(f"{provider_name} API 连接中断: {e}", retryable=True)
+        raise
+    finally:
+        unregister()
+        resp.close()
+    token.check()
+    return "".join(parts), finish
+
+
+def _claude_tool_message(name, tool_input):
+    """把 Claude CLI 的工具调用转成进度文案"""
+    if name == "WebSearch":
+        return f"正在搜索: {tool_input.get('query', '')}"
+    if name == "WebFetch":
+        return f"正在读取网页: {tool_input.get('url', '')}"
+    return f"正在调用工具 {name}"
+
+
+def _stream_claude(cmd, timeout, token, on_delta):
+    """以 --output-format stream-json 运行 Claude CLI，逐行解析事件。
+
+    assistant 消息中的文本块交给 on_delta，WebSearch / WebFetch 等工具调用
+    作为进度动态输出；最终文本取 result 事件。超时或取消时终止子进程。
+    """
+    cmd = cmd + ["--output-format", "stream-json", "--verbose"]
+    try:
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            bufsize=1,
+            cwd=str(PROJECT_ROOT),
+        )
+    except FileNotFoundError:
+        raise LLMError("未找到 claude 命令，请确认 Claude Code CLI 已安装")
+
+    # stderr 在后台读完，避免管道写满阻塞子进程
+    stderr_parts = []
+    stderr_thread = threading.Thread(target=lambda: stderr_parts.append(proc.stderr.read()),
+                                     daemon=True)
+    stderr_thread.start()
+    timed_out = threading.Event()
+
+    def _on_timeout():
+        timed_out.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, _on_timeout)
+    timer.daemon = True
+    timer.start()
+    unregister = token.on_cancel(proc.kill)
+
+    texts = []
+    result = None
+    try:
+        for line in proc.stdout:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                event = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            etype = event.get("type")
+            if etype == "assistant":
+                message = event.get("message") or {}
+                usage = message.get("usage") or {}
+                for block in message.get("content") or []:
+                    if block.get("type") == "text" and block.get("text"):
+                        texts.append(block["text"])
+                        on_delta(block["text"], tokens=usage.get("output_tokens") or 1)
+                    elif block.get("type") == "tool_use" and hasattr(on_delta, "activity"):
+                        name = block.get("name", "")
+                        on_delta.activity(_claude_tool_message(name, block.get("input") or {}),
+                                          tool=name)
+            elif etype == "result":
+                result = event
+        proc.wait()
+    finally:
+        timer.cancel()
+        unregister()
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        stderr_thread.join(timeout=1)
+    token.check()
+
+    if timed_out.is_set():
+        raise LLMError(f"Claude CLI 执行超时（{int(timeout) // 60}分钟）")
+
+    if result is not None:
+        usage_ledger.note(result.get("usage"))
+    output = ((result or {}).get("result") or "\n".join(texts)).strip()
+    if proc.returncode != 0 or not output or (result or {}).get("is_error"):
+        stderr = "".join(stderr_parts).strip() or (result or {}).get("result") or "无错误输出"
+        raise LLMError(f"Claude 返回异常: {stderr}")
+    return output, None
+
 
+# ==================== OpenAI 兼容后端 ====================
 
-def _generate_via_deepseek(prompt, config, timeout):
+def _generate_via_deepseek(prompt, config, timeout, token, on_delta=None, partial="",
+                           max_tokens=DEFAULT_MAX_TOKENS):
     """调用 DeepSeek API 生成内容"""
     api_key = config.get("DEEPSEEK_API_KEY", "")
     if not api_key:
         raise LLMError("未配置 DEEPSEEK_API_KEY，请在 config.env 中设置")
-    model = config.get("DEEPSEEK_MODEL", "deepseek-chat")
+    model = resolve_model("deepseek", config)
     return _generate_via_openai_compatible(
         prompt, api_key, model,
         "https://api.deepseek.com/v1/chat/completions",
-        timeout, "DeepSeek",
+        timeout, "DeepSeek", token, on_delta=on_delta,
+        max_tokens=prompt_budget.max_output_tokens("deepseek", model, max_tokens),
+        partial=partial,
+        stream_usage=True,
     )
 
 
-def _generate_via_openai(prompt, config, timeout):
+def _generate_via_openai(prompt, config, timeout, token, on_delta=None, partial="",
+                         max_tokens=DEFAULT_MAX_TOKENS):
     """调用 OpenAI API 生成内容"""
     api_key = config.get("OPENAI_API_KEY", "")
     if not api_key:
         raise LLMError("未配置 OPENAI_API_KEY，请在 config.env 中设置")
-    model = config.get("OPENAI_MODEL", "gpt-4o")
+    model = resolve_model("openai", config)
     return _generate_via_openai_compatible(
         prompt, api_key, model,
         "https://api.openai.com/v1/chat/completions",
-        timeout, "OpenAI",
+        timeout, "OpenAI", token, on_delta=on_delta,
+        max_tokens=prompt_budget.max_output_tokens("openai", model, max_tokens),
+        partial=partial,
+        stream_usage=True,
     )
 
 
-def _generate_via_glm(prompt, config, timeout):
+def _generate_via_glm(prompt, config, timeout, token, on_delta=None, partial="",
+                      max_tokens=DEFAULT_MAX_TOKENS):
     """调用智谱 GLM API 生成内容"""
     api_key = config.get("GLM_API_KEY", "")
     if not api_key:
         raise LLMError("未配置 GLM_API_KEY，请在配置中设置")
-    model = config.get("GLM_MODEL", "glm-4-flash")
+    model = resolve_model("glm", config)
     return _generate_via_openai_compatible(
         prompt, api_key, model,
         "https://open.bigmodel.cn/api/paas/v4/chat/completions",
-        timeout, "智谱 GLM",
+        timeout, "智谱 GLM", token, on_delta=on_delta,
+        max_tokens=prompt_budget.max_output_tokens("glm", model, max_tokens),
+        partial=partial,
     )
 
 
-def _generate_via_doubao(prompt, config, timeout):
+def _generate_via_doubao(prompt, config, timeout, token, on_delta=None, partial="",
+                         max_tokens=DEFAULT_MAX_TOKENS):
     """调用豆包（火山引擎）API 生成内容"""
     api_key = config.get("DOUBAO_API_KEY", "")
     if not api_key:
         raise LLMError("未配置 DOUBAO_API_KEY，请在配置中设置")
-    model = config.get("DOUBAO_MODEL", "doubao-1.5-pro-32k")
+    model = resolve_model("doubao", config)
     return _generate_via_openai_compatible(
         prompt, api_key, model,
         "https://ark.cn-beijing.volces.com/api/v3/chat/completions",
-        timeout, "豆包",
+        timeout, "豆包", token, on_delta=on_delta,
+        max_tokens=prompt_budget.max_output_tokens("doubao", model, max_tokens),
+        partial=partial,
     )
 
 
-def _generate_via_kimi(prompt, config, timeout):
+def _generate_via_kimi(prompt, config, timeout, token, on_delta=None, partial="",
+                       max_tokens=DEFAULT_MAX_TOKENS):
     """调用 Kimi（月之暗面）API 生成内容"""
     api_key = config.get("KIMI_API_KEY", "")
     if not api_key:
         raise LLMError("未配置 KIMI_API_KEY，请在配置中设置")
-    model = config.get("KIMI_MODEL", "moonshot-v1-8k")
+    model = resolve_model("kimi", config)
     return _generate_via_openai_compatible(
         prompt, api_key, model,
         "https://api.moonshot.cn/v1/chat/completions",
-        timeout, "Kimi",
+        timeout, "Kimi", token, on_delta=on_delta,
+        max_tokens=prompt_budget.max_output_tokens("kimi", model, max_tokens),
+        partial=partial,
     )
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+LLM 响应磁盘缓存（按内容寻址）
+
+键 = sha256(规范化 prompt + provider + model + 采样参数)，值为一个 JSON 文件：
+INK_HOME/cache/llm/{键前 2 位}/{键}.json。
+
+- 需要显式开启：配置 LLM_CACHE=1 或环境变量 INK_LLM_CACHE=1，
+  且调用点传入 cache_ttl（秒）——每个调用点自己决定内容多久过期
+- 总大小超过上限（INK_LLM_CACHE_MB，默认 200）时按最近使用时间淘汰（LRU，
+  命中时刷新文件 mtime）
+- 进程内统计命中/未命中/写入/淘汰次数，见 stats()
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from ink_env import INK_HOME
+
+logger = logging.getLogger("ink")
+
+LLM_CACHE_DIR = os.path.join(str(INK_HOME), "cache", "llm")
+DEFAULT_MAX_MB = 200
+
+_stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+_stats_lock = threading.Lock()
+# 淘汰扫描整个目录，同一时间只允许一个线程执行
+_evict_lock = threading.Lock()
+
+
+def enabled(config):
+    """配置或环境变量开启了缓存"""
+    value = str(config.get("LLM_CACHE") or os.environ.get("INK_LLM_CACHE", "")).lower()
+    return value in ("1", "true", "yes", "on")
+
+
+def _bump(name, n=1):
+    with _stats_lock:
+        _stats[name] += n
+
+
+def normalize_prompt(prompt):
+    """统一换行、去掉行尾空白和首尾空行，避免无意义差异导致未命中"""
+    text = prompt.replace("\r\n", "\n").replace("\r", "\n")
+    text = re.sub(r"[ \t]+\n", "\n", text)
+    return text.strip()
+
+
+def make_key(prompt, provider, model, **sampling):
+    """计算缓存键；sampling 为影响输出的参数（temperature、max_tokens、need_search 等）"""
+    payload = json.dumps({
+        "prompt": normalize_prompt(prompt),
+        "provider": provider,
+        "model": model,
+        "sampling": sampling,
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _path(key):
+    return os.path.join(LLM_CACHE_DIR, key[:2], f"{key}.json")
+
+
+def get(key):
+    """读取未过期的缓存内容；未命中返回 None"""
+    path = _path(key)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        _bump("misses")
+        return None
+    if time.time() > entry.get("expires_at", 0):
+        _bump("expired")
+        _bump("misses")
+        _remove(path)
+        return None
+    try:
+        os.utime(path)  # 刷新 mtime，作为 LRU 的最近使用时间
+    except OSError:
+        pass
+    _bump("hits")
+    return entry.get("content")
+
+
+def put(key, content, ttl, **meta):
+    """写入缓存（原子替换），写入后按大小上限淘汰"""
+    path = _path(key)
+    now = time.time()
+    entry = {"content": content, "created_at": now, "expires_at": now + ttl, **meta}
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        logger.warning("LLM cache write failed: %s", e)
+        return
+    _bump("stores")
+    evict()
+
+
+def _max_bytes():
+    try:
+        return float(os.environ.get("INK_LLM_CACHE_MB", DEFAULT_MAX_MB)) * 1024 * 1024
+    except ValueError:
+        return DEFAULT_MAX_MB * 1024 * 1024
+
+
+def _entries():
+    """[(mtime, size, path)]"""
+    entries = []
+    if not os.path.isdir(LLM_CACHE_DIR):
+        return entries
+    for root, _, files in os.walk(LLM_CACHE_DIR):
+        for name in files:
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    return entries
+
+
+def evict(max_bytes=None):
+    """总大小超过上限时删除最久未使用的条目，返回删除条数"""
+    if max_bytes is None:
+        max_bytes = _max_bytes()
+    with _evict_lock:
+        entries = _entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            if _remove(path):
+                total -= size
+                removed += 1
+    if removed:
+        _bump("evictions", removed)
+        logger.info("LLM cache evicted %d entries", removed)
+    return removed
+
+
+def prune_expired():
+    """删除已过期条目（每日清理时调用），返回删除条数"""
+    now = time.time()
+    removed = 0
+    for _, _, path in _entries():
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                expires_at = json.load(f).get("expires_at", 0)
+        except (OSError, json.JSONDecodeError):
+            expires_at = 0
+        if now > expires_at and _remove(path):
+            removed += 1
+    return removed
+
+
+def clear():
+    """清空缓存，返回删除条数"""
+    removed = 0
+    for _, _, path in _entries():
+        if _remove(path):
+            removed += 1
+    return removed
+
+
+def stats():
+    """进程内计数 + 磁盘占用"""
+    entries = _entries()
+    with _stats_lock:
+        counters = dict(_stats)
+    lookups = counters["hits"] + counters["misses"]
+    counters["hit_rate"] = round(counters["hits"] / lookups, 3) if lookups else 0.0
+    counters["entries"] = len(entries)
+    counters["bytes"] = sum(size for _, size, _ in entries)
+    counters["max_bytes"] = int(_max_bytes())
+    return counters
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+输出被长度截断时的自动续写
+
+长篇调研文章常超出单次调用的输出上限（finish_reason == "length"），截断在
+<section> 中间，extract_html 随之失败。llm_adapter.generate 和
+agent_loop.call_llm_with_tools 检测到截断后，把已生成的部分带入下一次请求续写，
+拼接成完整输出：
+
+    LLM_MAX_CONTINUATIONS=3       单次生成最多续写次数（0 关闭）
+    LLM_OUTPUT_CEILING=32768      单次生成（含续写）的总输出 token 上限
+                                  （0 表示使用默认值；过小的值提升到 MIN_CONTINUATION_TOKENS，
+                                  避免首次请求的 max_tokens 为 0 被服务商拒绝）
+
+- 续写请求：OpenAI 兼容服务商追加 assistant（已生成部分）+ user（续写指令）；
+  Anthropic 以已生成部分作为 assistant 预填充，直接接着写
+- 拼接：去掉续写开头重复的已生成内容和多余的代码块标记
+- 每次续写的 max_tokens 不超过模型输出上限、剩余总额度和上下文剩余空间；
+  空间不足时停止续写，返回已生成的部分
+"""
+
+import logging
+import os
+
+import prompt_budget
+
+logger = logging.getLogger("ink")
+
+DEFAULT_MAX_CONTINUATIONS = 3
+DEFAULT_OUTPUT_CEILING = 32768
+# 剩余空间不足以生成这么多 token 时不再续写
+MIN_CONTINUATION_TOKENS = 256
+
+CONTINUE_PROMPT = ("你的上一条回复因长度限制被截断。请从截断处继续输出，"
+                   "不要重复已输出的内容，不要添加任何说明、开场白或代码块标记。")
+
+# 支持 assistant 预填充、从已生成部分直接续写的服务商
+PREFILL_PROVIDERS = ("claude",)
+
+# 检查续写开头与已生成结尾重复的最大 / 最小长度（字符）
+_MAX_OVERLAP = 500
+_MIN_OVERLAP = 20
+
+
+def _int_setting(config, key, default):
+    raw = (config or {}).get(key) or os.environ.get(f"INK_{key}", "")
+    try:
+        return max(0, int(raw)) if str(raw).strip() else default
+    except ValueError:
+        logger.warning("%s: invalid value %s", key, raw)
+        return default
+
+
+def max_continuations(config):
+    return _int_setting(config, "LLM_MAX_CONTINUATIONS", DEFAULT_MAX_CONTINUATIONS)
+
+
+def output_ceiling(config):
+    ceiling = _int_setting(config, "LLM_OUTPUT_CEILING", DEFAULT_OUTPUT_CEILING)
+    if not ceiling:
+        return DEFAULT_OUTPUT_CEILING
+    return max(ceiling, MIN_CONTINUATION_TOKENS)
+
+
+def next_max_tokens(provider, model, prompt_tokens, produced, ceiling):
+    """下一次续写的 max_tokens；剩余额度或上下文空间不足时返回 0"""
+    limits = prompt_budget.model_limits(provider, model)
+    room = int((limits.context - prompt_tokens - produced) * prompt_budget.SAFETY_RATIO)
+    tokens = min(limits.max_output, ceiling - produced, room)
+    return tokens if tokens >= MIN_CONTINUATION_TOKENS else 0
+
+
+def messages_for(messages, partial, provider):
+    """在原对话后追加已生成的部分，构成续写请求的消息列表"""
+    if provider in PREFILL_PROVIDERS:
+        # Messages API 不接受以空白结尾的预填充
+        return messages + [{"role": "assistant", "content": partial.rstrip()}]
+    return messages + [{"role": "assistant", "content": partial},
+                       {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def _strip_fence(text):
+    """去掉续写开头的 ```html 之类的代码块标记"""
+    stripped = text.lstrip()
+    if stripped.startswith("```"):
+        newline = stripped.find("\n")
+        if newline != -1:
+            return stripped[newline + 1:]
+    return text
+
+
+def stitch(text, addition, provider):
+    """把续写内容接到已生成部分之后，去掉开头与已生成结尾重复的部分"""
+    if provider in PREFILL_PROVIDERS:
+        text = text.rstrip()
+    else:
+        addition = _strip_fence(addition)
+    limit = min(len(text), len(addition), _MAX_OVERLAP)
+    for size in range(limit, _MIN_OVERLAP - 1, -1):
+        if text.endswith(addition[:size]):
+            return text + addition[size:]
+    return text + addition
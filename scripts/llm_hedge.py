@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+LLM 对冲请求与服务商故障转移
+
+p99 延迟主要来自单个服务商偶发的卡顿请求。llm_adapter.generate 按配置的
+服务商顺序执行：
+
+    LLM_FALLBACK_PROVIDERS=glm,kimi   主服务商之后依次尝试的备用服务商
+    LLM_HEDGE=1                       开启对冲
+    LLM_HEDGE_PERCENTILE=95           对冲阈值取历史延迟的百分位
+    LLM_HEDGE_DELAY=30                历史样本不足时的对冲阈值（秒）
+
+- 故障转移：当前服务商（重试后）仍失败时，换列表中的下一个；
+  未配置 API Key 的备用服务商跳过；熔断中的服务商（circuit_breaker）立即失败，直接换下一个
+- 对冲：主服务商在阈值内没有返回结果（流式模式下为首个 token）时，
+  向列表中的下一个服务商发出同一 prompt，取先完成的一个，取消另一个。
+  流式进度只转发先产出 token 的一路
+- 阈值按服务商分别统计：流式记录首 token 延迟，非流式记录总耗时，
+  样本保存在 INK_HOME/cache/llm_latency.json（每项最近 MAX_SAMPLES 个），
+  单次模式的短命进程之间也能积累
+
+取消、截止时间（Cancelled / DeadlineExceeded）不触发故障转移。
+"""
+
+import contextvars
+import json
+import logging
+import math
+import os
+import queue
+import threading
+import time
+
+from cancellation import bind_token, unbind_token
+from ink_env import INK_HOME
+from ink_trace import current_span
+
+logger = logging.getLogger("ink")
+
+LATENCY_FILE = os.path.join(str(INK_HOME), "cache", "llm_latency.json")
+MAX_SAMPLES = 50
+MIN_SAMPLES = 5
+DEFAULT_PERCENTILE = 95
+DEFAULT_HEDGE_DELAY = 30.0
+
+# 可作为备用的服务商（需要 API Key 的 HTTP 后端）
+FALLBACK_CAPABLE = ("deepseek", "glm", "kimi", "doubao", "openai", "claude")
+
+# 等待结果时检查取消的间隔（秒）
+_POLL_SECONDS = 0.2
+
+_latency = None
+_latency_lock = threading.Lock()
+
+
+def _flag(value):
+    return str(value or "").lower() in ("1", "true", "yes", "on")
+
+
+def hedge_enabled(config):
+    return _flag(config.get("LLM_HEDGE") or os.environ.get("INK_LLM_HEDGE"))
+
+
+def has_credentials(provider, config):
+    """备用服务商是否可用：配置了对应的 API Key（claude 需走 API 后端）"""
+    if provider == "claude":
+        import anthropic_client
+        return anthropic_client.use_api(config) and bool(config.get("ANTHROPIC_API_KEY"))
+    return bool(config.get(f"{provider.upper()}_API_KEY"))
+
+
+def provider_chain(provider, config):
+    """[主服务商, 可用的备用服务商...]，去重并保持配置顺序"""
+    chain = [provider]
+    raw = (config.get("LLM_FALLBACK_PROVIDERS")
+           or os.environ.get("INK_LLM_FALLBACK_PROVIDERS", ""))
+    for name in str(raw).replace("，", ",").split(","):
+        name = name.strip().lower()
+        if not name or name in chain:
+            continue
+        if name not in FALLBACK_CAPABLE:
+            logger.warning("LLM fallback provider not supported: %s", name)
+            continue
+        if not has_credentials(name, config):
+            logger.info("LLM fallback provider skipped (no API key): %s", name)
+            continue
+        chain.append(name)
+    return chain
+
+
+# ==================== 延迟统计 ====================
+
+def _load_latency():
+    global _latency
+    if _latency is None:
+        try:
+            with open(LATENCY_FILE, "r", encoding="utf-8") as f:
+                _latency = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            _latency = {}
+    return _latency
+
+
+def record_latency(provider, streaming, seconds):
+    key = f"{provider}:{'ttft' if streaming else 'total'}"
+    with _latency_lock:
+        samples = _load_latency().setdefault(key, [])
+        samples.append(round(seconds, 3))
+        del samples[:-MAX_SAMPLES]
+        try:
+            os.makedirs(os.path.dirname(LATENCY_FILE), exist_ok=True)
+            tmp = f"{LATENCY_FILE}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(_latency, f)
+            os.replace(tmp, LATENCY_FILE)
+        except OSError as e:
+            logger.warning("LLM latency stats write failed: %s", e)
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+def hedge_delay(provider, streaming, config):
+    """对冲阈值（秒）：历史延迟的百分位，样本不足时用 LLM_HEDGE_DELAY"""
+    try:
+        default = float(config.get("LLM_HEDGE_DELAY") or DEFAULT_HEDGE_DELAY)
+    except ValueError:
+        default = DEFAULT_HEDGE_DELAY
+    try:
+        pct = float(config.get("LLM_HEDGE_PERCENTILE") or DEFAULT_PERCENTILE)
+    except ValueError:
+        pct = DEFAULT_PERCENTILE
+    with _latency_lock:
+        samples = list(_load_latency().get(f"{provider}:{'ttft' if streaming else 'total'}", []))
+    if len(samples) < MIN_SAMPLES:
+        return default
+    return _percentile(samples, pct)
+
+
+# ==================== 对冲执行 ====================
+
+class _Forward:
+    """单路尝试的流式回调：记录首 token，只有领先的一路转发给真实回调"""
+
+    def __init__(self, race, name):
+        self.race = race
+        self.name = name
+
+    def __call__(self, delta, **kwargs):
+        self.race.first_output(self.name)
+        if self.race.leader == self.name:
+            self.race.on_delta(delta, **kwargs)
+
+    def activity(self, message, **fields):
+        if self.race.leader in (None, self.name) and hasattr(self.race.on_delta, "activity"):
+            self.race.on_delta.activity(message, **fields)
+
+    def reset(self, **counts):
+        # 只有领先（或尚无领先）的一路重试 / 续写时重置进度计数
+        if self.race.leader in (None, self.name) and hasattr(self.race.on_delta, "reset"):
+            self.race.on_delta.reset(**counts)
+
+
+class _Race:
+    """一组并发尝试：先成功者胜出，其余取消"""
+
+    def __init__(self, call, token, on_delta, record):
+        self.call = call
+        self.token = token
+        self.on_delta = on_delta
+        self.record = record
+        self.leader = None
+        self.results = queue.Queue()
+        self.children = {}
+        self.started = {}
+        self.progress = {}  # 服务商 → 已有结果或首 token 的 Event
+        self._lock = threading.Lock()
+
+    def first_output(self, name):
+        with self._lock:
+            if self.leader is None:
+                self.leader = name
+        event = self.progress[name]
+        if not event.is_set():
+            event.set()
+            if self.record:
+                record_latency(name, True, time.monotonic() - self.started[name])
+
+    def start(self, name):
+        child = self.token.child()
+        self.children[name] = child
+        self.started[name] = time.monotonic()
+        self.progress[name] = threading.Event()
+        forward = _Forward(self, name) if self.on_delta is not None else None
+        ctx = contextvars.copy_context()
+        threading.Thread(target=ctx.run, args=(self._attempt, name, child, forward),
+                         name=f"ink-hedge-{name}", daemon=True).start()
+
+    def _attempt(self, name, child, forward):
+        ctx_token = bind_token(child)
+        try:
+            content = self.call(name, child, forward)
+            if self.record and self.on_delta is None:
+                record_latency(name, False, time.monotonic() - self.started[name])
+            self.results.put((name, content, None))
+        except BaseException as e:
+            self.results.put((name, None, e))
+        finally:
+            self.progress[name].set()
+            unbind_token(ctx_token)
+
+    def wait_progress(self, name, seconds):
+        """等待某一路出现结果或首 token，期间检查取消；返回是否已有进展"""
+        deadline = time.monotonic() + seconds
+        while True:
+            self.token.check()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            if self.progress[name].wait(min(left, _POLL_SECONDS)):
+                return True
+
+    def next_result(self):
+        while True:
+            self.token.check()
+            try:
+                return self.results.get(timeout=_POLL_SECONDS)
+            except queue.Empty:
+                continue
+
+    def cancel_others(self, winner):
+        for name, child in self.children.items():
+            if name != winner:
+                child.cancel("对冲请求已由其他服务商完成")
+
+    def close(self):
+        for child in self.children.values():
+            child.close()
+
+
+def run(call, providers, config, token, on_delta=None):
+    """按服务商列表执行 call(provider, token, on_delta)，返回 (胜出服务商, 结果)。
+
+    开启对冲时每次同时最多两路（当前服务商 + 下一个），否则逐个故障转移。
+    全部失败时抛出第一个服务商的异常。
+    """
+    hedge = hedge_enabled(config)
+    first_error = None
+    cancel_error = None
+    index = 0
+    while index < len(providers):
+        primary = providers[index]
+        secondary = providers[index + 1] if hedge and index + 1 < len(providers) else None
+        race = _Race(call, token, on_delta, record=hedge)
+        race.start(primary)
+        pending = 1
+        try:
+            if secondary is not None:
+                delay = hedge_delay(primary, on_delta is not None, config)
+                if not race.wait_progress(primary, delay):
+                    logger.info("LLM hedge: %s silent for %.1fs, also trying %s",
+                                primary, delay, secondary)
+                    current_span().set(hedged=f"{primary}->{secondary}",
+                                       hedge_delay_ms=round(delay * 1000))
+                    race.start(secondary)
+                    pending += 1
+            while pending:
+                name, content, error = race.next_result()
+                pending -= 1
+                if error is None:
+                    race.cancel_others(name)
+                    if name != providers[0]:
+                        logger.info("LLM served by fallback provider %s", name)
+                    return name, content
+                if not isinstance(error, Exception):
+                    # 单路被取消或超过截止时间；整体取消由 token.check 处理
+                    cancel_error = cancel_error or error
+                    continue
+                logger.warning("LLM provider %s failed: %s", name, error)
+                if first_error is None:
+                    first_error = error
+        finally:
+            race.close()
+        index += len(race.children)
+    token.check()
+    raise first_error or cancel_error
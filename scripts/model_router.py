@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+按任务类别选择服务商 / 模型（级联路由）
+
+所有调用点原先共用 LLM_PROVIDER 及其模型：渲染四行页眉和二十分钟的深度调研
+用的是同一个模型。这里按任务类别配置模型梯队，便宜快速的模型在前：
+
+    MODEL_ROUTES=render=glm:glm-4-flash, translate=deepseek>openai:gpt-4o, research=claude
+
+- 任务类别：render（页眉页脚渲染）、translate（批量翻译）、summarize（视频转录分析）、
+  research（日报 / 专题调研）、agent（Agent 多轮调用）
+- 每个类别是以 ">" 分隔的梯队，每级为 "服务商" 或 "服务商:模型"；
+  未配置的类别只有一级：LLM_PROVIDER 及其模型（与原行为一致）
+- 主服务商不在梯队中时自动追加为最后一级，作为最强的兜底
+- 升级（fall-up）：调用方传入 validate，输出未通过校验（如翻译条数不符、
+  没有 <section>）或调用失败时换下一级；最后一级的输出原样返回
+- 未配置 API Key 的梯队跳过（主服务商除外）
+- agent 类别没有单次输出可校验，只取第一级
+- 联网搜索能力按整个梯队判断（builtin_search）：只要有一级不能自行搜索，
+  调用方就先经 search_adapter 搜索，避免升级后的模型在没有资料的情况下凭记忆写作
+"""
+
+import logging
+import os
+import re
+
+logger = logging.getLogger("ink")
+
+TASK_CLASSES = ("render", "translate", "summarize", "research", "agent")
+
+
+def _parse_routes(raw):
+    """"task=p1:m1>p2, ..." → {task: [(provider, model 或 None), ...]}"""
+    routes = {}
+    for item in (raw or "").replace("，", ",").split(","):
+        if "=" not in item:
+            continue
+        task, value = item.split("=", 1)
+        task = task.strip().lower()
+        if task not in TASK_CLASSES:
+            logger.warning("MODEL_ROUTES: unknown task class %s", task)
+            continue
+        tiers = []
+        for tier in value.split(">"):
+            provider, _, model = tier.strip().partition(":")
+            if provider.strip():
+                tiers.append((provider.strip().lower(), model.strip() or None))
+        if tiers:
+            routes[task] = tiers
+    return routes
+
+
+def _available(provider, config):
+    from llm_adapter import ROUTED_PROVIDERS
+    import llm_hedge
+    if provider not in ROUTED_PROVIDERS:
+        logger.warning("MODEL_ROUTES: unsupported provider %s", provider)
+        return False
+    main = config.get("LLM_PROVIDER", "claude").lower()
+    return provider == main or llm_hedge.has_credentials(provider, config)
+
+
+def tiers(task, config):
+    """任务类别的可用梯队 [(provider, model), ...]，便宜的在前"""
+    from llm_adapter import resolve_model
+    main = config.get("LLM_PROVIDER", "claude").lower()
+    raw = config.get("MODEL_ROUTES") or os.environ.get("INK_MODEL_ROUTES", "")
+    chain = []
+    for provider, model in _parse_routes(raw).get(task, []):
+        if not _available(provider, config):
+            logger.info("MODEL_ROUTES: %s tier %s skipped (no API key)", task, provider)
+            continue
+        model = model or resolve_model(provider, config)
+        if (provider, model) not in chain:
+            chain.append((provider, model))
+    default = (main, resolve_model(main, config))
+    if default not in chain:
+        chain.append(default)
+    return chain
+
+
+def config_for(config, provider, model):
+    """指向某一级梯队的配置副本"""
+    from llm_adapter import PROVIDER_MODELS
+    routed = dict(config)
+    routed["LLM_PROVIDER"] = provider
+    if provider == "claude":
+        routed["ANTHROPIC_MODEL"] = model
+    elif provider in PROVIDER_MODELS:
+        routed[PROVIDER_MODELS[provider][0]] = model
+    return routed
+
+
+def route_config(task, config):
+    """任务类别第一级梯队的配置（不需要升级的调用点，如 agent）"""
+    provider, model = tiers(task, config)[0]
+    return config_for(config, provider, model)
+
+
+def builtin_search(task, config):
+    """梯队每一级都能自行联网搜索（Claude CLI）时返回 True；否则调用方需先搜索并拼入 prompt"""
+    from llm_adapter import has_builtin_search
+    return all(has_builtin_search(config_for(config, provider, model))
+               for provider, model in tiers(task, config))
+
+
+def input_budget(task, config):
+    """(第一级服务商, 各级中最小的输入预算)：prompt 对每一级都放得下"""
+    import prompt_budget
+    chain = tiers(task, config)
+    return chain[0][0], min(prompt_budget.input_budget(p, m) for p, m in chain)
+
+
+def has_section(output):
+    """校验：输出中有完整的 <section>…</section>"""
+    return bool(output and re.search(r"<section[\s\S]*</section>", output))
+
+
+def generate(task, prompt, config, validate=None, **kwargs):
+    """按梯队调用 llm_adapter.generate：输出未通过 validate 或调用失败时升级到下一级。
+
+    kwargs 透传给 llm_adapter.generate；最后一级的异常和输出原样返回给调用方。
+    """
+    from llm_adapter import LLMError, generate as llm_generate
+    from ink_trace import current_span
+
+    chain = tiers(task, config)
+    for level, (provider, model) in enumerate(chain):
+        last = level == len(chain) - 1
+        try:
+            output = llm_generate(prompt, config_for(config, provider, model), **kwargs)
+        except LLMError as e:
+            if last:
+                raise
+            logger.warning("route %s: %s/%s failed, falling up: %s", task, provider, model, e)
+            continue
+        if last or validate is None or validate(output):
+            if level:
+                current_span().set(route=task, fell_up=level, model=model)
+            return output
+        logger.warning("route %s: %s/%s output failed validation, falling up",
+                       task, provider, model)
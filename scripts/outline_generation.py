@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+长文分段并行生成：先出大纲，再并发撰写各 PART
+
+专题调研默认一次调用输出整篇文章，各部分依次生成，耗时随篇幅线性增长。
+开启后改为两步：
+
+1. 大纲：同一 prompt（含搜索资料）末尾要求只输出 JSON 大纲——标题和各部分的
+   标题、要点（含关键事实和来源链接）
+2. 分段：每个部分一次调用，prompt = 同一前缀 + 大纲 + 「只写第 i 部分」，
+   经 StageGraph 有界并发执行；前缀相同，可命中服务商的前缀缓存
+
+大纲中的标题作为 <h1> 放在外层 <section> 开头、第一个 PART 之前（extract_title
+据此取标题，split_article_if_needed 将其作为各篇共用的头部），各部分以
+<!-- PART N --> 分隔，可按 PART 边界拆分系列文章。整篇耗时约为大纲 + 最慢的一个部分。
+
+prompt 中没有搜索资料（research 梯队全部是能自行联网的 Claude CLI）时，各部分
+同样开启联网搜索，不只依赖大纲要点中的事实。
+
+    TOPIC_PARALLEL_PARTS=1   开启（专题调研；翻译模板不适用）
+    TOPIC_PART_WORKERS=3     同时撰写的部分数
+
+大纲解析失败时返回 None，由调用方回退到单次生成。
+"""
+
+import html
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger("ink")
+
+DEFAULT_WORKERS = 3
+MIN_PARTS = 2
+MAX_PARTS = 8
+
+ARTICLE_STYLE = ("font-family:-apple-system, BlinkMacSystemFont, 'Helvetica Neue', "
+                 "'PingFang SC', 'Microsoft YaHei', sans-serif;")
+TITLE_STYLE = "font-size:22px;font-weight:700;color:#111;margin:28px 0 12px;line-height:1.4;"
+
+OUTLINE_INSTRUCTION = f"""
+
+## 本步骤：只输出文章大纲
+
+文章将分段撰写，本步骤只规划结构，忽略上文关于输出 HTML 的要求。
+请规划 {MIN_PARTS}-{MAX_PARTS} 个部分，每部分聚焦一个独立的子主题，各部分篇幅大致相当。
+只输出如下 JSON，不要输出任何其他内容：
+
+{{"title": "文章标题", "parts": [{{"heading": "第一部分标题", "brief": "本部分要讲清楚的要点，列出要引用的关键事实、数据和来源链接"}}]}}"""
+
+PART_INSTRUCTION = """
+
+## 本步骤：只撰写第 {index} 部分
+
+本部分标题：「{heading}」
+本部分要点：{brief}
+
+- 只输出这一部分的 HTML，以 <section 开头，以 </section> 结尾，不要写其他部分的内容
+- 不要重复文章导语；{position}
+- 遵守上文的写作风格、排版样式和 HTML 质量规则"""
+
+
+def _flag(value):
+    return str(value or "").lower() in ("1", "true", "yes", "on")
+
+
+def enabled(config):
+    return _flag(config.get("TOPIC_PARALLEL_PARTS")
+                 or os.environ.get("INK_TOPIC_PARALLEL_PARTS"))
+
+
+def workers(config):
+    raw = config.get("TOPIC_PART_WORKERS") or os.environ.get("INK_TOPIC_PART_WORKERS", "")
+    try:
+        return max(1, int(raw)) if str(raw).strip() else DEFAULT_WORKERS
+    except ValueError:
+        return DEFAULT_WORKERS
+
+
+def parse_outline(text):
+    """大纲 JSON → (标题, [(部分标题, 要点), ...])；无法解析或部分数不足时返回 None"""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    parts = []
+    for item in data.get("parts") or []:
+        if isinstance(item, dict) and str(item.get("heading") or "").strip():
+            parts.append((str(item["heading"]).strip(), str(item.get("brief") or "").strip()))
+    if len(parts) < MIN_PARTS:
+        return None
+    return str(data.get("title") or "").strip(), parts[:MAX_PARTS]
+
+
+def outline_text(title, parts):
+    """大纲的文字形式，放进每个部分的 prompt，保证各部分衔接、不重复"""
+    lines = ["", "", "## 文章大纲（分段撰写）", ""]
+    if title:
+        lines.append(f"文章标题：{title}")
+    for i, (heading, brief) in enumerate(parts, 1):
+        lines.append(f"{i}. {heading}：{brief}")
+    return "\n".join(lines)
+
+
+def part_prompt(base_prompt, outline, parts, index):
+    heading, brief = parts[index]
+    if index == len(parts) - 1:
+        position = "这是最后一部分，在末尾给出实操建议并附参考来源（附原始链接）"
+    else:
+        position = "不要写全文总结和参考来源，它们由最后一部分负责"
+    return base_prompt + outline + PART_INSTRUCTION.format(
+        index=index + 1, heading=heading, brief=brief or "见大纲", position=position)
+
+
+def _section_html(output):
+    """单个部分的输出 → <section> 片段；没有 HTML 时按 Markdown 转换"""
+    from daily_ai_news import _markdown_to_html, extract_html
+    fragment = extract_html(output)
+    if not fragment:
+        match = re.search(r"<section[\s\S]*</section>", output)
+        fragment = match.group(0) if match else _markdown_to_html(output)
+    return fragment
+
+
+def assemble(title, sections):
+    """标题和各部分装进外层 <section>：标题在第一个 PART 之前，各部分以 <!-- PART N --> 分隔"""
+    header = f'<h1 style="{TITLE_STYLE}">{html.escape(title)}</h1>\n' if title else ""
+    body = "\n".join(f"<!-- PART {i} -->\n{part}" for i, part in enumerate(sections, 1))
+    return f'<section style="{ARTICLE_STYLE}">\n{header}{body}\n</section>'
+
+
+def generate(base_prompt, config, timeout=600, need_search=True, token=None,
+             cache_ttl=None, emit_fn=None):
+    """先大纲后并发分段生成，返回整篇 HTML；大纲不可用时返回 None"""
+    import model_router
+    from stage_graph import StageGraph
+
+    def progress(message):
+        print(f"      {message}")
+        if emit_fn is not None:
+            emit_fn("progress", stage="generating", message=message)
+
+    progress("正在规划文章大纲...")
+    raw = model_router.generate(
+        "research", base_prompt + OUTLINE_INSTRUCTION, config,
+        validate=lambda out: parse_outline(out) is not None,
+        timeout=timeout, need_search=need_search, token=token, cache_ttl=cache_ttl,
+        emit_fn=emit_fn)
+    outline = parse_outline(raw)
+    if outline is None:
+        logger.warning("outline unusable, falling back to single-call generation: %s",
+                       raw[:200])
+        return None
+    title, parts = outline
+    outline_block = outline_text(title, parts)
+    progress(f"大纲：{len(parts)} 个部分，正在并行撰写...")
+
+    # 前缀中已有搜索资料时分段不再联网；没有时（梯队全部自行搜索）各部分各自搜索
+    part_search = need_search and model_router.builtin_search("research", config)
+    done = []
+
+    def make_part(index):
+        def run(_):
+            output = model_router.generate(
+                "research", part_prompt(base_prompt, outline_block, parts, index), config,
+                validate=model_router.has_section, timeout=timeout, need_search=part_search,
+                token=token, cache_ttl=cache_ttl, emit_fn=emit_fn)
+            done.append(index)
+            progress(f"已完成 {len(done)}/{len(parts)} 部分：{parts[index][0]}")
+            return _section_html(output)
+        return run
+
+    graph = StageGraph()
+    for i in range(len(parts)):
+        graph.add(f"part:{i}", make_part(i))
+    results = graph.run(max_workers=workers(config))
+    return assemble(title, [results[f"part:{i}"] for i in range(len(parts))])
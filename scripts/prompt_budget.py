@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+按模型上下文窗口分配 prompt 预算
+
+各调用点原先用固定字符数截断输入（上传文件 5 万字、网页 3000 字、转录 8 万字），
+与模型无关：moonshot-v1-8k 收到根本放不下的 prompt，128k 模型的输入却被截短。
+这里提供：
+
+- MODEL_LIMITS：模型 → (上下文窗口, 最大输出 token)，按最长前缀匹配，
+  未知模型回退到服务商默认值
+- estimate_tokens：按 UTF-8 字节数快速估算 token（不做分词），
+  CJK 字符按各家 tokenizer 的经验比例计
+- pack：按优先级把若干段落装进预算，必需段落保持原样，
+  其余按优先级从高到低填充，装不下的截断或丢弃
+- fair_share：多个同级条目（如多条搜索结果）平分预算，短条目剩余的额度分给长条目
+
+    budget = input_budget(provider, model) - estimate_tokens(instructions, provider)
+    parts = pack([Section("data", file_text), Section("desc", desc, priority=-1)],
+                 budget, provider)
+"""
+
+from collections import namedtuple
+
+ModelLimits = namedtuple("ModelLimits", "context max_output")
+
+# 模型名前缀 → 限制；同一前缀有多条时取最长匹配
+MODEL_LIMITS = {
+    "deepseek-chat": ModelLimits(131072, 8192),
+    "deepseek-reasoner": ModelLimits(131072, 32768),
+    "gpt-4o": ModelLimits(128000, 16384),
+    "gpt-4.1": ModelLimits(1047576, 32768),
+    "gpt-5": ModelLimits(400000, 128000),
+    "glm-4": ModelLimits(131072, 4095),
+    "doubao-1.5-pro-32k": ModelLimits(32768, 12288),
+    "doubao-1.5-pro-256k": ModelLimits(262144, 12288),
+    "moonshot-v1-8k": ModelLimits(8192, 4096),
+    "moonshot-v1-32k": ModelLimits(32768, 8192),
+    "moonshot-v1-128k": ModelLimits(131072, 8192),
+    "kimi-k2": ModelLimits(131072, 16384),
+    "claude": ModelLimits(200000, 64000),
+}
+
+# 未登记的模型按服务商取保守值
+PROVIDER_DEFAULTS = {
+    "deepseek": ModelLimits(65536, 8192),
+    "openai": ModelLimits(128000, 16384),
+    "glm": ModelLimits(131072, 4095),
+    "doubao": ModelLimits(32768, 4096),
+    "kimi": ModelLimits(8192, 4096),
+    "claude": ModelLimits(200000, 8192),
+}
+DEFAULT_LIMITS = ModelLimits(32768, 4096)
+
+# 每个 CJK 字符对应的 token 数（各家 tokenizer 的经验值，略偏高以留余量）
+CJK_TOKENS_PER_CHAR = {
+    "deepseek": 0.7,
+    "glm": 0.8,
+    "kimi": 0.8,
+    "doubao": 0.8,
+    "openai": 0.9,
+    "claude": 1.2,
+}
+# 其余字符（英文、代码、HTML）每 token 的字符数
+CHARS_PER_TOKEN = 3.5
+
+# 估算误差的余量：预算只用上下文剩余空间的 SAFETY_RATIO
+SAFETY_RATIO = 0.9
+# 为输出预留的 token 上限（与 llm_adapter.DEFAULT_MAX_TOKENS 一致）
+OUTPUT_RESERVE = 8192
+
+TRUNCATED_MARK = "\n……（内容过长，已截断）"
+OMITTED_MARK = "\n……（中间部分省略）……\n"
+
+
+def model_limits(provider, model=None):
+    """模型的 (上下文窗口, 最大输出)，未登记时回退到服务商默认值"""
+    name = (model or "").lower()
+    best = ""
+    for prefix in MODEL_LIMITS:
+        if name.startswith(prefix) and len(prefix) > len(best):
+            best = prefix
+    if best:
+        return MODEL_LIMITS[best]
+    return PROVIDER_DEFAULTS.get((provider or "").lower(), DEFAULT_LIMITS)
+
+
+def max_output_tokens(provider, model=None, requested=OUTPUT_RESERVE):
+    """本次调用的 max_tokens：不超过模型的输出上限"""
+    return min(requested, model_limits(provider, model).max_output)
+
+
+def input_budget(provider, model=None, reserve_output=OUTPUT_RESERVE):
+    """可用于 prompt 的 token 数：上下文窗口减去输出预留，再乘安全系数"""
+    limits = model_limits(provider, model)
+    reserve = min(reserve_output, limits.max_output)
+    return int((limits.context - reserve) * SAFETY_RATIO)
+
+
+def budget_for(config):
+    """按配置的主服务商和模型返回 (provider, 输入预算)"""
+    from llm_adapter import resolve_model
+    provider = config.get("LLM_PROVIDER", "claude").lower()
+    return provider, input_budget(provider, resolve_model(provider, config))
+
+
+# ==================== 估算与截断 ====================
+
+def estimate_tokens(text, provider=None):
+    """快速估算 token 数。
+
+    不逐字符分类：ASCII 占 1 字节、CJK 占 3 字节，(字节数 - 字符数) / 2 即 CJK 字符数
+    （2 字节的拉丁扩展 / 西里尔字符按半个计）。
+    """
+    if not text:
+        return 0
+    chars = len(text)
+    cjk = max(0, (len(text.encode("utf-8", errors="replace")) - chars) // 2)
+    ratio = CJK_TOKENS_PER_CHAR.get((provider or "").lower(), 1.0)
+    return int(cjk * ratio + (chars - cjk) / CHARS_PER_TOKEN) + 1
+
+
+def _chars_for(text, max_tokens, provider):
+    """text 中大约对应 max_tokens 个 token 的字符数"""
+    total = estimate_tokens(text, provider)
+    return int(len(text) * max_tokens / total) if total else len(text)
+
+
+def _cut_head(text, chars):
+    """保留前 chars 个字符，尽量在段落 / 换行处断开"""
+    head = text[:chars]
+    cut = max(head.rfind("\n\n"), head.rfind("\n"))
+    return head[:cut] if cut > chars * 0.8 else head
+
+
+def truncate(text, max_tokens, provider=None, keep="head"):
+    """截断到约 max_tokens 个 token；未超出时原样返回。
+
+    keep="head" 保留开头；keep="both" 保留开头和结尾（3:1），适合转录等首尾都重要的文本。
+    """
+    if max_tokens <= 0:
+        return ""
+    if estimate_tokens(text, provider) <= max_tokens:
+        return text
+    mark = OMITTED_MARK if keep == "both" else TRUNCATED_MARK
+    room = max(0, max_tokens - estimate_tokens(mark, provider))
+    chars = _chars_for(text, room, provider)
+    # 首尾的中英文密度可能不同，按字符比例换算会有偏差：超出时按比例收缩重试
+    for _ in range(4):
+        if keep == "both":
+            head_chars = chars * 3 // 4
+            tail = text[len(text) - (chars - head_chars):] if chars > head_chars else ""
+            cut = tail.find("\n")
+            if 0 <= cut < len(tail) * 0.2:
+                tail = tail[cut + 1:]
+            result = _cut_head(text, head_chars) + mark + tail
+        else:
+            result = _cut_head(text, chars) + mark
+        size = estimate_tokens(result, provider)
+        if size <= max_tokens:
+            break
+        chars = int(chars * max_tokens / size * 0.95)
+    return result
+
+
+# ==================== 按优先级装填 ====================
+
+class Section:
+    """prompt 中的一段：required 的段落不截断；其余按 priority 从高到低分配预算"""
+
+    __slots__ = ("name", "text", "priority", "required", "keep", "min_tokens")
+
+    def __init__(self, name, text, priority=0, required=False, keep="head", min_tokens=200):
+        self.name = name
+        self.text = text or ""
+        self.priority = priority
+        self.required = required
+        self.keep = keep
+        self.min_tokens = min_tokens  # 剩余额度不足此值时整段丢弃，不留残片
+
+
+def pack(sections, budget, provider=None):
+    """把 sections 装进 budget 个 token，返回 {name: 装填后的文本}（丢弃的段落为 ""）"""
+    result = {}
+    remaining = budget
+    for sec in sections:
+        if sec.required:
+            result[sec.name] = sec.text
+            remaining -= estimate_tokens(sec.text, provider)
+    for sec in sorted((s for s in sections if not s.required), key=lambda s: -s.priority):
+        size = estimate_tokens(sec.text, provider)
+        if size <= remaining:
+            result[sec.name] = sec.text
+            remaining -= size
+        elif remaining >= min(sec.min_tokens, size):
+            result[sec.name] = truncate(sec.text, remaining, provider, keep=sec.keep)
+            remaining = 0
+        else:
+            result[sec.name] = ""
+    return result
+
+
+def fair_share(texts, budget, provider=None):
+    """多个同级文本平分 budget：短文本用不完的额度依次分给更长的文本"""
+    sizes = [estimate_tokens(t, provider) for t in texts]
+    shares = [0] * len(texts)
+    remaining = budget
+    pending = sorted(range(len(texts)), key=lambda i: sizes[i])
+    while pending:
+        share = remaining // len(pending)
+        i = pending.pop(0)
+        shares[i] = min(sizes[i], share)
+        remaining -= shares[i]
+    return [t if shares[i] >= sizes[i] else truncate(t, shares[i], provider)
+            for i, t in enumerate(texts)]
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+跨进程的服务商限流（令牌桶）
+
+GUI 的 sidecar 和定时运行的 daily_ai_news.py 可能同时使用同一个 API Key，
+各自的并发限制（concurrency_limits）看不到彼此，合起来会触发服务商的 RPM / TPM 限制。
+这里按 (类别, 服务商, Key 指纹) 维护令牌桶，状态存于 INK_HOME/ratelimit.db（SQLite），
+所有进程共享：
+
+    rate_limiter.acquire("llm", "deepseek", api_key, tokens=prompt_tokens, token=token)
+    content = call()
+    rate_limiter.debit("llm", "deepseek", api_key, tokens=output_tokens)   # 输出 token 事后补扣
+
+- 重试的每次尝试各自 acquire；debit 在全部尝试结束、输出 token 已知后调用一次
+- 每分钟请求数（RPM）和每分钟 token 数（TPM）两个桶，按时间连续补充
+- 额度不足时排队等待（可被取消，记录为 wait.ratelimit span），不会失败
+- token 数由调用方估算（prompt_budget.estimate_tokens）；输出 token 调用前未知，
+  调用后补扣；桶可以透支，后续调用方相应多等
+- 限额：DEFAULT_LIMITS，或配置 / 环境变量 RATE_LIMITS 覆盖，
+  格式 "deepseek=60/200000, tavily=30"（RPM/TPM，TPM 可省略，0 表示不限）
+- INK_RATE_LIMIT=0 关闭；数据库不可用时记录警告并放行
+"""
+
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import time
+
+from cancellation import current_token
+from ink_env import INK_HOME
+from ink_trace import span
+
+logger = logging.getLogger("ink")
+
+DB_PATH = os.path.join(str(INK_HOME), "ratelimit.db")
+
+# 类别（llm / search / image）→ 默认的 (RPM, TPM)；None 表示不限，
+# 单个服务商的限额由 RATE_LIMITS 覆盖
+DEFAULT_LIMITS = {
+    "llm": (60, None),
+    "search": (60, None),
+    "image": (5, None),
+}
+
+# 额度不足时单次等待的上限（秒），之后重新读取共享状态
+_MAX_SLEEP = 2.0
+
+
+def enabled():
+    return os.environ.get("INK_RATE_LIMIT", "1").lower() not in ("0", "false", "no", "off")
+
+
+def _parse_limits(raw):
+    limits = {}
+    for item in re.split(r"[,，;\s]+", raw or ""):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        parts = value.split("/")
+        try:
+            rpm = float(parts[0]) or None
+            tpm = (float(parts[1]) or None) if len(parts) > 1 else None
+        except ValueError:
+            logger.warning("RATE_LIMITS: invalid entry %s", item)
+            continue
+        limits[name.strip().lower()] = (rpm, tpm)
+    return limits
+
+
+def limits_for(kind, provider, config=None):
+    """(RPM, TPM)：RATE_LIMITS 中的服务商配置优先，其次按类别默认值"""
+    raw = (config or {}).get("RATE_LIMITS") or os.environ.get("RATE_LIMITS", "")
+    overrides = _parse_limits(raw)
+    if provider in overrides:
+        return overrides[provider]
+    return DEFAULT_LIMITS.get(kind, (None, None))
+
+
+def _bucket_key(kind, provider, api_key):
+    fingerprint = hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:12]
+    return f"{kind}:{provider}:{fingerprint}"
+
+
+def _connect():
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=10, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS buckets (
+        key TEXT PRIMARY KEY,
+        requests REAL NOT NULL,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL)""")
+    return conn
+
+
+def _try_take(conn, key, rpm, tpm, cost):
+    """在一个写事务内补充并尝试扣减，成功返回 0，否则返回建议等待秒数"""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("SELECT requests, tokens, updated FROM buckets WHERE key = ?",
+                           (key,)).fetchone()
+        req_cap = rpm or 0
+        tok_cap = tpm or 0
+        if row is None:
+            requests, tokens = req_cap, tok_cap
+        else:
+            elapsed = max(0.0, now - row[2])
+            requests = min(req_cap, row[0] + elapsed * req_cap / 60)
+            tokens = min(tok_cap, row[1] + elapsed * tok_cap / 60)
+
+        wait = 0.0
+        if rpm and requests < 1:
+            wait = max(wait, (1 - requests) * 60 / rpm)
+        # 单次请求超过整个 TPM 桶时，等桶满即放行，避免永远等待
+        need = min(cost, tok_cap) if tpm else 0
+        if tpm and tokens < need:
+            wait = max(wait, (need - tokens) * 60 / tpm)
+        if wait == 0:
+            if rpm:
+                requests -= 1
+            if tpm:
+                tokens -= cost
+        conn.execute("INSERT OR REPLACE INTO buckets (key, requests, tokens, updated) "
+                     "VALUES (?, ?, ?, ?)", (key, requests, tokens, now))
+        conn.execute("COMMIT")
+        return wait
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def acquire(kind, provider, api_key="", tokens=0, config=None, token=None):
+    """等待直到 (类别, 服务商, Key) 有额度，扣减 1 次请求和 tokens 个 token"""
+    if not enabled():
+        return
+    rpm, tpm = limits_for(kind, provider, config)
+    if not rpm and not tpm:
+        return
+    if token is None:
+        token = current_token()
+    key = _bucket_key(kind, provider, api_key)
+    try:
+        conn = _connect()
+    except sqlite3.Error as e:
+        logger.warning("rate limiter unavailable, not limiting: %s", e)
+        return
+    try:
+        wait = _try_take(conn, key, rpm, tpm, tokens)
+        if wait == 0:
+            return
+        with span("wait.ratelimit", cat="wait", provider=provider) as sp:
+            waited = 0.0
+            while wait > 0:
+                pause = min(wait, _MAX_SLEEP)
+                if token.wait(pause):
+                    token.check()
+                waited += pause
+                wait = _try_take(conn, key, rpm, tpm, tokens)
+            sp.set(waited_ms=round(waited * 1000))
+        logger.info("rate limit: waited %.1fs for %s", waited, key)
+    except sqlite3.Error as e:
+        logger.warning("rate limiter error, not limiting: %s", e)
+    finally:
+        conn.close()
+
+
+def debit(kind, provider, api_key="", tokens=0, config=None):
+    """事后补扣 token（如输出 token），允许透支"""
+    if not enabled() or tokens <= 0:
+        return
+    rpm, tpm = limits_for(kind, provider, config)
+    if not tpm:
+        return
+    key = _bucket_key(kind, provider, api_key)
+    try:
+        conn = _connect()
+        try:
+            conn.execute("UPDATE buckets SET tokens = tokens - ? WHERE key = ?", (tokens, key))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("rate limiter debit failed: %s", e)
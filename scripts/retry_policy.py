@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+LLM 调用的重试策略
+
+高峰期国内服务商经常返回 429 / 502，一次瞬时错误不应让整篇生成或 Agent 运行失败。
+RetryPolicy.call 对幂等调用（LLM 生成、function-calling 一轮）按以下规则重试：
+
+- 分类：连接失败、超时、408 / 409 / 425 / 429 / 5xx / 529 可重试；
+  其余状态码（400 / 401 / 403 / 404 / 422 …）和空输出等视为致命错误，立即抛出。
+  异常通过 status / retry_after / retryable 属性（见 HTTPStatusError、LLMError）声明分类
+- 退避：指数退避 + full jitter；响应带 Retry-After 时按其等待
+- 上限：最多 max_attempts 次尝试、重试等待总时长不超过 max_elapsed，
+  且不超过请求剩余预算——等待后已不够发起一次调用时直接放弃
+- 等待可被取消打断；每次重试记录到当前 span（retries 计数，进入 trace 汇总）
+  和 retry.wait span，进程内累计次数见 stats()
+
+环境变量 INK_RETRY_MAX_ATTEMPTS 覆盖默认尝试次数（1 表示不重试）。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from cancellation import MIN_CALL_SECONDS, current_token
+from ink_trace import current_span, span
+
+logger = logging.getLogger("ink")
+
+RETRYABLE_STATUS = frozenset({408, 409, 425, 429, 500, 502, 503, 504, 529})
+
+DEFAULT_MAX_ATTEMPTS = 4
+
+_stats = {"retries": 0, "gave_up": 0}
+_stats_lock = threading.Lock()
+
+
+class HTTPStatusError(RuntimeError):
+    """带 HTTP 状态码的调用失败，供重试策略分类"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """解析 Retry-After（秒数或 HTTP 日期），无法解析返回 None"""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def response_retry_after(resp):
+    return parse_retry_after(resp.headers.get("Retry-After"))
+
+
+def is_retryable(exc):
+    """判断异常是否值得重试"""
+    flag = getattr(exc, "retryable", None)
+    if flag is not None:
+        return bool(flag)
+    status = getattr(exc, "status", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    try:
+        import requests
+    except ImportError:
+        return False
+    return isinstance(exc, (requests.exceptions.ConnectionError,
+                            requests.exceptions.Timeout,
+                            requests.exceptions.ChunkedEncodingError))
+
+
+def _default_attempts():
+    try:
+        return max(1, int(os.environ.get("INK_RETRY_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)))
+    except ValueError:
+        return DEFAULT_MAX_ATTEMPTS
+
+
+class RetryPolicy:
+    """指数退避 + jitter 的重试策略"""
+
+    def __init__(self, max_attempts=None, base_delay=1.0, max_delay=30.0,
+                 max_elapsed=180.0, max_retry_after=60.0):
+        self.max_attempts = _default_attempts() if max_attempts is None else max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.max_retry_after = max_retry_after
+
+    def delay_for(self, exc, attempt):
+        """第 attempt 次失败后的等待秒数（attempt 从 1 开始）"""
+        retry_after = getattr(exc, "retry_after", None)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        # full jitter：在 [0, 指数上限] 内均匀取值，避免并发任务同时重试
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def call(self, fn, token=None, label="llm"):
+        """执行 fn()，可重试的异常按策略重试，返回 fn 的结果"""
+        if token is None:
+            token = current_token()
+        waited = 0.0
+        attempt = 0
+        while True:
+            try:
+                return fn()
+            except Exception as e:
+                attempt += 1
+                if not is_retryable(e):
+                    raise
+                delay = self.delay_for(e, attempt)
+                remaining = token.remaining()
+                if (attempt >= self.max_attempts
+                        or waited + delay > self.max_elapsed
+                        or (remaining is not None and remaining - delay < MIN_CALL_SECONDS)):
+                    _bump("gave_up")
+                    logger.warning("%s: giving up after %d attempt(s): %s", label, attempt, e)
+                    raise
+                _bump("retries")
+                current_span().add(retries=1)
+                logger.warning("%s: attempt %d failed (%s), retrying in %.1fs",
+                               label, attempt, e, delay)
+                with span("retry.wait", cat="wait", label=label, attempt=attempt,
+                          delay_ms=round(delay * 1000)):
+                    if token.wait(delay):
+                        token.check()
+                waited += delay
+
+
+def call_with_retry(fn, token=None, label="llm", policy=None):
+    """用默认策略（或指定策略）执行 fn"""
+    return (policy or RetryPolicy()).call(fn, token=token, label=label)
+
+
+def _bump(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    """进程内累计的重试 / 放弃次数"""
+    with _stats_lock:
+        return dict(_stats)
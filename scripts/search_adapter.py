@@ -6,8 +6,25 @@
 仅当 LLM_PROVIDER != claude 时需要调用，因为 Claude 一体化模式自带搜索。
 """
 
+import time
 
-def search_and_fetch(queries, config, fetch_top_n=2):
+from cancellation import current_token
+from concurrency_limits import provider_slot
+from ink_trace import span
+import circuit_breaker
+import http_session
+import prompt_budget
+import rate_limiter
+import retry_policy
+import singleflight
+
+# 单个网页正文的抓取上限（字符），注入 prompt 前再按模型预算裁剪
+PAGE_MAX_CHARS = 20000
+# 未提供预算时每条来源保留的字符数
+DEFAULT_SOURCE_CHARS = 3000
+
+
+def search_and_fetch(queries, config, fetch_top_n=2, token=None, max_tokens=None):
     """
     执行多个搜索查询，返回格式化的上下文文本。
 
@@ -15,10 +32,15 @@ def search_and_fetch(queries, config, fetch_top_n=2):
         queries: 搜索查询列表，如 ["AI Agent 最新进展 2026", "OpenAI announcement"]
         config: 配置字典
         fetch_top_n: 每个查询取前 N 条结果的正文
+        token: CancelToken，每次网络调用的超时从剩余预算推导
+        max_tokens: 搜索上下文的 token 预算（按 LLM_PROVIDER 估算），各来源平分；
+            None 时每条来源截取 DEFAULT_SOURCE_CHARS 字符
 
     返回:
         格式化的搜索结果文本，可直接注入 prompt
     """
+    if token is None:
+        token = current_token()
     provider = config.get("SEARCH_PROVIDER", "auto").lower()
 
     has_tavily = bool(config.get("TAVILY_API_KEY"))
@@ -44,17 +66,35 @@ def search_and_fetch(queries, config, fetch_top_n=2):
         return ""
 
     for p in order:
+        # 熔断中的搜索服务商直接跳过，不再等满超时
+        wait = circuit_breaker.admit("search", p, config, lease=30)
+        if wait:
+            print(f"[警告] {p} 近期连续失败，已暂停调用（熔断），约 {wait:.0f} 秒后恢复")
+            continue
         if p == "tavily":
-            results = _search_via_tavily(queries, config, fetch_top_n)
+            results = _search_via_tavily(queries, config, fetch_top_n, token)
         else:
-            results = _search_via_serpapi(queries, config, fetch_top_n)
+            results = _search_via_serpapi(queries, config, fetch_top_n, token)
         if results:
-            return format_search_context(results)
+            return format_search_context(results, max_tokens=max_tokens,
+                                         provider=config.get("LLM_PROVIDER"))
 
     return ""
 
 
-def _search_via_tavily(queries, config, fetch_top_n):
+def _tracked(provider, config, query_fn):
+    """执行单个查询，结果计入该服务商的断路器，返回结果列表"""
+    start = time.monotonic()
+    try:
+        results, healthy = query_fn()
+    except BaseException:
+        circuit_breaker.record("search", provider, None, config=config)
+        raise
+    circuit_breaker.record("search", provider, healthy, time.monotonic() - start, config)
+    return results
+
+
+def _search_via_tavily(queries, config, fetch_top_n, token=None):
     """
     使用 Tavily API 搜索（自带正文提取）。
 
@@ -66,16 +106,28 @@ def _search_via_tavily(queries, config, fetch_top_n):
         print("[警告] 未配置 TAVILY_API_KEY，跳过搜索")
         return []
 
-    try:
-        import requests
-    except ImportError:
-        print("[警告] requests 库未安装，跳过搜索")
-        return []
-
+    if token is None:
+        token = current_token()
     results = []
     for query in queries:
+        # 并发任务中相同的查询只请求一次（见 singleflight）
+        results.extend(singleflight.do(
+            ("search", "tavily", query, fetch_top_n),
+            lambda: _tracked("tavily", config,
+                             lambda: _tavily_query(query, api_key, config, fetch_top_n, token)),
+            token))
+    return results
+
+
+def _tavily_query(query, api_key, config, fetch_top_n, token):
+    """单个查询的 Tavily 请求，返回 (结果, 服务商是否健康)；失败时结果为空列表"""
+    rate_limiter.acquire("search", "tavily", api_key, config=config, token=token)
+    timeout = token.timeout(30)
+    results = []
+    with provider_slot("search", "tavily"), \
+            span("search.tavily", cat="search", query=query) as sp:
         try:
-            resp = requests.post(
+            resp = http_session.post(
                 "https://api.tavily.com/search",
                 json={
                     "api_key": api_key,
@@ -84,13 +136,14 @@ def _search_via_tavily(queries, config, fetch_top_n):
                     "include_answer": False,
                     "include_raw_content": False,
                 },
-                timeout=30,
+                timeout=timeout,
             )
 
             if resp.status_code != 200:
                 print(f"[警告] Tavily 搜索失败: HTTP {resp.status_code}")
-                continue
+                return results, resp.status_code not in retry_policy.RETRYABLE_STATUS
 
+            sp.add(bytes_in=len(resp.content))
             data = resp.json()
             for item in data.get("results", [])[:fetch_top_n]:
                 results.append({
@@ -101,12 +154,12 @@ def _search_via_tavily(queries, config, fetch_top_n):
                 })
         except Exception as e:
             print(f"[警告] Tavily 搜索异常 ({query}): {e}")
-            continue
+            return results, not retry_policy.is_retryable(e)
 
-    return results
+    return results, True
 
 
-def _search_via_serpapi(queries, config, fetch_top_n):
+def _search_via_serpapi(queries, config, fetch_top_n, token=None):
     """
     使用 SerpAPI 搜索 + requests 抓取正文。
 
@@ -118,16 +171,28 @@ def _search_via_serpapi(queries, config, fetch_top_n):
         print("[警告] 未配置 SERPAPI_API_KEY，跳过搜索")
         return []
 
-    try:
-        import requests
-    except ImportError:
-        print("[警告] requests 库未安装，跳过搜索")
-        return []
-
+    if token is None:
+        token = current_token()
     results = []
     for query in queries:
+        # 并发任务中相同的查询只请求一次（见 singleflight）
+        results.extend(singleflight.do(
+            ("search", "serpapi", query, fetch_top_n),
+            lambda: _tracked("serpapi", config,
+                             lambda: _serpapi_query(query, api_key, config, fetch_top_n, token)),
+            token))
+    return results
+
+
+def _serpapi_query(query, api_key, config, fetch_top_n, token):
+    """单个查询的 SerpAPI 请求 + 正文抓取，返回 (结果, 服务商是否健康)；失败时结果为空列表"""
+    rate_limiter.acquire("search", "serpapi", api_key, config=config, token=token)
+    timeout = token.timeout(30)
+    results = []
+    with provider_slot("search", "serpapi"), \
+            span("search.serpapi", cat="search", query=query) as sp:
         try:
-            resp = requests.get(
+            resp = http_session.get(
                 "https://serpapi.com/search",
                 params={
                     "api_key": api_key,
@@ -135,13 +200,14 @@ def _search_via_serpapi(queries, config, fetch_top_n):
                     "num": fetch_top_n,
                     "engine": "google",
                 },
-                timeout=30,
+                timeout=timeout,
             )
 
             if resp.status_code != 200:
                 print(f"[警告] SerpAPI 搜索失败: HTTP {resp.status_code}")
-                continue
+                return results, resp.status_code not in retry_policy.RETRYABLE_STATUS
 
+            sp.add(bytes_in=len(resp.content))
             data = resp.json()
             organic = data.get("organic_results", [])[:fetch_top_n]
 
@@ -151,7 +217,7 @@ def _search_via_serpapi(queries, config, fetch_top_n):
                 snippet = item.get("snippet", "")
 
                 # 尝试抓取正文
-                content = _fetch_page_content(url)
+                content = _fetch_page_content(url, token=token)
                 if not content:
                     content = snippet
 
@@ -163,46 +229,59 @@ def _search_via_serpapi(queries, config, fetch_top_n):
                 })
         except Exception as e:
             print(f"[警告] SerpAPI 搜索异常 ({query}): {e}")
-            continue
+            return results, not retry_policy.is_retryable(e)
 
-    return results
+    return results, True
 
 
-def _fetch_page_content(url, max_chars=3000):
-    """抓取网页正文，截取前 max_chars 字符"""
-    try:
-        import requests
-        resp = requests.get(url, timeout=10, headers={
-            "User-Agent": "Mozilla/5.0 (compatible; NewsBot/1.0)"
-        })
-        if resp.status_code != 200:
-            return ""
+def _fetch_page_content(url, max_chars=PAGE_MAX_CHARS, token=None):
+    """抓取网页正文，截取前 max_chars 字符；并发的相同 URL 只抓取一次"""
+    if token is None:
+        token = current_token()
+    return singleflight.do(("fetch", url, max_chars),
+                           lambda: _fetch_page(url, max_chars, token), token)
 
-        # 简单提取正文：去除 HTML 标签
-        import re
-        text = resp.text
-        # 移除 script 和 style
-        text = re.sub(r'<script[^>]*>.*?</script>', '', text, flags=re.DOTALL)
-        text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.DOTALL)
-        # 移除所有标签
-        text = re.sub(r'<[^>]+>', ' ', text)
-        # 清理空白
-        text = re.sub(r'\s+', ' ', text).strip()
-        return text[:max_chars]
-    except Exception:
-        return ""
+
+def _fetch_page(url, max_chars, token):
+    timeout = token.timeout(10)
+    with span("search.fetch", cat="fetch", url=url[:200]) as sp:
+        try:
+            resp = http_session.get(url, timeout=timeout, headers={
+                "User-Agent": "Mozilla/5.0 (compatible; NewsBot/1.0)"
+            })
+            sp.add(bytes_in=len(resp.content))
+            if resp.status_code != 200:
+                return ""
+
+            # 简单提取正文：去除 HTML 标签
+            import re
+            text = resp.text
+            # 移除 script 和 style
+            text = re.sub(r'<script[^>]*>.*?</script>', '', text, flags=re.DOTALL)
+            text = re.sub(r'<style[^>]*>.*?</style>', '', text, flags=re.DOTALL)
+            # 移除所有标签
+            text = re.sub(r'<[^>]+>', ' ', text)
+            # 清理空白
+            text = re.sub(r'\s+', ' ', text).strip()
+            return text[:max_chars]
+        except Exception:
+            return ""
 
 
-def format_search_context(results):
-    """将搜索结果格式化为 prompt 可用的文本块"""
+def format_search_context(results, max_tokens=None, provider=None):
+    """将搜索结果格式化为 prompt 可用的文本块；给定 max_tokens 时各来源正文平分预算"""
     if not results:
         return ""
 
-    parts = []
-    for i, item in enumerate(results, 1):
-        part = f"【来源 {i}】{item['title']}\n"
-        part += f"URL: {item['url']}\n"
-        part += f"内容: {item['content']}\n"
-        parts.append(part)
+    headers = [f"【来源 {i}】{item['title']}\nURL: {item['url']}\n内容: "
+               for i, item in enumerate(results, 1)]
+    contents = [item["content"] or "" for item in results]
+    if max_tokens is None:
+        contents = [c[:DEFAULT_SOURCE_CHARS] for c in contents]
+    else:
+        overhead = sum(prompt_budget.estimate_tokens(h, provider) + 2 for h in headers)
+        contents = prompt_budget.fair_share(contents, max(0, max_tokens - overhead), provider)
+
+    parts = [f"{header}{content}\n" for header, content in zip(headers, contents)]
 
     return "\n---\n".join(parts)
@@ -2,10 +2,22 @@
 """
 Sidecar 入口：接收 Tauri 前端命令，输出 JSON Lines 进度。
 用法: echo '{"action":"generate","mode":"daily"}' | python3 sidecar_main.py
+
+常驻模式: python3 sidecar_main.py --daemon
+    stdin 每行一条 JSON 命令（可带 request_id），stdout 事件都带上对应 request_id，
+    每条命令结束输出 {"type":"done","request_id":...}。进程、已加载模块和缓存在命令间复用。
+    命令在有界线程池中并发执行（INK_SIDECAR_WORKERS，默认 4），
+    {"action":"cancel","target":"<request_id>"} 只取消目标请求。
+
+冷启动约定：import 本模块不做任何磁盘 IO；日志/目录初始化在 main() 中进行，
+轻量 action（LIGHT_ACTIONS）不得 import 生成链路模块，可用 profile_startup 验证。
 """
 import sys
 import os
 import io
+import contextvars
+import threading
+import uuid
 
 # Windows 下强制 UTF-8 编码，避免中文乱码
 if sys.platform == "win32":
@@ -19,6 +31,16 @@ import json
 import logging
 from datetime import datetime
 
+from event_writer import EventWriter
+
+# 事件输出：daemon 模式会接管 sys.stdout，事件始终写入原始 stdout；
+# 同 stage 的高频 progress 事件按窗口合并（INK_EVENT_COALESCE_MS）
+_events = EventWriter(sys.stdout)
+# 当前命令的 request_id（daemon 模式下用于事件路由）
+_current_request_id = contextvars.ContextVar("ink_request_id", default=None)
+# 事件接收者：batch_generate 的子任务把事件交给批次汇总，而不是直接输出
+_event_sink = contextvars.ContextVar("ink_event_sink", default=None)
+
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
 # PyInstaller 打包后，数据文件在 sys._MEIPASS 目录下
@@ -40,28 +62,103 @@ if os.path.exists(PYLIB_DIR) and PYLIB_DIR not in sys.path:
 # 本地日志 & 缓存目录（跨平台）
 # ============================================================
 from ink_env import INK_HOME
+from cancellation import (
+    Cancelled, CancelToken, DeadlineExceeded,
+    current_token, bind_token, unbind_token,
+)
+from ink_trace import (
+    traced, span, current_span, current_trace, start_trace, end_trace,
+    cleanup_old_traces,
+)
+import usage_ledger
 INK_HOME = str(INK_HOME)  # keep as str for os.path.join compat
 LOG_DIR = os.path.join(INK_HOME, "logs")
 CACHE_DIR = os.path.join(INK_HOME, "cache")
-os.makedirs(LOG_DIR, exist_ok=True)
-os.makedirs(CACHE_DIR, exist_ok=True)
-
-# 按天滚动的日志文件
-_log_file = os.path.join(LOG_DIR, f"{datetime.now().strftime('%Y-%m-%d')}.log")
-logging.basicConfig(
-    filename=_log_file,
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    datefmt="%H:%M:%S",
-)
+# 上次清理日志/缓存的时间戳文件，每天最多扫描一次目录
+CLEANUP_STAMP = os.path.join(INK_HOME, ".last_cleanup")
+
 logger = logging.getLogger("ink")
 
+# 按天滚动的日志文件（由 _configure_log_file 设置）
+_log_day = None
+_log_file = None
+# 日志写盘在后台线程完成：root logger 只挂 QueueHandler，emit 热路径不做文件 IO
+_log_queue = None
+_log_listener = None
+
+
+def _configure_log_file():
+    """配置当天的日志文件；daemon 跨天运行时切换文件，日期未变时不做任何事"""
+    global _log_day, _log_file, _log_queue, _log_listener
+    import queue
+    from logging.handlers import QueueHandler, QueueListener
+
+    today = datetime.now().strftime('%Y-%m-%d')
+    if today == _log_day:
+        return
+    root = logging.getLogger()
+    if _log_listener is None:
+        _log_queue = queue.SimpleQueue()
+        root.addHandler(QueueHandler(_log_queue))
+        root.setLevel(logging.INFO)
+    else:
+        _log_listener.stop()  # 写完队列中的记录后切换文件
+        for h in _log_listener.handlers:
+            h.close()
+    _log_day = today
+    _log_file = os.path.join(LOG_DIR, f"{today}.log")
+    handler = logging.FileHandler(_log_file, encoding="utf-8")
+    handler.setFormatter(logging.Formatter(
+        "%(asctime)s [%(levelname)s] %(message)s", datefmt="%H:%M:%S"))
+    _log_listener = QueueListener(_log_queue, handler)
+    _log_listener.start()
+
+
+def _shutdown_runtime():
+    """进程退出前调用：写出待发事件，关闭 HTTP 连接池，等待日志线程写完"""
+    _events.close()
+    if "http_session" in sys.modules:
+        sys.modules["http_session"].close()
+    if _events.total_suppressed:
+        logger.info("events coalesced: %d progress events suppressed",
+                    _events.total_suppressed)
+    if _log_listener is not None:
+        _log_listener.stop()
+
+
+def _init_runtime():
+    """进程入口调用：创建目录、配置日志、按需清理过期文件"""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    _configure_log_file()
+    _maybe_cleanup()
+
+
+# 请求被取消后仍允许输出的事件类型
+_TERMINAL_EVENTS = ("error", "done")
+
 
 def emit(event_type, **kwargs):
-    """输出一行 JSON 事件到 stdout，同时写入日志"""
+    """输出一行 JSON 事件到 stdout，同时写入日志。
+
+    emit 同时是取消检查的安全点：当前请求已取消时，非终止事件会抛出 Cancelled。
+    """
+    if event_type not in _TERMINAL_EVENTS:
+        current_token().check()
+    if event_type == "result":
+        trace = current_trace()
+        if trace is not None:
+            kwargs.setdefault("trace", trace.summary())
     event = {"type": event_type, **kwargs}
-    print(json.dumps(event, ensure_ascii=False), flush=True)
-    # 写入本地日志
+    request_id = _current_request_id.get()
+    if request_id is not None:
+        event.setdefault("request_id", request_id)
+    sink = _event_sink.get()
+    if sink is not None:
+        sink(event)
+    else:
+        _events.write(event)
+    # 写入本地日志（完整记录，不受事件合并影响）
     msg = kwargs.get("message", "")
     if event_type == "error":
         logger.error("emit %s: %s %s", event_type, kwargs.get("code", ""), msg)
@@ -88,11 +185,6 @@ def _handle_translate_inplace(params, config, file_formats, topic, timestamp,
                               output_dir, header_html, footer_html):
     """原格式翻译：保持文档格式和样式，只替换文字内容。"""
     import re as re_mod
-    from translate_inplace import translate_file_inplace
-    from daily_ai_news import (
-        generate_cover_image, save_article, make_timestamp,
-        pick_daily_variation, append_footer,
-    )
 
     # 从 topic 提取目标语言（如 "翻译为英文" → "英文"）
     lang_match = re_mod.search(
@@ -104,7 +196,22 @@ def _handle_translate_inplace(params, config, file_formats, topic, timestamp,
 
     article_dir = os.path.join(output_dir, timestamp)
     os.makedirs(article_dir, exist_ok=True)
+    try:
+        _translate_files_inplace(params, config, file_formats, topic, timestamp,
+                                 article_dir, header_html, footer_html, target_lang)
+    except Cancelled:
+        # 取消时 metadata 尚未写出，整个目录都是半成品
+        _discard_partial_outputs([article_dir])
+        raise
+
 
+def _translate_files_inplace(params, config, file_formats, topic, timestamp,
+                             article_dir, header_html, footer_html, target_lang):
+    """逐个翻译上传文件并写出预览、封面和元数据"""
+    from translate_inplace import translate_file_inplace
+    from daily_ai_news import generate_cover_image, pick_daily_variation
+
+    token = current_token()
     translated_files = []
     all_preview_texts = []
 
@@ -128,7 +235,7 @@ def _handle_translate_inplace(params, config, file_formats, topic, timestamp,
              message=f"正在翻译 {fname}...", percent=20)
 
         result_path = translate_file_inplace(
-            src_path, out_path, target_lang, config, emit_fn=emit)
+            src_path, out_path, target_lang, config, emit_fn=emit, token=token)
 
         if result_path:
             translated_files.append(out_name)
@@ -262,6 +369,29 @@ def _build_preview_html(preview_texts, target_lang):
     return "\n".join(parts)
 
 
+# 命令参数中透传给 LLM / 搜索适配层的配置项
+LLM_CONFIG_KEYS = (
+    "DEEPSEEK_API_KEY", "GLM_API_KEY", "DOUBAO_API_KEY",
+    "KIMI_API_KEY", "OPENAI_API_KEY",
+    "DEEPSEEK_MODEL", "GLM_MODEL", "DOUBAO_MODEL",
+    "KIMI_MODEL", "OPENAI_MODEL",
+    "ANTHROPIC_API_KEY", "ANTHROPIC_MODEL", "ANTHROPIC_BASE_URL",
+    "CLAUDE_BACKEND", "LLM_CACHE",
+    "LLM_FALLBACK_PROVIDERS", "LLM_HEDGE", "LLM_HEDGE_PERCENTILE", "LLM_HEDGE_DELAY",
+    "RATE_LIMITS", "LLM_MAX_CONTINUATIONS", "LLM_OUTPUT_CEILING",
+    "TOPIC_PARALLEL_PARTS", "TOPIC_PART_WORKERS", "MODEL_ROUTES",
+    "LLM_BREAKER", "LLM_BREAKER_FAILURES", "LLM_BREAKER_COOLDOWN", "LLM_BREAKER_SLOW_SECONDS",
+)
+SEARCH_CONFIG_KEYS = ("TAVILY_API_KEY", "SERPAPI_API_KEY", "SEARCH_PROVIDER")
+
+# 上传文件提取文本的字符上限（防止超大文件撑大事件流）
+EXTRACT_MAX_CHARS = 400_000
+
+# 检查点目录中的文本产物
+RAW_OUTPUT_FILE = "raw.html"
+EXTRACTED_FILE = "extracted.html"
+
+
 def handle_generate(params):
     """处理文章生成请求，集成 daily_ai_news.py 核心逻辑"""
     from datetime import datetime
@@ -271,6 +401,8 @@ def handle_generate(params):
         make_timestamp, run_video_analysis, save_article,
         pick_daily_variation, append_footer,
     )
+    from checkpoint import RunCheckpoint
+    from stage_graph import StageGraph
 
     logger.info("=== generate start === mode=%s topic=%s provider=%s",
                 params.get("mode"), params.get("topic", "")[:60],
@@ -281,12 +413,7 @@ def handle_generate(params):
     config = {}
     if params.get("provider"):
         config["LLM_PROVIDER"] = params["provider"]
-    for key in ["DEEPSEEK_API_KEY", "GLM_API_KEY", "DOUBAO_API_KEY",
-                "KIMI_API_KEY", "OPENAI_API_KEY",
-                "DEEPSEEK_MODEL", "GLM_MODEL", "DOUBAO_MODEL",
-                "KIMI_MODEL", "OPENAI_MODEL",
-                "TAVILY_API_KEY", "SERPAPI_API_KEY",
-                "SEARCH_PROVIDER", "OUTPUT_DIR"]:
+    for key in LLM_CONFIG_KEYS + SEARCH_CONFIG_KEYS + ("OUTPUT_DIR",):
         if params.get(key):
             config[key] = params[key]
 
@@ -306,7 +433,10 @@ def handle_generate(params):
             oss_config[k] = params[k]
     default_output = os.path.join(INK_HOME, "articles")
     output_dir = config.get("OUTPUT_DIR", default_output)
-    timestamp = make_timestamp()
+    # batch_generate 为每个任务指定不同的时间戳，避免文件/缓存/OSS key 冲突
+    timestamp = params.get("timestamp") or make_timestamp()
+    token = current_token()
+    written = []  # 本次已写出的文件，取消时清理
 
     try:  # noqa: E501 — 捕获 SystemExit（daily_ai_news 内部 sys.exit）
         # ---------- 视频分析模式 ----------
@@ -334,6 +464,15 @@ def handle_generate(params):
             return
 
         # ---------- 文章生成模式（daily / topic） ----------
+        if params.get("separate_dir"):
+            # 批量任务：每篇文章写入独立目录
+            output_dir = os.path.join(output_dir, timestamp)
+            written.append(output_dir)
+
+        # 检查点：每个阶段的产物落盘，resume 时跳过产物仍然有效的阶段
+        checkpoint = RunCheckpoint.open(timestamp, params, resume=bool(params.get("resume")))
+        reused = []
+
         today = datetime.now().strftime("%Y-%m-%d")
         variation = pick_daily_variation(today)
         effective_topic = topic if topic else variation.get("topic")
@@ -342,136 +481,399 @@ def handle_generate(params):
         if file_contents and not effective_topic:
             effective_topic = "数据分析报告"
 
-        emit("progress", stage="generating", message="正在生成文章...", percent=20)
-        html_content = generate_article(topic=effective_topic, config=config,
-                                        custom_prompt=template_prompt,
-                                        file_contents=file_contents,
-                                        layout_style=layout_style)
-        if not html_content:
-            emit("error", code="GENERATION_FAILED", message="文章生成失败，未获得输出")
-            return
-
-        # 缓存 LLM 原始输出，方便排查和复用
-        cache_file = os.path.join(CACHE_DIR, f"{timestamp}-raw.html")
-        try:
-            with open(cache_file, "w", encoding="utf-8") as cf:
-                cf.write(html_content)
-            logger.info("LLM raw output cached: %s (%d chars)", cache_file, len(html_content))
-        except OSError:
-            pass
+        llm_stage = checkpoint.get("llm", files=("path",))
+        if llm_stage:
+            html_content = checkpoint.read_text(RAW_OUTPUT_FILE)
+            effective_topic = llm_stage.get("topic", effective_topic)
+            reused.append("llm")
+            emit("progress", stage="generating", message="复用已生成的文章内容", percent=40)
+        else:
+            emit("progress", stage="generating", message="正在生成文章...", percent=20)
+            html_content = generate_article(topic=effective_topic, config=config,
+                                            custom_prompt=template_prompt,
+                                            file_contents=file_contents,
+                                            layout_style=layout_style,
+                                            token=token, emit_fn=emit)
+            if not html_content:
+                emit("error", code="GENERATION_FAILED", message="文章生成失败，未获得输出")
+                return
+
+            # LLM 原始输出写入检查点，下游失败后 resume 不再重新调用 LLM
+            raw_path = checkpoint.save_text(RAW_OUTPUT_FILE, html_content)
+            checkpoint.record("llm", {"path": raw_path, "chars": len(html_content),
+                                      "topic": effective_topic or ""})
+            logger.info("LLM raw output checkpointed: %s (%d chars)", raw_path, len(html_content))
 
         emit("progress", stage="processing", message="正在处理文章...", percent=50)
 
-        # 提取 HTML
-        extracted = extract_html(html_content)
-        if extracted:
-            html_content = extracted
-
-        # 提取标题
-        title = extract_title(html_content) or f"AI 资讯 {timestamp}"
-
-        # 拆分长文
-        articles = split_article_if_needed(html_content, title)
-        is_series = len(articles) > 1
+        extract_stage = checkpoint.get("extract", files=("path",))
+        if extract_stage:
+            html_content = checkpoint.read_text(EXTRACTED_FILE)
+            title = extract_stage["title"]
+            reused.append("extract")
+        else:
+            # 提取 HTML
+            extracted = extract_html(html_content)
+            if extracted:
+                html_content = extracted
+
+            # 提取标题
+            title = extract_title(html_content) or f"AI 资讯 {timestamp}"
+            checkpoint.record("extract", {
+                "path": checkpoint.save_text(EXTRACTED_FILE, html_content),
+                "title": title,
+            })
 
         emit("progress", stage="saving", message="正在保存文章...", percent=60)
 
-        filepaths = []
-        img_paths = []
-        for idx, (part_title, part_html) in enumerate(articles):
-            part_html = append_footer(part_html)
-            # 插入用户自定义头部/尾部模板
-            if header_html:
-                part_html = header_html + part_html
-            if footer_html:
-                part_html = part_html + footer_html
-            suffix = f"-part{idx + 1}" if is_series else ""
-            filepath = save_article(timestamp, part_html, output_dir, suffix=suffix)
-            filepaths.append(str(filepath))
-
-            emit("progress", stage="cover", message=f"正在生成封面图...", percent=70 + idx * 10)
-            cover_kwargs = _get_cover_kwargs(params)
-            cover_path = generate_cover_image(
-                f"{timestamp}{suffix}", part_title,
-                effective_topic or "", output_dir,
-                cover_theme=variation.get("cover_theme"),
-                **cover_kwargs,
-            )
-            img_paths.append(str(cover_path) if cover_path else "")
-
-        # 同步到 OSS
-        if len(oss_config) == 4:
+        save_stage = checkpoint.get("save", files=("paths",))
+        if save_stage:
+            part_titles = save_stage["titles"]
+            filepaths = save_stage["paths"]
+            reused.append("save")
+        else:
+            # 拆分长文
+            articles = split_article_if_needed(html_content, title)
+            is_series = len(articles) > 1
+            part_titles = [part_title for part_title, _ in articles]
+            filepaths = []
+            for idx, (_, part_html) in enumerate(articles):
+                part_html = append_footer(part_html)
+                # 插入用户自定义头部/尾部模板
+                if header_html:
+                    part_html = header_html + part_html
+                if footer_html:
+                    part_html = part_html + footer_html
+                suffix = f"-part{idx + 1}" if is_series else ""
+                filepath = save_article(timestamp, part_html, output_dir, suffix=suffix)
+                filepaths.append(str(filepath))
+                written.append(str(filepath))
+            checkpoint.record("save", {"titles": part_titles, "paths": filepaths})
+        is_series = len(filepaths) > 1
+
+        # ---------- 后处理：封面、OSS、格式转换并发执行，元数据最后写入 ----------
+        graph = StageGraph()
+        cover_kwargs = _get_cover_kwargs(params)
+        oss_enabled = len(oss_config) == 4
+        oss_lock = threading.Lock()
+        oss_failures = []
+        oss_stage = checkpoint.get("oss") or {"keys": []}
+        uploaded = list(oss_stage["keys"])
+        if oss_enabled and uploaded:
+            reused.append("oss")
+
+        def make_cover_stage(idx, part_title):
+            def run(_):
+                stage = checkpoint.get(f"cover:{idx}", files=("path",))
+                if stage:
+                    reused.append(f"cover:{idx}")
+                    return stage["path"]
+                suffix = f"-part{idx + 1}" if is_series else ""
+                emit("progress", stage="cover", message=f"正在生成封面图...", percent=70 + idx * 10)
+                cover_path = generate_cover_image(
+                    f"{timestamp}{suffix}", part_title,
+                    effective_topic or "", output_dir,
+                    cover_theme=variation.get("cover_theme"),
+                    **cover_kwargs,
+                )
+                cover_path = str(cover_path) if cover_path else ""
+                if cover_path:
+                    written.append(cover_path)
+                checkpoint.record(f"cover:{idx}", {"path": cover_path})
+                return cover_path
+            return run
+
+        def make_oss_stage(local_path=None, dep=None):
+            # 同步到 OSS（逐个文件记录到检查点，resume 时只上传缺失的文件）
+            def run(inputs):
+                path = inputs[dep] if dep else local_path
+                if not path or not os.path.exists(path):
+                    return None
+                oss_key = f"articles/{timestamp}/{os.path.basename(path)}"
+                with oss_lock:
+                    if oss_key in uploaded:
+                        return oss_key
+                try:
+                    _upload_to_oss(path, oss_key, oss_config)
+                except Exception as e:
+                    oss_failures.append(oss_key)
+                    emit("progress", stage="uploading",
+                         message=f"OSS 同步失败（不影响本地文件）: {e}")
+                    return None
+                with oss_lock:
+                    uploaded.append(oss_key)
+                    checkpoint.record("oss", {"keys": list(uploaded)})
+                return oss_key
+            return run
+
+        for idx, part_title in enumerate(part_titles):
+            graph.add(f"cover:{idx}", make_cover_stage(idx, part_title))
+        if oss_enabled:
             emit("progress", stage="uploading", message="正在同步到云端...", percent=90)
-            try:
-                for i in range(len(articles)):
-                    # 上传文章 HTML
-                    oss_article_key = f"articles/{timestamp}/{os.path.basename(filepaths[i])}"
-                    _upload_to_oss(filepaths[i], oss_article_key, oss_config)
-                    # 上传封面图
-                    if img_paths[i] and os.path.exists(img_paths[i]):
-                        oss_cover_key = f"articles/{timestamp}/{os.path.basename(img_paths[i])}"
-                        _upload_to_oss(img_paths[i], oss_cover_key, oss_config)
-                emit("progress", stage="uploading", message="云端同步完成", percent=95)
-            except Exception as e:
-                emit("progress", stage="uploading",
-                     message=f"OSS 同步失败（不影响本地文件）: {e}")
+            for idx, filepath in enumerate(filepaths):
+                graph.add(f"oss:article:{idx}", make_oss_stage(local_path=filepath))
+                graph.add(f"oss:cover:{idx}", make_oss_stage(dep=f"cover:{idx}"),
+                          deps=[f"cover:{idx}"])
 
         # 格式转换：如果有上传文件，生成与上传文件相同格式的输出
-        file_type = "html"
-        converted_files = []
-        converted_path = ""
+        target_ext = ""
         if file_formats:
             target_ext = file_formats[0].get("ext", "").lower()
-            if target_ext and target_ext not in ("txt", "md", "csv"):
+            if target_ext in ("txt", "md", "csv"):
+                target_ext = ""
+        if target_ext:
+            def run_convert(_):
+                convert_stage = checkpoint.get("convert", files=("path",))
+                if convert_stage:
+                    reused.append("convert")
+                    return convert_stage["path"]
                 article_dir = os.path.dirname(filepaths[0]) if filepaths else output_dir
                 emit("progress", stage="converting",
                      message=f"正在转换为 .{target_ext} 格式...", percent=85)
                 converted = _convert_html_to_format(
                     html_content, target_ext, article_dir, timestamp)
                 if converted:
-                    file_type = target_ext
-                    converted_path = converted
-                    converted_files.append(os.path.basename(converted))
+                    written.append(converted)
+                    checkpoint.record("convert", {"path": converted})
                     logger.info("Converted to %s: %s", target_ext, converted)
-
-        # 保存元数据
-        meta_dir = os.path.dirname(filepaths[0]) if filepaths else output_dir
-        metadata = {
-            "title": title,
-            "date": timestamp[:8],  # YYYYMMDD
-            "mode": mode,
-            "topic": effective_topic or "",
-            "status": "generated",
-            "provider": config.get("LLM_PROVIDER", "claude"),
-            "file_type": file_type,
-            "converted_path": converted_path,
-            "output_files": converted_files,
-            "articles": [
-                {"title": articles[i][0], "path": filepaths[i], "cover": img_paths[i]}
-                for i in range(len(articles))
-            ],
-        }
-        meta_path = os.path.join(meta_dir, f"{timestamp}-metadata.json")
-        with open(meta_path, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, ensure_ascii=False, indent=2)
+                return converted
+            graph.add("convert", run_convert)
+
+        # 保存元数据：依赖所有其他阶段，metadata 总是最后写入
+        def run_metadata(inputs):
+            img_paths = [inputs[f"cover:{i}"] for i in range(len(part_titles))]
+            converted = inputs.get("convert")
+            meta_dir = os.path.dirname(filepaths[0]) if filepaths else output_dir
+            metadata = {
+                "title": title,
+                "date": timestamp[:8],  # YYYYMMDD
+                "mode": mode,
+                "topic": effective_topic or "",
+                "status": "generated",
+                "provider": config.get("LLM_PROVIDER", "claude"),
+                "file_type": target_ext if converted else "html",
+                "converted_path": converted or "",
+                "output_files": [os.path.basename(converted)] if converted else [],
+                "articles": [
+                    {"title": part_titles[i], "path": filepaths[i], "cover": img_paths[i]}
+                    for i in range(len(filepaths))
+                ],
+            }
+            meta_path = os.path.join(meta_dir, f"{timestamp}-metadata.json")
+            with open(meta_path, "w", encoding="utf-8") as f:
+                json.dump(metadata, f, ensure_ascii=False, indent=2)
+            checkpoint.record("metadata", {"path": meta_path})
+            return metadata, meta_path
+        graph.add("metadata", run_metadata, deps=graph.names())
+
+        metadata, meta_path = graph.run()["metadata"]
+        if oss_enabled and not oss_failures:
+            emit("progress", stage="uploading", message="云端同步完成", percent=95)
 
         emit("progress", stage="done", message="生成完成！", percent=100)
         emit("result", status="success", title=title,
              article_path=filepaths[0], metadata_path=meta_path,
-             cover_path=img_paths[0] if img_paths else "",
-             file_type=file_type, article_count=len(articles))
+             cover_path=metadata["articles"][0]["cover"] if filepaths else "",
+             file_type=metadata["file_type"], article_count=len(filepaths),
+             run_id=timestamp, reused_stages=reused)
 
+    except Cancelled:
+        _discard_partial_outputs(written)
+        raise
     except SystemExit as e:
         logger.error("generate SystemExit code=%s", e.code)
-        emit("error", code="GENERATION_ERROR", message=f"生成过程异常退出 (code={e.code})")
+        emit("error", code="GENERATION_ERROR", message=f"生成过程异常退出 (code={e.code})",
+             run_id=timestamp)
     except Exception as e:
         logger.exception("generate exception")
-        emit("error", code="GENERATION_ERROR", message=str(e))
+        emit("error", code="GENERATION_ERROR", message=str(e), run_id=timestamp)
+
+
+def handle_resume(params):
+    """从检查点恢复一次失败的生成：产物仍然有效的阶段直接复用，不重复调用 LLM。
+
+    run_id: 失败时 error 事件中的 run_id（即运行时间戳）
+    其余字段覆盖检查点中保存的参数；检查点不保存密钥，需要时由调用方重新提供。
+    """
+    from checkpoint import RunCheckpoint
+
+    import re as re_mod
+    run_id = str(params.get("run_id") or "")
+    valid = re_mod.fullmatch(r"[\w-]+", run_id) is not None
+    checkpoint = RunCheckpoint.load(run_id) if valid else None
+    if checkpoint is None:
+        emit("error", code="NOT_FOUND", message=f"未找到可恢复的运行: {run_id}")
+        return
+    overrides = {k: v for k, v in params.items()
+                 if k not in ("action", "request_id", "timeout", "run_id")}
+    logger.info("resume run_id=%s done_stages=%s", run_id, checkpoint.done())
+    handle_generate({**checkpoint.params, **overrides,
+                     "timestamp": run_id, "resume": True})
+
+
+# ============================================================
+# 批量生成
+# ============================================================
+
+# 批量参数中不下发给单个任务的字段
+_BATCH_ONLY_KEYS = ("action", "request_id", "timeout", "jobs", "max_parallel",
+                    "llm_concurrency", "search_concurrency")
+
+
+class _BatchJob:
+    """batch_generate 中的一个任务：收集其事件，换算为批次进度"""
+
+    def __init__(self, index, total, params):
+        self.index = index
+        self.total = total
+        self.params = params
+        self.percent = 0
+        self.summary = {"job": index, "topic": params.get("topic", ""),
+                        "template_id": params.get("template_id", ""),
+                        "status": "pending"}
+
+    def label(self):
+        return f"[{self.index + 1}/{self.total}]"
+
+
+def handle_batch_generate(params):
+    """并发执行多个生成任务，每个任务走 handle_generate 流水线。
+
+    jobs: [{topic, template_id, template_prompt, layout_style, ...}]，
+          任务字段覆盖批次级参数（provider、API Key、封面设置等）
+    max_parallel: 同时运行的任务数（默认 INK_BATCH_WORKERS 或 4）
+    llm_concurrency / search_concurrency: 每个服务商的并发上限，
+          int 或 {服务商: 上限}，见 concurrency_limits.ProviderLimits
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from concurrency_limits import ProviderLimits, bind_limits, unbind_limits
+    from daily_ai_news import make_timestamp
+
+    specs = params.get("jobs")
+    if not isinstance(specs, list) or not specs:
+        emit("error", code="MISSING_PARAMS", message="缺少 jobs 列表")
+        return
+
+    shared = {k: v for k, v in params.items() if k not in _BATCH_ONLY_KEYS}
+    batch_ts = make_timestamp()
+    jobs = []
+    for i, spec in enumerate(specs):
+        if not isinstance(spec, dict):
+            spec = {"topic": str(spec)}
+        job_params = {**shared, **spec,
+                      "timestamp": f"{batch_ts}-{i + 1:02d}", "separate_dir": True}
+        job_params.setdefault("mode", "topic" if job_params.get("topic") else "daily")
+        jobs.append(_BatchJob(i, len(specs), job_params))
+
+    try:
+        max_parallel = int(params.get("max_parallel")
+                           or os.environ.get("INK_BATCH_WORKERS", "4"))
+    except (TypeError, ValueError):
+        max_parallel = 4
+    max_parallel = max(1, min(max_parallel, len(jobs)))
+    limits = ProviderLimits(llm=params.get("llm_concurrency"),
+                            search=params.get("search_concurrency"))
+    state_lock = threading.Lock()
+
+    logger.info("=== batch_generate start === jobs=%d parallel=%d", len(jobs), max_parallel)
+    emit("progress", stage="batch", message=f"批量生成 {len(jobs)} 篇，"
+         f"同时运行 {max_parallel} 个任务", percent=0)
+
+    def overall_percent():
+        return round(sum(j.percent for j in jobs) / len(jobs))
+
+    def make_sink(job):
+        def sink(event):
+            etype = event.get("type")
+            forward = None
+            with state_lock:
+                if etype == "progress":
+                    if isinstance(event.get("percent"), (int, float)):
+                        job.percent = max(job.percent, min(100, event["percent"]))
+                    forward = {**event, "job": job.index,
+                               "message": f"{job.label()} {event.get('message', '')}",
+                               "job_percent": job.percent, "percent": overall_percent()}
+                elif etype == "result":
+                    job.percent = 100
+                    job.summary.update(
+                        {k: v for k, v in event.items()
+                         if k not in ("type", "request_id", "trace")})
+                    job.summary["status"] = "success"
+                    forward = {"type": "job_done", "job": job.index,
+                               "status": "success", "title": event.get("title", ""),
+                               "article_path": event.get("article_path", ""),
+                               "percent": overall_percent()}
+                elif etype == "error":
+                    job.percent = 100
+                    job.summary.update(status="error", code=event.get("code", ""),
+                                       message=event.get("message", ""))
+                    forward = {"type": "job_done", "job": job.index,
+                               "status": "error", "code": event.get("code", ""),
+                               "message": event.get("message", ""),
+                               "percent": overall_percent()}
+                else:
+                    forward = {**event, "job": job.index}
+                if "request_id" in event:
+                    forward.setdefault("request_id", event["request_id"])
+                # 持锁写出，保证批次 percent 单调递增
+                _events.write(forward)
+        return sink
+
+    def run_job(job):
+        _event_sink.set(make_sink(job))
+        usage_ledger.bind_action("batch_generate", job.params.get("template_id")
+                                 or job.params.get("mode") or "")
+        job.summary["status"] = "running"
+        t0 = time.monotonic()
+        try:
+            handle_generate(job.params)
+        except Cancelled:
+            job.summary["status"] = "cancelled"
+            raise
+        finally:
+            job.summary["elapsed_ms"] = round((time.monotonic() - t0) * 1000)
+            if job.summary["status"] == "running":
+                job.summary.update(status="error", code="NO_RESULT",
+                                   message="任务结束但未输出结果")
+
+    t0 = time.monotonic()
+    limits_token = bind_limits(limits)
+    try:
+        with ThreadPoolExecutor(max_workers=max_parallel,
+                                thread_name_prefix="ink-batch") as pool:
+            # 每个任务在当前上下文（令牌、trace、限额）的副本中运行
+            futures = [pool.submit(contextvars.copy_context().run, run_job, job)
+                       for job in jobs]
+            for f in futures:
+                try:
+                    f.result()
+                except Cancelled:
+                    pass
+    finally:
+        unbind_limits(limits_token)
+    current_token().check()
+
+    summaries = [j.summary for j in jobs]
+    succeeded = sum(1 for s in summaries if s["status"] == "success")
+    elapsed_ms = round((time.monotonic() - t0) * 1000)
+    logger.info("=== batch_generate done === %d/%d succeeded in %dms",
+                succeeded, len(jobs), elapsed_ms)
+    if not succeeded:
+        emit("error", code="BATCH_FAILED", message="批量生成全部失败", jobs=summaries)
+        return
+    emit("progress", stage="done", message=f"批量生成完成：{succeeded}/{len(jobs)} 篇成功",
+         percent=100)
+    emit("result", status="success", jobs=summaries, succeeded=succeeded,
+         failed=len(jobs) - succeeded, elapsed_ms=elapsed_ms,
+         job_elapsed_ms_sum=sum(s.get("elapsed_ms", 0) for s in summaries),
+         limits=limits.describe())
 
 
 def handle_agent_generate(params):
     """处理 Agent 模式生成请求：多轮工具调用"""
     import shutil
+    import model_router
     from agent_loop import run_agent_loop, init_workspace
     from daily_ai_news import (
         extract_html, extract_title, append_footer,
@@ -487,12 +889,7 @@ def handle_agent_generate(params):
     config = {}
     if params.get("provider"):
         config["LLM_PROVIDER"] = params["provider"]
-    for key in ["DEEPSEEK_API_KEY", "GLM_API_KEY", "DOUBAO_API_KEY",
-                "KIMI_API_KEY", "OPENAI_API_KEY",
-                "DEEPSEEK_MODEL", "GLM_MODEL", "DOUBAO_MODEL",
-                "KIMI_MODEL", "OPENAI_MODEL",
-                "TAVILY_API_KEY", "SERPAPI_API_KEY",
-                "SEARCH_PROVIDER", "OUTPUT_DIR"]:
+    for key in LLM_CONFIG_KEYS + SEARCH_CONFIG_KEYS + ("OUTPUT_DIR",):
         if params.get(key):
             config[key] = params[key]
 
@@ -513,6 +910,8 @@ def handle_agent_generate(params):
     default_output = os.path.join(INK_HOME, "articles")
     output_dir = config.get("OUTPUT_DIR", default_output)
     timestamp = make_timestamp()
+    token = current_token()
+    written = []  # 本次写入文章目录的文件，取消时清理
 
     try:
         # 初始化 workspace
@@ -545,7 +944,7 @@ def handle_agent_generate(params):
         turns = params.get("max_turns", 15)
         html_content = run_agent_loop(
             topic=topic,
-            config=config,
+            config=model_router.route_config("agent", config),
             emit_fn=emit,
             workspace=workspace,
             template_prompt=template_prompt,
@@ -553,6 +952,7 @@ def handle_agent_generate(params):
             file_formats=file_formats,
             max_turns=turns,
             layout_style=layout_style,
+            token=token,
         )
 
         if not html_content:
@@ -607,6 +1007,7 @@ def handle_agent_generate(params):
             html_content = html_content + footer_html
 
         filepath = save_article(timestamp, html_content, output_dir)
+        written.append(str(filepath))
 
         emit("progress", stage="cover", message="正在生成封面图...", percent=70)
         today = datetime.now().strftime("%Y-%m-%d")
@@ -617,12 +1018,16 @@ def handle_agent_generate(params):
             cover_theme=variation.get("cover_theme"),
             **cover_kwargs,
         )
+        if cover_path:
+            written.append(str(cover_path))
         article_dir = os.path.dirname(str(filepath))
         file_type = "html"
         for fname in output_files:
             src = os.path.join(ws_output, fname)
             dst = os.path.join(article_dir, fname)
+            token.check()
             shutil.copy2(src, dst)
+            written.append(dst)
             ext = os.path.splitext(fname)[1].lower()
             if ext in (".docx", ".xlsx", ".pdf"):
                 file_type = ext[1:]  # docx/xlsx/pdf
@@ -653,6 +1058,9 @@ def handle_agent_generate(params):
              cover_path=str(cover_path) if cover_path else "",
              file_type=file_type, article_count=1)
 
+    except Cancelled:
+        _discard_partial_outputs(written)
+        raise
     except SystemExit as e:
         logger.error("agent_generate SystemExit code=%s", e.code)
         emit("error", code="AGENT_ERROR", message=f"Agent 异常退出 (code={e.code})")
@@ -670,7 +1078,7 @@ def handle_validate_key(params):
         emit("error", code="MISSING_PARAMS", message="缺少 provider 或 api_key")
         return
 
-    import requests
+    import http_session
 
     endpoints = {
         "deepseek": "https://api.deepseek.com/v1/models",
@@ -678,6 +1086,7 @@ def handle_validate_key(params):
         "doubao": "https://ark.cn-beijing.volces.com/api/v3/models",
         "kimi": "https://api.moonshot.cn/v1/models",
         "openai": "https://api.openai.com/v1/models",
+        "claude": "https://api.anthropic.com/v1/models",
     }
 
     endpoint = endpoints.get(provider)
@@ -686,11 +1095,13 @@ def handle_validate_key(params):
         return
 
     try:
-        resp = requests.get(
-            endpoint,
-            headers={"Authorization": f"Bearer {api_key}"},
-            timeout=10,
-        )
+        if provider == "claude":
+            # Anthropic Messages API 的鉴权头与 OpenAI 兼容接口不同
+            from anthropic_client import API_VERSION
+            headers = {"x-api-key": api_key, "anthropic-version": API_VERSION}
+        else:
+            headers = {"Authorization": f"Bearer {api_key}"}
+        resp = http_session.get(endpoint, headers=headers, timeout=10)
         if resp.status_code == 200:
             emit("result", status="success", message=f"{provider} API Key 验证成功")
         else:
@@ -702,7 +1113,7 @@ def handle_validate_key(params):
 
 def handle_test_wechat(params):
     """测试微信公众号连接：获取 access_token 并返回结果"""
-    import requests
+    import http_session
 
     app_id = params.get("app_id", "")
     app_secret = params.get("app_secret", "")
@@ -714,7 +1125,7 @@ def handle_test_wechat(params):
     # 获取当前出口 IP
     current_ip = ""
     try:
-        ip_resp = requests.get("https://ifconfig.me/ip", timeout=5,
+        ip_resp = http_session.get("https://ifconfig.me/ip", timeout=5,
                                headers={"User-Agent": "curl/7.0"})
         if ip_resp.status_code == 200:
             current_ip = ip_resp.text.strip()
@@ -723,7 +1134,7 @@ def handle_test_wechat(params):
 
     try:
         url = "https://api.weixin.qq.com/cgi-bin/token"
-        resp = requests.get(url, params={
+        resp = http_session.get(url, params={
             "grant_type": "client_credential",
             "appid": app_id,
             "secret": app_secret,
@@ -863,9 +1274,28 @@ def handle_delete_article(params):
              message=f"未找到文章: {article_id}")
 
 
+def _discard_partial_outputs(paths):
+    """请求被取消时删除本次已写出的文件/目录。
+
+    metadata 总是最后写入，清理后不会在文章列表中留下半成品。
+    """
+    import shutil
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+            logger.info("discarded partial output: %s", path)
+        except OSError as e:
+            logger.warning("failed to discard %s: %s", path, e)
+
+
+@traced("oss.upload", cat="oss")
 def _upload_to_oss(local_path, oss_key, oss_config):
     """上传文件到阿里云 OSS"""
     import oss2
+    current_span().add(bytes_out=os.path.getsize(local_path))
     auth = oss2.Auth(oss_config["oss_access_key_id"], oss_config["oss_access_key_secret"])
     endpoint = oss_config["oss_endpoint"]
     if not endpoint.startswith("http"):
@@ -876,7 +1306,7 @@ def _upload_to_oss(local_path, oss_key, oss_config):
 
 def handle_render_template(params):
     """用 AI 将纯文本渲染为微信公众号风格的 HTML 片段"""
-    from llm_adapter import generate, LLMError
+    import model_router
 
     text = params.get("text", "").strip()
     position = params.get("position", "footer")  # header or footer
@@ -887,10 +1317,7 @@ def handle_render_template(params):
     config = {}
     provider = params.get("provider", "deepseek")
     config["LLM_PROVIDER"] = provider
-    for key in ["DEEPSEEK_API_KEY", "GLM_API_KEY", "DOUBAO_API_KEY",
-                "KIMI_API_KEY", "OPENAI_API_KEY",
-                "DEEPSEEK_MODEL", "GLM_MODEL", "DOUBAO_MODEL",
-                "KIMI_MODEL", "OPENAI_MODEL"]:
+    for key in LLM_CONFIG_KEYS:
         if params.get(key):
             config[key] = params[key]
 
@@ -910,7 +1337,11 @@ def handle_render_template(params):
 {text}"""
 
     try:
-        html = generate(prompt, config, timeout=60, need_search=False)
+        # 同一段文字反复渲染（切换模板、重新发布）时直接复用
+        # 机械性任务：MODEL_ROUTES 的 render 梯队，输出缺少 <section> 时升级
+        html = model_router.generate("render", prompt, config,
+                                     validate=model_router.has_section,
+                                     timeout=60, need_search=False, cache_ttl=30 * 86400)
         if html:
             # 提取 HTML 部分
             from daily_ai_news import extract_html
@@ -954,10 +1385,10 @@ def handle_extract_files(params):
                                 "error": f"不支持的文件类型: {ext}"})
                 continue
 
-            # 截断过长内容（避免超出 LLM 上下文）
-            max_chars = 50000
-            if len(text) > max_chars:
-                text = text[:max_chars] + f"\n\n... (内容已截断，原文共 {len(text)} 字符)"
+            # 只截断超大文件；按模型上下文窗口的裁剪在生成时由 prompt_budget 完成
+            if len(text) > EXTRACT_MAX_CHARS:
+                text = (text[:EXTRACT_MAX_CHARS]
+                        + f"\n\n... (内容已截断，原文共 {len(text)} 字符)")
 
             results.append({"path": fpath, "name": name, "text": text,
                             "chars": len(text)})
@@ -1075,6 +1506,29 @@ def _extract_pptx(fpath):
     return "\n\n".join(parts) if parts else "(空 PPT)"
 
 
+def _maybe_cleanup():
+    """每天最多清理一次过期日志和缓存，避免每次启动都扫描目录"""
+    try:
+        last = os.path.getmtime(CLEANUP_STAMP)
+    except OSError:
+        last = 0
+    if datetime.now().timestamp() - last < 86400:
+        return
+    _cleanup_old_logs()
+    _cleanup_old_cache()
+    cleanup_old_traces()
+    from checkpoint import cleanup_old_checkpoints
+    cleanup_old_checkpoints()
+    import llm_cache
+    llm_cache.prune_expired()
+    usage_ledger.prune()
+    try:
+        with open(CLEANUP_STAMP, "w", encoding="utf-8") as f:
+            f.write(datetime.now().isoformat())
+    except OSError:
+        pass
+
+
 def _cleanup_old_logs(max_days=7):
     """清理超过 max_days 天的日志文件"""
     import glob
@@ -1113,16 +1567,51 @@ def handle_get_logs(params):
 
 
 def handle_clear_cache(params):
-    """清理缓存目录"""
+    """清理缓存目录（含 LLM 响应缓存）"""
     import glob
+    import llm_cache
     count = 0
     for f in glob.glob(os.path.join(CACHE_DIR, "*")):
+        if os.path.isdir(f):
+            continue
         try:
             os.remove(f)
             count += 1
         except OSError:
             pass
-    emit("result", status="success", message=f"已清理 {count} 个缓存文件")
+    llm_count = llm_cache.clear()
+    emit("result", status="success",
+         message=f"已清理 {count} 个缓存文件、{llm_count} 条 LLM 缓存")
+
+
+def handle_cache_stats(params):
+    """LLM 响应缓存的命中率和磁盘占用，以及在途请求合并的计数"""
+    import llm_cache
+    import singleflight
+    emit("result", status="success", singleflight=singleflight.stats(), **llm_cache.stats())
+
+
+def handle_get_usage(params):
+    """LLM 用量与估算费用：最近 days 天按日期 / 服务商 / action / 模板 / 模型汇总"""
+    try:
+        days = max(1, int(params.get("days", 30)))
+    except (TypeError, ValueError):
+        days = 30
+    group_by = params.get("group_by") or usage_ledger.GROUP_COLUMNS
+    config = {"LLM_PRICES": params["LLM_PRICES"]} if params.get("LLM_PRICES") else None
+    try:
+        summary = usage_ledger.summarize(days=days, group_by=group_by, config=config)
+    except ValueError as e:
+        emit("error", code="INVALID_INPUT", message=str(e))
+        return
+    emit("result", status="success", **summary)
+
+
+def handle_provider_health(params):
+    """各 LLM / 搜索服务商的断路器状态；reset=true 时清除（可用 key 指定单个）"""
+    import circuit_breaker
+    cleared = circuit_breaker.reset(params.get("key")) if params.get("reset") else 0
+    emit("result", status="success", cleared=cleared, breakers=circuit_breaker.states())
 
 
 def handle_publish_wechat(params):
@@ -1156,7 +1645,8 @@ def handle_publish_wechat(params):
 
         # 上传文章内图片到微信 CDN
         emit("progress", stage="publish", message="正在上传文章图片到微信...")
-        html = process_images_in_html(html, mode="wechat", access_token=token)
+        html = process_images_in_html(html, mode="wechat", access_token=token,
+                                      token=current_token())
 
         # 上传封面图
         thumb_media_id = None
@@ -1202,12 +1692,14 @@ def handle_publish_wechat(params):
         emit("error", code="PUBLISH_ERROR", message=str(e))
 
 
+@traced("convert", cat="convert")
 def _convert_html_to_format(html_content, target_ext, output_dir, timestamp=""):
     """将 HTML 内容转换为目标格式文件（PDF/DOCX/XLSX）。
 
     作为 Agent 未能生成原格式文件时的兜底方案。
     """
     import re
+    current_span().set(format=target_ext)
     os.makedirs(output_dir, exist_ok=True)
 
     # 从 HTML 提取纯文本（保留段落结构）
@@ -1343,48 +1835,295 @@ def _text_to_xlsx(text, output_dir, timestamp=""):
     return out_path
 
 
+# 轻量 action：只读本地文件，不允许 import 生成链路（见 startup_profile.GENERATION_STACK）
+LIGHT_ACTIONS = ("get_config", "list_articles", "read_file", "get_logs")
+
+# 子进程设置该环境变量时，命令结束后输出 startup_profile 事件（已加载模块等）
+PROFILE_ENV = "INK_PROFILE_STARTUP"
+
+
+def _emit_startup_report():
+    """profile 子进程：上报本次命令加载了哪些生成链路模块"""
+    from startup_profile import GENERATION_STACK
+    loaded = sorted(m for m in GENERATION_STACK if m in sys.modules)
+    emit("startup_profile", module_count=len(sys.modules),
+         generation_modules=loaded)
+
+
+def handle_profile_startup(params):
+    """冷启动分析：为每个 action 启动全新 sidecar 进程，
+    测量首个事件到达时间（TTFE）和总耗时，并统计各模块 import 耗时。
+
+    params.probe_imports 非空时为子进程探针模式：在本进程内逐个 import 并计时。
+    """
+    import startup_profile
+
+    probe = params.get("probe_imports")
+    if probe:
+        emit("result", status="success",
+             imports=startup_profile.time_imports(probe))
+        return
+
+    runs = max(1, int(params.get("runs", 3)))
+    commands = params.get("actions") or [{"action": a} for a in LIGHT_ACTIONS]
+    reports = []
+    for idx, command in enumerate(commands):
+        if isinstance(command, str):
+            command = {"action": command}
+        emit("progress", stage="profile",
+             message=f"正在测量 {command.get('action')} ({idx + 1}/{len(commands)})...",
+             percent=int(idx * 80 / len(commands)))
+        reports.append(startup_profile.profile_action(command, runs=runs))
+
+    emit("progress", stage="profile", message="正在测量模块 import 耗时...", percent=85)
+    imports = startup_profile.profile_imports()
+    emit("result", status="success", actions=reports, imports=imports)
+
+
+HANDLERS = {
+    "generate": handle_generate,
+    "agent_generate": handle_agent_generate,
+    "validate_key": handle_validate_key,
+    "test_wechat": handle_test_wechat,
+    "list_articles": handle_list_articles,
+    "get_config": handle_get_config,
+    "save_config": handle_save_config,
+    "read_file": handle_read_file,
+    "delete_article": handle_delete_article,
+    "extract_files": handle_extract_files,
+    "render_template": handle_render_template,
+    "get_logs": handle_get_logs,
+    "clear_cache": handle_clear_cache,
+    "cache_stats": handle_cache_stats,
+    "get_usage": handle_get_usage,
+    "provider_health": handle_provider_health,
+    "publish_wechat": handle_publish_wechat,
+    "profile_startup": handle_profile_startup,
+    "batch_generate": handle_batch_generate,
+    "resume": handle_resume,
+}
+
+
+# 记录阶段 span 的 action：trace 写入 INK_HOME/traces，汇总附加到 result 事件
+TRACED_ACTIONS = ("generate", "agent_generate", "batch_generate", "resume",
+                  "publish_wechat", "render_template")
+
+
+def dispatch(command):
+    """执行单条命令，返回 handler 是否正常结束"""
+    action = command.get("action")
+    logger.info("action=%s", action)
+
+    handler = HANDLERS.get(action)
+    if not handler:
+        logger.warning("unknown action: %s", action)
+        emit("error", code="UNKNOWN_ACTION", message=f"未知操作: {action}")
+        return False
+    # LLM 调用按 action / 模板记入用量账本
+    usage_token = usage_ledger.bind_action(
+        action, command.get("template_id") or command.get("mode") or "")
+    try:
+        return _dispatch_handler(action, handler, command)
+    finally:
+        usage_ledger.unbind_action(usage_token)
+
+
+def _dispatch_handler(action, handler, command):
+    """按需开启 trace 后调用 handler"""
+    if action in TRACED_ACTIONS:
+        trace, trace_token = start_trace(action, _current_request_id.get() or "")
+        try:
+            with span(action, cat="request"):
+                return _call_handler(action, handler, command)
+        finally:
+            end_trace(trace_token)
+            logger.info("trace %s: %d spans -> %s", action, len(trace.spans), trace.path)
+    return _call_handler(action, handler, command)
+
+
+def _call_handler(action, handler, command):
+    """调用 handler，将取消/超时/异常转为 error 事件，返回是否正常结束"""
+    try:
+        handler(command)
+        return True
+    except DeadlineExceeded as e:
+        logger.warning("handler %s deadline exceeded: %s", action, e.reason)
+        emit("error", code="DEADLINE_EXCEEDED", message=f"请求超时: {e.reason}")
+        return False
+    except Cancelled as e:
+        logger.info("handler %s cancelled: %s", action, e.reason)
+        emit("error", code="CANCELLED", message=f"已取消: {e.reason}")
+        return False
+    except Exception as e:
+        logger.exception("handler %s failed", action)
+        emit("error", code="INTERNAL_ERROR", message=str(e))
+        return False
+
+
+class _PrintToEvents(io.TextIOBase):
+    """daemon 模式下接管 sys.stdout：把模块里的 print 输出转成带 request_id 的 log 事件，
+    避免非 JSON 行混入事件流。"""
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        buf = getattr(self._local, "buf", "") + s
+        while "\n" in buf:
+            line, buf = buf.split("\n", 1)
+            if line.strip():
+                try:
+                    emit("progress", stage="log", message=line)
+                except Cancelled:
+                    pass  # 已取消的请求不再输出日志，print 本身不作为取消点
+        self._local.buf = buf
+        return len(s)
+
+
+# daemon 模式下正在执行的请求：request_id → CancelToken
+_active_requests = {}
+_active_lock = threading.Lock()
+
+
+def _run_command(request_id, command, token):
+    """daemon 模式下执行一条命令，事件带上 request_id，结束时输出 done"""
+    rid_token = _current_request_id.set(request_id)
+    cancel_token = bind_token(token)
+    try:
+        ok = dispatch(command)
+        emit("done", ok=ok)
+    finally:
+        with _active_lock:
+            _active_requests.pop(request_id, None)
+        token.close()
+        unbind_token(cancel_token)
+        _current_request_id.reset(rid_token)
+
+
+def _make_request_token(command):
+    """按命令的 timeout 字段（秒）创建请求令牌；未设置时不限总时长"""
+    timeout = command.get("timeout")
+    try:
+        timeout = float(timeout) if timeout else None
+    except (TypeError, ValueError):
+        timeout = None
+    return CancelToken(timeout=timeout)
+
+
+def _handle_cancel(command):
+    """cancel 动作：取消指定 request_id 的请求，不影响其他请求；返回是否找到目标"""
+    target = str(command.get("target") or "")
+    with _active_lock:
+        token = _active_requests.get(target)
+    if token is None:
+        emit("error", code="NOT_FOUND", message=f"请求不存在或已结束: {target}",
+             request_id=command.get("request_id"))
+        return False
+    token.cancel(command.get("reason") or "用户取消")
+    logger.info("cancel requested: %s", target)
+    emit("result", status="success", message=f"已请求取消 {target}",
+         request_id=command.get("request_id"))
+    return True
+
+
+def _submit_command(executor, command):
+    """登记请求并提交到线程池"""
+    request_id = str(command.get("request_id") or uuid.uuid4().hex[:12])
+    token = _make_request_token(command)
+    with _active_lock:
+        if request_id in _active_requests:
+            emit("error", code="DUPLICATE_REQUEST",
+                 message=f"request_id 正在执行中: {request_id}",
+                 request_id=request_id)
+            token.close()
+            return
+        _active_requests[request_id] = token
+    # 每个请求在独立的 context 中运行，contextvars 互不干扰
+    ctx = contextvars.copy_context()
+    executor.submit(ctx.run, _run_command, request_id, command, token)
+
+
+def run_daemon():
+    """常驻模式：逐行读取 JSON 命令并发执行，直到 stdin 关闭或收到 shutdown"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    _init_runtime()
+    sys.stdout = _PrintToEvents()
+    workers = max(1, int(os.environ.get("INK_SIDECAR_WORKERS", "4")))
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ink-req")
+    logger.info("daemon start pid=%d workers=%d", os.getpid(), workers)
+    emit("ready", pid=os.getpid(), workers=workers)
+
+    while True:
+        line = sys.stdin.readline()
+        if not line:
+            break  # stdin EOF：宿主进程退出
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            command = json.loads(line)
+        except json.JSONDecodeError:
+            emit("error", code="INVALID_INPUT", message="无效的 JSON 输入")
+            continue
+        if not isinstance(command, dict):
+            emit("error", code="INVALID_INPUT", message="命令必须是 JSON 对象")
+            continue
+
+        # shutdown / ping / cancel 在读取线程内直接处理，同样以 done 结束
+        action = command.get("action")
+        request_id = command.get("request_id")
+        if action == "shutdown":
+            emit("result", status="success", message="sidecar 已退出", request_id=request_id)
+            emit("done", ok=True, request_id=request_id)
+            break
+        if action == "ping":
+            emit("result", status="success", message="pong", request_id=request_id)
+            emit("done", ok=True, request_id=request_id)
+            continue
+        if action == "cancel":
+            emit("done", ok=_handle_cancel(command), request_id=request_id)
+            continue
+
+        _configure_log_file()
+        _submit_command(executor, command)
+
+    # 退出前取消仍在运行的请求，等待它们在安全点收尾
+    with _active_lock:
+        pending = list(_active_requests.values())
+    for token in pending:
+        token.cancel("sidecar 退出")
+    executor.shutdown(wait=True)
+    logger.info("daemon exit")
+    _shutdown_runtime()
+
+
 def main():
-    # 启动时清理过期日志和缓存
-    _cleanup_old_logs()
-    _cleanup_old_cache()
+    if "--daemon" in sys.argv[1:]:
+        run_daemon()
+        return
+
+    _init_runtime()
 
     raw = sys.stdin.read()
     try:
         command = json.loads(raw)
     except json.JSONDecodeError:
         emit("error", code="INVALID_INPUT", message="无效的 JSON 输入")
+        _shutdown_runtime()
         sys.exit(1)
 
-    action = command.get("action")
-    logger.info("action=%s", action)
-    handlers = {
-        "generate": handle_generate,
-        "agent_generate": handle_agent_generate,
-        "validate_key": handle_validate_key,
-        "test_wechat": handle_test_wechat,
-        "list_articles": handle_list_articles,
-        "get_config": handle_get_config,
-        "save_config": handle_save_config,
-        "read_file": handle_read_file,
-        "delete_article": handle_delete_article,
-        "extract_files": handle_extract_files,
-        "render_template": handle_render_template,
-        "get_logs": handle_get_logs,
-        "clear_cache": handle_clear_cache,
-        "publish_wechat": handle_publish_wechat,
-    }
-
-    handler = handlers.get(action)
-    if handler:
-        try:
-            handler(command)
-        except Exception as e:
-            logger.exception("handler %s failed", action)
-            emit("error", code="INTERNAL_ERROR", message=str(e))
-            sys.exit(1)
-    else:
-        logger.warning("unknown action: %s", action)
-        emit("error", code="UNKNOWN_ACTION", message=f"未知操作: {action}")
+    token = _make_request_token(command)
+    bind_token(token)
+    ok = dispatch(command)
+    token.close()
+    if os.environ.get(PROFILE_ENV):
+        _emit_startup_report()
+    _shutdown_runtime()
+    if not ok:
         sys.exit(1)
 
 
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+相同在途请求合并（singleflight）
+
+daemon / batch_generate 并发生成多篇文章时，常有几个任务同时发出完全相同的请求：
+日报各公司的搜索词、相同模板的页眉渲染、样板段落的翻译批次。同一进程内，
+键相同的并发调用只有第一个（leader）真正发起，其余调用等待并共享其结果：
+
+    content = singleflight.do(("llm", cache_key), produce, token)
+
+- 键由调用方给出：LLM 调用与响应缓存同键（llm_cache.make_key），
+  搜索按 (服务商, 查询词, 条数)，网页抓取按 URL
+- 只合并在途请求，结果不保留；跨时间的复用由 llm_cache 负责
+- leader 的异常同样交给所有等待者；但 leader 被取消 / 超过截止时间时，
+  等待者不受其影响，由其中一个重新发起
+- 等待可被各自的 CancelToken 打断，记录为 singleflight.wait span
+"""
+
+import threading
+
+from cancellation import Cancelled, current_token
+from ink_trace import span
+
+# 等待 leader 时检查取消的间隔（秒）
+_POLL_SECONDS = 0.5
+
+_calls = {}
+_lock = threading.Lock()
+_stats = {"leaders": 0, "shared": 0}
+
+
+class _Call:
+    __slots__ = ("done", "result", "error", "waiters")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+def do(key, fn, token=None):
+    """执行 fn()；键相同的调用正在进行时等待并返回它的结果"""
+    if token is None:
+        token = current_token()
+    while True:
+        with _lock:
+            call = _calls.get(key)
+            leader = call is None
+            if leader:
+                call = _calls[key] = _Call()
+                _stats["leaders"] += 1
+            else:
+                call.waiters += 1
+                _stats["shared"] += 1
+
+        if leader:
+            try:
+                call.result = fn()
+                return call.result
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with _lock:
+                    del _calls[key]
+                call.done.set()
+
+        with span("singleflight.wait", cat="wait", kind=str(key[0])):
+            while not call.done.wait(_POLL_SECONDS):
+                token.check()
+        token.check()
+        if isinstance(call.error, Cancelled):
+            continue  # leader 自己的请求被取消，与本请求无关，重新发起
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+def stats():
+    """进程内计数：leaders 为实际发起的调用数，shared 为共享结果的调用数"""
+    with _lock:
+        counters = dict(_stats)
+        counters["in_flight"] = len(_calls)
+    return counters
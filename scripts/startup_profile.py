@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+Sidecar 冷启动分析
+
+- profile_action(): 启动全新 sidecar 进程执行一条命令，测量首个事件到达时间
+  （time-to-first-event, TTFE）和总耗时，并检查该命令是否加载了生成链路模块
+- profile_imports(): 在全新 sidecar 进程中逐个 import 模块并计时
+  （走 sidecar 自身的 profile_startup 探针，PyInstaller 打包后同样可用）
+
+用法（冷启动基准）:
+    python3 scripts/startup_profile.py                      # 轻量 action，各 3 次
+    python3 scripts/startup_profile.py --runs 10 get_logs   # 指定 action 和次数
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SIDECAR_SCRIPT = os.path.join(SCRIPT_DIR, "sidecar_main.py")
+
+# 生成链路模块：轻量 action 不应加载其中任何一个
+GENERATION_STACK = (
+    "daily_ai_news", "agent_loop", "agent_prompts", "llm_adapter",
+    "search_adapter", "translate_inplace", "image_processor", "video_analyzer",
+    "requests", "PIL", "docx", "pptx", "openpyxl", "pdfplumber", "fitz",
+    "reportlab", "oss2", "pandas", "numpy", "matplotlib",
+)
+
+
+def sidecar_command():
+    """返回启动 sidecar 的命令行：打包后就是可执行文件本身"""
+    if getattr(sys, "frozen", False):
+        return [sys.executable]
+    return [sys.executable, SIDECAR_SCRIPT]
+
+
+def _run_once(command, timeout):
+    """启动一次 sidecar，返回 (ttfe_ms, total_ms, events)"""
+    env = {**os.environ, "INK_PROFILE_STARTUP": "1",
+           "PYTHONIOENCODING": "utf-8", "PYTHONUTF8": "1"}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(
+        sidecar_command(),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        env=env,
+    )
+    proc.stdin.write(json.dumps(command, ensure_ascii=False).encode("utf-8"))
+    proc.stdin.close()
+
+    ttfe_ms = None
+    events = []
+    try:
+        for raw in proc.stdout:
+            if ttfe_ms is None:
+                ttfe_ms = (time.perf_counter() - t0) * 1000
+            try:
+                events.append(json.loads(raw.decode("utf-8", errors="replace")))
+            except json.JSONDecodeError:
+                pass
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+    total_ms = (time.perf_counter() - t0) * 1000
+    return ttfe_ms, total_ms, events
+
+
+def _summary(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {
+        "min": round(min(values), 1),
+        "median": round(statistics.median(values), 1),
+        "max": round(max(values), 1),
+    }
+
+
+def profile_action(command, runs=3, timeout=120):
+    """多次冷启动执行同一命令，返回 TTFE/总耗时统计和加载的生成链路模块"""
+    ttfes, totals = [], []
+    generation_modules = []
+    module_count = None
+    for _ in range(runs):
+        ttfe_ms, total_ms, events = _run_once(command, timeout)
+        ttfes.append(ttfe_ms)
+        totals.append(total_ms)
+        for ev in events:
+            if ev.get("type") == "startup_profile":
+                generation_modules = ev.get("generation_modules", [])
+                module_count = ev.get("module_count")
+    return {
+        "action": command.get("action"),
+        "runs": runs,
+        "ttfe_ms": _summary(ttfes),
+        "total_ms": _summary(totals),
+        "module_count": module_count,
+        "generation_modules": generation_modules,
+    }
+
+
+def time_imports(modules):
+    """在当前进程中按顺序 import 模块并计时（毫秒）。
+
+    依赖被先 import 的模块计入其首个导入者，结果反映的是增量成本。
+    """
+    import importlib
+    results = []
+    for name in modules:
+        t0 = time.perf_counter()
+        try:
+            importlib.import_module(name)
+            error = None
+        except Exception as e:
+            error = str(e)
+        results.append({
+            "module": name,
+            "ms": round((time.perf_counter() - t0) * 1000, 2),
+            "error": error,
+        })
+    return results
+
+
+def profile_imports(modules=GENERATION_STACK, timeout=120):
+    """在全新 sidecar 进程中测量各模块 import 耗时"""
+    command = {"action": "profile_startup", "probe_imports": list(modules)}
+    _, _, events = _run_once(command, timeout)
+    for ev in events:
+        if ev.get("type") == "result" and "imports" in ev:
+            return ev["imports"]
+    return []
+
+
+def main():
+    runs = 3
+    actions = []
+    argv = sys.argv[1:]
+    i = 0
+    while i < len(argv):
+        if argv[i] == "--runs" and i + 1 < len(argv):
+            i += 1
+            runs = int(argv[i])
+        else:
+            actions.append(argv[i])
+        i += 1
+    if not actions:
+        actions = ["get_config", "list_articles", "read_file", "get_logs"]
+
+    print(f"{'action':<16}{'TTFE median':>14}{'total median':>15}  generation modules")
+    for action in actions:
+        report = profile_action({"action": action}, runs=runs)
+        ttfe = report["ttfe_ms"]["median"] if report["ttfe_ms"] else "-"
+        total = report["total_ms"]["median"] if report["total_ms"] else "-"
+        loaded = ", ".join(report["generation_modules"]) or "(none)"
+        print(f"{action:<16}{ttfe:>12} ms{total:>13} ms  {loaded}")
+
+    print("\nimport cost (fresh process, incremental):")
+    for item in sorted(profile_imports(), key=lambda x: -x["ms"]):
+        note = f"  [{item['error']}]" if item["error"] else ""
+        print(f"  {item['module']:<20}{item['ms']:>9} ms{note}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,11 +12,14 @@ import os
 import logging
 import re
 
+from ink_trace import traced
+
 logger = logging.getLogger("ink")
 
 
+@traced("translate.file", cat="translate")
 def translate_file_inplace(input_path, output_path, target_lang, config,
-                           emit_fn=None):
+                           emit_fn=None, token=None):
     """
     翻译文件，保持原格式。
 
@@ -26,6 +29,7 @@ def translate_file_inplace(input_path, output_path, target_lang, config,
         target_lang: 目标语言描述，如 "英文"、"日文"
         config: LLM 配置 dict
         emit_fn: 进度回调 emit(type, **kwargs)
+        token: CancelToken，每批翻译前检查取消/截止时间
 
     Returns:
         output_path if success, None if failed
@@ -34,17 +38,17 @@ def translate_file_inplace(input_path, output_path, target_lang, config,
 
     if ext == ".docx":
         return _translate_docx(input_path, output_path, target_lang,
-                               config, emit_fn)
+                               config, emit_fn, token)
     elif ext == ".pptx":
         return _translate_pptx(input_path, output_path, target_lang,
-                               config, emit_fn)
+                               config, emit_fn, token)
     elif ext in (".doc", ".ppt"):
         logger.error("旧版 Office 格式 %s 不支持原格式翻译，请转换为 %sx 后重试",
                      ext, ext)
         return None
     elif ext == ".pdf":
         return _translate_pdf(input_path, output_path, target_lang,
-                              config, emit_fn)
+                              config, emit_fn, token)
     else:
         logger.warning("Unsupported format for inplace translation: %s", ext)
         return None
@@ -56,16 +60,22 @@ def translate_file_inplace(input_path, output_path, target_lang, config,
 
 # 每批最大字符数（避免超出 LLM 上下文）
 BATCH_MAX_CHARS = 8000
+# 同一批原文的译文长期有效（需开启 LLM_CACHE），重试/重译时直接复用
+TRANSLATE_CACHE_TTL = 30 * 86400
 
 
-def _batch_translate(segments, target_lang, config, emit_fn=None):
+def _batch_translate(segments, target_lang, config, emit_fn=None, token=None):
     """
     批量翻译文本段落。
 
     将 segments 分批发送给 LLM，返回与 segments 等长的翻译列表。
-    空字符串保持不变。
+    空字符串保持不变。每批开始前检查 token，取消后不再发起新的批次。
     """
-    from llm_adapter import generate
+    import model_router
+    from cancellation import current_token
+
+    if token is None:
+        token = current_token()
 
     # 过滤出需要翻译的段落（非空且有实际文字内容）
     indexed = []  # (original_index, text)
@@ -95,6 +105,7 @@ def _batch_translate(segments, target_lang, config, emit_fn=None):
     total_batches = len(batches)
 
     for batch_idx, batch in enumerate(batches):
+        token.check()
         if emit_fn:
             emit_fn("progress", stage="translating",
                     message=f"翻译中 ({batch_idx + 1}/{total_batches})...")
@@ -103,7 +114,12 @@ def _batch_translate(segments, target_lang, config, emit_fn=None):
         prompt = _build_translate_prompt(texts, target_lang)
 
         try:
-            response = generate(prompt, config, timeout=120, need_search=False)
+            # 便宜的模型漏译、串号时升级到更强的模型（MODEL_ROUTES 的 translate 梯队）
+            response = model_router.generate(
+                "translate", prompt, config,
+                validate=lambda r: all(t.strip() for t in
+                                       _parse_translate_response(r, len(texts))),
+                timeout=120, need_search=False, token=token, cache_ttl=TRANSLATE_CACHE_TTL)
             translations = _parse_translate_response(response, len(texts))
 
             for i, (orig_idx, _) in enumerate(batch):
@@ -119,9 +135,9 @@ def _batch_translate(segments, target_lang, config, emit_fn=None):
 
 
 def _build_translate_prompt(texts, target_lang):
-    """构建批量翻译 prompt"""
+    """构建批量翻译 prompt（固定的要求在前，目标语言和原文在后，便于命中服务商的前缀缓存）"""
     numbered = "\n".join(f"[{i+1}] {t}" for i, t in enumerate(texts))
-    return f"""你是专业翻译。请将以下编号文本翻译为{target_lang}。
+    return f"""你是专业翻译。请将以下编号文本翻译为目标语言。
 
 要求：
 1. 每条翻译用相同的编号格式输出：[编号] 翻译内容
@@ -130,6 +146,8 @@ def _build_translate_prompt(texts, target_lang):
 4. 数字、代码、URL 等保持原样
 5. 如果原文只有标点或空白，保持原样
 
+目标语言：{target_lang}
+
 原文：
 {numbered}
 
@@ -155,7 +173,7 @@ def _parse_translate_response(response, expected_count):
 # Word (.docx) 翻译
 # ============================================================
 
-def _translate_docx(input_path, output_path, target_lang, config, emit_fn):
+def _translate_docx(input_path, output_path, target_lang, config, emit_fn, token=None):
     """翻译 Word 文档，保持原格式"""
     from docx import Document
 
@@ -191,7 +209,7 @@ def _translate_docx(input_path, output_path, target_lang, config, emit_fn):
                 message=f"Word 文档共 {len(segments)} 个文本段...")
 
     # 批量翻译
-    translations = _batch_translate(segments, target_lang, config, emit_fn)
+    translations = _batch_translate(segments, target_lang, config, emit_fn, token)
 
     # 回写翻译结果
     for i, (ref_type, ref) in enumerate(segment_refs):
@@ -208,7 +226,7 @@ def _translate_docx(input_path, output_path, target_lang, config, emit_fn):
 # PPT (.pptx) 翻译
 # ============================================================
 
-def _translate_pptx(input_path, output_path, target_lang, config, emit_fn):
+def _translate_pptx(input_path, output_path, target_lang, config, emit_fn, token=None):
     """翻译 PPT，保持原格式"""
     from pptx import Presentation
 
@@ -243,7 +261,7 @@ def _translate_pptx(input_path, output_path, target_lang, config, emit_fn):
         emit_fn("progress", stage="translating",
                 message=f"PPT 共 {len(segments)} 个文本段...")
 
-    translations = _batch_translate(segments, target_lang, config, emit_fn)
+    translations = _batch_translate(segments, target_lang, config, emit_fn, token)
 
     for i, (ref_type, ref) in enumerate(segment_refs):
         if ref_type == "run" and i < len(translations):
@@ -259,7 +277,7 @@ def _translate_pptx(input_path, output_path, target_lang, config, emit_fn):
 # PDF 翻译
 # ============================================================
 
-def _translate_pdf(input_path, output_path, target_lang, config, emit_fn):
+def _translate_pdf(input_path, output_path, target_lang, config, emit_fn, token=None):
     """翻译 PDF，尽量保持原格式。
 
     使用 PyMuPDF 逐页提取文本块，翻译后覆盖写回。
@@ -304,7 +322,7 @@ def _translate_pdf(input_path, output_path, target_lang, config, emit_fn):
         emit_fn("progress", stage="translating",
                 message=f"PDF 共 {len(segments)} 个文本段...")
 
-    translations = _batch_translate(segments, target_lang, config, emit_fn)
+    translations = _batch_translate(segments, target_lang, config, emit_fn, token)
 
     # 回写：按页分组，每页先收集所有 redaction，apply 一次，再插入文本
     if emit_fn:
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""
+LLM 用量与费用账本
+
+每次 LLM 调用（llm_adapter 的每次尝试、agent_loop 的每轮 function-calling）写入
+INK_HOME/usage.db（SQLite）一行：时间、sidecar action、模板、服务商、模型、
+输入 / 输出 / 缓存命中 token、延迟、结果。用于估算预算、找出最耗 token 的模板：
+
+    with usage_ledger.meter("deepseek", model):
+        ...
+        usage_ledger.note(data.get("usage"))   # 解析 usage，同时计入当前 span
+
+- action / 模板由 sidecar 的 dispatch 通过 bind_action 绑定到上下文，
+  单次命令行运行记为 "cli"
+- note() 兼容 OpenAI（prompt_tokens_details.cached_tokens）、
+  DeepSeek（prompt_cache_hit_tokens）、Kimi（cached_tokens）和
+  Anthropic（input_tokens / cache_read_input_tokens）的 usage 格式
+- 费用在查询时按 MODEL_PRICES（美元 / 百万 token，可用 LLM_PRICES 覆盖）估算，
+  调整价格后历史数据随之重算
+- 写入失败只记录警告，不影响生成
+"""
+
+import contextlib
+import contextvars
+import logging
+import os
+import time
+
+from ink_env import INK_HOME
+from ink_trace import current_span
+
+logger = logging.getLogger("ink")
+
+DB_PATH = os.path.join(str(INK_HOME), "usage.db")
+
+# 模型 → (输入, 输出, 缓存命中输入)，美元 / 百万 token，按各家公开价格折算的估计值
+MODEL_PRICES = {
+    "deepseek-chat": (0.27, 1.10, 0.07),
+    "deepseek-reasoner": (0.55, 2.19, 0.14),
+    "gpt-4o": (2.50, 10.00, 1.25),
+    "gpt-4o-mini": (0.15, 0.60, 0.075),
+    "glm-4-flash": (0.0, 0.0, 0.0),
+    "doubao-1.5-pro-32k": (0.11, 0.28, 0.11),
+    "moonshot-v1-8k": (1.66, 1.66, 0.14),
+    "claude-sonnet-4-5": (3.00, 15.00, 0.30),
+}
+
+_action = contextvars.ContextVar("ink_usage_action", default=("cli", ""))
+_meter = contextvars.ContextVar("ink_usage_meter", default=None)
+
+
+def bind_action(action, template=""):
+    """绑定当前请求的 action 和模板，返回用于 unbind_action 的 contextvars.Token"""
+    return _action.set((action, template or ""))
+
+
+def unbind_action(ctx_token):
+    _action.reset(ctx_token)
+
+
+# ==================== 记录 ====================
+
+def parse_usage(usage):
+    """各家 usage 结构 → (输入 token, 输出 token, 缓存命中 token)；缺失项为 None"""
+    if not usage:
+        return None, None, None
+    if "input_tokens" in usage:
+        # Anthropic：input_tokens 不含缓存读取 / 写入部分
+        cached = usage.get("cache_read_input_tokens") or 0
+        tokens_in = ((usage.get("input_tokens") or 0) + cached
+                     + (usage.get("cache_creation_input_tokens") or 0))
+        return tokens_in, usage.get("output_tokens"), cached
+    details = usage.get("prompt_tokens_details") or {}
+    cached = (details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens")
+              or usage.get("cached_tokens") or 0)
+    return usage.get("prompt_tokens"), usage.get("completion_tokens"), cached
+
+
+class _Meter:
+    __slots__ = ("tokens_in", "tokens_out", "tokens_cached")
+
+    def __init__(self):
+        self.tokens_in = None
+        self.tokens_out = None
+        self.tokens_cached = None
+
+
+def note(usage):
+    """记录一次响应的 usage：计入当前 span（tokens_in / tokens_out / tokens_cached）
+    和当前 meter；流式响应分多次到达时覆盖为最新值"""
+    tokens_in, tokens_out, cached = parse_usage(usage)
+    if tokens_in is None and tokens_out is None:
+        return
+    # usage 是截至目前的累计值（Anthropic 的 message_start / message_delta 各报一次），覆盖而不是累加
+    counts = {"tokens_in": tokens_in, "tokens_out": tokens_out, "tokens_cached": cached or None}
+    current_span().set(**{k: v for k, v in counts.items() if v is not None})
+    m = _meter.get()
+    if m is not None:
+        m.tokens_in = tokens_in if tokens_in is not None else m.tokens_in
+        m.tokens_out = tokens_out if tokens_out is not None else m.tokens_out
+        m.tokens_cached = cached if cached is not None else m.tokens_cached
+
+
+@contextlib.contextmanager
+def meter(provider, model, kind="generate"):
+    """计量一次 LLM 调用：块内 note() 的 usage 与耗时在退出时写入账本"""
+    m = _Meter()
+    ctx_token = _meter.set(m)
+    start = time.monotonic()
+    status = "error"
+    try:
+        yield m
+        status = "ok"
+    except BaseException as e:
+        if not isinstance(e, Exception):
+            status = "cancelled"
+        raise
+    finally:
+        _meter.reset(ctx_token)
+        action, template = _action.get()
+        record(action=action, template=template, kind=kind, provider=provider, model=model,
+               tokens_in=m.tokens_in, tokens_out=m.tokens_out, tokens_cached=m.tokens_cached,
+               latency_ms=round((time.monotonic() - start) * 1000), status=status)
+
+
+def _connect():
+    import sqlite3
+    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+    conn = sqlite3.connect(DB_PATH, timeout=10)
+    conn.execute("""CREATE TABLE IF NOT EXISTS calls (
+        ts REAL NOT NULL,
+        day TEXT NOT NULL,
+        action TEXT NOT NULL,
+        template TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        provider TEXT NOT NULL,
+        model TEXT NOT NULL,
+        tokens_in INTEGER,
+        tokens_out INTEGER,
+        tokens_cached INTEGER,
+        latency_ms INTEGER,
+        status TEXT NOT NULL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS calls_day ON calls (day)")
+    return conn
+
+
+def record(action, template, kind, provider, model, tokens_in=None, tokens_out=None,
+           tokens_cached=None, latency_ms=None, status="ok"):
+    """写入一行调用记录"""
+    import sqlite3
+    now = time.time()
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                conn.execute(
+                    "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (now, time.strftime("%Y-%m-%d", time.localtime(now)), action, template,
+                     kind, provider, model or "", tokens_in, tokens_out, tokens_cached,
+                     latency_ms, status))
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("usage ledger write failed: %s", e)
+
+
+# ==================== 查询 ====================
+
+def _prices(config=None):
+    """MODEL_PRICES 叠加 LLM_PRICES 覆盖，格式 "model=输入/输出/缓存命中, ..." """
+    prices = dict(MODEL_PRICES)
+    raw = (config or {}).get("LLM_PRICES") or os.environ.get("LLM_PRICES", "")
+    for item in raw.replace("，", ",").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            parts = [float(v) for v in value.split("/")]
+        except ValueError:
+            logger.warning("LLM_PRICES: invalid entry %s", item)
+            continue
+        parts += [parts[0]] * (3 - len(parts))
+        prices[name.strip()] = tuple(parts[:3])
+    return prices
+
+
+def _cost(prices, model, tokens_in, tokens_out, tokens_cached):
+    price = prices.get(model)
+    if price is None:
+        return None
+    uncached = max(0, tokens_in - tokens_cached)
+    return (uncached * price[0] + tokens_out * price[1] + tokens_cached * price[2]) / 1e6
+
+
+GROUP_COLUMNS = ("day", "provider", "action", "template", "model")
+
+
+def summarize(days=30, group_by=GROUP_COLUMNS, config=None):
+    """最近 days 天的用量，按 group_by 中每一列分别汇总。
+
+    返回 {"totals": {...}, "by_day": [...], "by_provider": [...], ...}，
+    每项含 calls / errors / tokens_in / tokens_out / tokens_cached / cache_hit_ratio /
+    avg_latency_ms / cost_usd（未知模型的费用不计入）。
+
+    group_by 可以是列名序列，也可以是逗号分隔的字符串；含未知列时抛出 ValueError。
+    """
+    import sqlite3
+    if isinstance(group_by, str):
+        group_by = group_by.split(",")
+    group_by = [str(g).strip() for g in group_by if str(g).strip()]
+    unknown = [g for g in group_by if g not in GROUP_COLUMNS]
+    if unknown:
+        raise ValueError(f"未知的汇总列: {', '.join(unknown)}，可选: {' / '.join(GROUP_COLUMNS)}")
+    since = time.time() - days * 86400
+    prices = _prices(config)
+    try:
+        conn = _connect()
+    except sqlite3.Error as e:
+        logger.warning("usage ledger unavailable: %s", e)
+        return {"days": days, "totals": {}}
+    try:
+        rows = conn.execute(
+            "SELECT day, provider, action, template, model, COUNT(*), "
+            "SUM(status != 'ok'), COALESCE(SUM(tokens_in), 0), "
+            "COALESCE(SUM(tokens_out), 0), COALESCE(SUM(tokens_cached), 0), "
+            "SUM(latency_ms) FROM calls WHERE ts >= ? "
+            "GROUP BY day, provider, action, template, model", (since,)).fetchall()
+    except sqlite3.Error as e:
+        logger.warning("usage ledger query failed: %s", e)
+        return {"days": days, "totals": {}}
+    finally:
+        conn.close()
+
+    def _empty():
+        return {"calls": 0, "errors": 0, "tokens_in": 0, "tokens_out": 0,
+                "tokens_cached": 0, "latency_ms": 0, "cost_usd": 0.0, "unpriced_calls": 0}
+
+    totals = _empty()
+    groups = {g: {} for g in group_by}
+    for day, provider, action, template, model, calls, errors, t_in, t_out, t_cached, lat \
+            in rows:
+        values = {"day": day, "provider": provider, "action": action,
+                  "template": template, "model": model}
+        cost = _cost(prices, model, t_in, t_out, t_cached)
+        for bucket in [totals] + [groups[g].setdefault(values[g], _empty()) for g in group_by]:
+            bucket["calls"] += calls
+            bucket["errors"] += errors or 0
+            bucket["tokens_in"] += t_in
+            bucket["tokens_out"] += t_out
+            bucket["tokens_cached"] += t_cached
+            bucket["latency_ms"] += lat or 0
+            if cost is None:
+                bucket["unpriced_calls"] += calls
+            else:
+                bucket["cost_usd"] += cost
+
+    def _finish(bucket):
+        bucket["avg_latency_ms"] = round(bucket.pop("latency_ms") / bucket["calls"]) \
+            if bucket["calls"] else 0
+        bucket["cost_usd"] = round(bucket["cost_usd"], 4)
+        # 服务商前缀缓存的命中比例（输入 token 中按缓存价计费的部分）
+        bucket["cache_hit_ratio"] = round(bucket["tokens_cached"] / bucket["tokens_in"], 3) \
+            if bucket["tokens_in"] else 0.0
+        return bucket
+
+    result = {"days": days, "totals": _finish(totals)}
+    for g in group_by:
+        items = [dict(_finish(b), **{g: key}) for key, b in groups[g].items()]
+        if g == "day":
+            items.sort(key=lambda b: b["day"], reverse=True)
+        else:
+            items.sort(key=lambda b: b["tokens_in"] + b["tokens_out"], reverse=True)
+        result[f"by_{g}"] = items
+    return result
+
+
+def prune(max_days=365):
+    """删除 max_days 天前的记录，返回删除行数"""
+    import sqlite3
+    try:
+        conn = _connect()
+        try:
+            with conn:
+                return conn.execute("DELETE FROM calls WHERE ts < ?",
+                                    (time.time() - max_days * 86400,)).rowcount
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        logger.warning("usage ledger prune failed: %s", e)
+        return 0
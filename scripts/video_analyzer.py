@@ -20,6 +20,8 @@ from pathlib import Path
 SCRIPT_DIR = Path(__file__).parent
 PROJECT_ROOT = SCRIPT_DIR.parent
 VIDEO_PROMPT_FILE = PROJECT_ROOT / "prompts" / "video_prompt_template.txt"
+# 同一视频/字幕的分析结果长期有效（需开启 LLM_CACHE）
+ANALYSIS_CACHE_TTL = 7 * 86400
 
 
 def extract_video_id(url):
@@ -288,43 +290,15 @@ def get_transcript(video_id):
     return None
 
 
-def chunk_transcript(text, max_chars=80000):
-    """
-    超长转录文本分块。
-    在句子边界处切分，每块不超过 max_chars 字符。
-    """
-    if len(text) <= max_chars:
-        return [text]
-
-    chunks = []
-    current_chunk = ""
-
-    # 按句号/问号/感叹号分割
-    sentences = re.split(r'([.!?。！？\n]+)', text)
-
-    for i in range(0, len(sentences), 2):
-        sentence = sentences[i]
-        delimiter = sentences[i + 1] if i + 1 < len(sentences) else ""
-        full_sentence = sentence + delimiter
-
-        if len(current_chunk) + len(full_sentence) > max_chars:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = full_sentence
-        else:
-            current_chunk += full_sentence
-
-    if current_chunk.strip():
-        chunks.append(current_chunk.strip())
-
-    return chunks
-
-
-def build_analysis_prompt(transcript, metadata):
+def build_analysis_prompt(transcript, metadata, config=None):
     """
     组装深度分析 prompt。
-    读取 video_prompt_template.txt 模板并填入变量。
+    读取 video_prompt_template.txt 模板并填入变量；转录文本和视频简介
+    按所配置模型的上下文窗口装填（转录优先，超长时保留首尾）。
     """
+    from prompt_budget import Section, pack
+    import model_router
+
     # 读取模板
     if VIDEO_PROMPT_FILE.exists():
         with open(VIDEO_PROMPT_FILE, "r", encoding="utf-8") as f:
@@ -351,8 +325,20 @@ def build_analysis_prompt(transcript, metadata):
     prompt = prompt.replace("{{CHANNEL}}", metadata.get("channel", ""))
     prompt = prompt.replace("{{DURATION}}", duration_str)
     prompt = prompt.replace("{{UPLOAD_DATE}}", upload_date)
-    prompt = prompt.replace("{{DESCRIPTION}}", metadata.get("description", ""))
-    prompt = prompt.replace("{{TRANSCRIPT}}", transcript)
+
+    provider, budget = model_router.input_budget("summarize", config or {})
+    skeleton = prompt.replace("{{DESCRIPTION}}", "").replace("{{TRANSCRIPT}}", "")
+    parts = pack([
+        Section("skeleton", skeleton, required=True),
+        Section("transcript", transcript, priority=1, keep="both"),
+        Section("description", metadata.get("description", "")),
+    ], budget, provider)
+    if len(parts["transcript"]) < len(transcript):
+        print(f"      转录文本超出模型上下文，保留首尾 {len(parts['transcript'])} 字符"
+              f"（原文 {len(transcript)} 字符）")
+
+    prompt = prompt.replace("{{DESCRIPTION}}", parts["description"])
+    prompt = prompt.replace("{{TRANSCRIPT}}", parts["transcript"])
 
     return prompt
 
@@ -365,18 +351,20 @@ def call_llm_for_analysis(prompt, config=None):
     if config is None:
         config = {}
 
-    from llm_adapter import generate, LLMError
+    from llm_adapter import LLMError
+    import model_router
 
-    provider = config.get("LLM_PROVIDER", "claude").lower()
+    routed = model_router.route_config("summarize", config)
+    provider = routed.get("LLM_PROVIDER", "claude").lower()
     print(f"      正在调用 AI 生成深度分析（提供商: {provider}）...")
     print("      (这一步需要较长时间，请耐心等待)")
 
     try:
-        if provider == "claude":
-            output = generate(prompt, config, timeout=900, need_search=True)
-        else:
-            # 非 Claude 后端：转录文本已在 prompt 中，信息量足够，可跳过搜索
-            output = generate(prompt, config, timeout=900, need_search=False)
+        # need_search 只对 Claude CLI 生效；其余后端转录文本已在 prompt 中，信息量足够
+        output = model_router.generate(
+            "summarize", prompt, config, validate=model_router.has_section,
+            timeout=900, need_search=True,
+            cache_ttl=ANALYSIS_CACHE_TTL)
     except LLMError as e:
         print(f"[错误] {e}")
         return None
@@ -426,21 +414,9 @@ def analyze_video(youtube_url, config=None):
         print("       - 视频不可访问或已被删除")
         return None, None
 
-    # 4. 处理超长文本
-    chunks = chunk_transcript(transcript)
-    if len(chunks) > 1:
-        print(f"      转录文本过长，已分为 {len(chunks)} 块")
-        # 对于多块文本，合并前几块（在 token 限制内尽量保留更多内容）
-        # 如果分块超过 3 个，只取前 3 块加最后一块的结尾
-        if len(chunks) > 3:
-            transcript = "\n\n".join(chunks[:3])
-            transcript += f"\n\n[... 中间部分省略 ...]\n\n{chunks[-1][-2000:]}"
-        else:
-            transcript = "\n\n".join(chunks)
-
-    # 5. 构建 prompt 并调用 Claude
+    # 4. 构建 prompt（超长转录按模型上下文窗口裁剪）并调用 LLM
     print("[1/4] 构建分析 prompt...")
-    prompt = build_analysis_prompt(transcript, metadata)
+    prompt = build_analysis_prompt(transcript, metadata, config)
 
     output = call_llm_for_analysis(prompt, config)
     if not output: